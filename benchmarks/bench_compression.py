@@ -0,0 +1,110 @@
+"""Effective push throughput with and without wire compression, on compressible and incompressible data.
+
+Usage: python benchmarks/bench_compression.py [--size BYTES] [--link-mbps 100,1000]
+
+Each corpus is pushed over loopback to a node, once raw and once with every codec both
+sides have. Loopback is never the bottleneck, so the effective throughput over a slower
+link is also given: the file size over whichever takes longer, the loopback push or
+sending the bytes that actually went on the wire at the link's speed.
+"""
+import argparse
+import os
+import queue
+import random
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import compression  # noqa: E402
+from file_utils import ChunkStore  # noqa: E402
+from node import ChunkSender, Node  # noqa: E402
+
+
+def csv_corpus(size):
+    rng = random.Random(0)
+    rows = []
+    total = 0
+    while total < size:
+        row = f"{total},2024-01-{rng.randint(1, 28):02d},user{rng.randint(1, 5000)},GET,/api/items/{rng.randint(1, 99999)},200,{rng.random():.4f}\n"
+        rows.append(row)
+        total += len(row)
+    return ''.join(rows).encode()[:size]
+
+
+def write_corpus(path, size, kind):
+    with open(path, 'wb') as f:
+        if kind == 'csv':
+            f.write(csv_corpus(size))
+        else:
+            f.write(os.urandom(size))
+    return ChunkStore.open(path)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_listener(port):
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+
+def wire_bytes(store, codec):
+    total = 0
+    for chunk_id in range(store.num_chunks):
+        for block_id, payload in compression.encode_chunk(store, chunk_id, codec):
+            total += store.block_range(block_id)[1] if payload is None else len(payload)
+    return total
+
+
+def push(port, store, file_name, codecs):
+    chunks = queue.Queue()
+    for chunk_id in range(store.num_chunks):
+        chunks.put(chunk_id)
+    sender = ChunkSender('127.0.0.1', port, store, chunks, file_name, codecs=codecs)
+    start = time.perf_counter()
+    sender.run()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=128 << 20)
+    parser.add_argument('--link-mbps', default='100,1000')
+    args = parser.parse_args()
+    links = [int(mbps) for mbps in args.link_mbps.split(',')]
+
+    # The receiving node writes its chunks under ./received_files
+    os.chdir(tempfile.mkdtemp())
+    port = free_port()
+    Node(port)
+    wait_for_listener(port)
+    codec = compression.choose(compression.available())
+
+    print(f"{args.size} bytes per corpus, codec {codec} (1 zlib, 2 zstd, 4 lz4)")
+    header = f"{'corpus':<8} {'mode':<6} {'ratio':>6} {'loopback MB/s':>14}"
+    print(header + ''.join(f" {f'@{mbps} Mbit/s MB/s':>18}" for mbps in links))
+    for kind in ('csv', 'random'):
+        store = write_corpus(f"{kind}.bin", args.size, kind)
+        for mode, codecs in (('raw', compression.NONE), ('packed', compression.available())):
+            elapsed = push(port, store, f"{kind}-{mode}.bin", codecs)
+            sent = wire_bytes(store, codec if codecs else compression.NONE)
+            row = f"{kind:<8} {mode:<6} {args.size / sent:>6.2f} {args.size / elapsed / 1e6:>14.1f}"
+            for mbps in links:
+                effective = args.size / max(elapsed, sent * 8 / (mbps * 1e6))
+                row += f" {effective / 1e6:>18.1f}"
+            print(row)
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
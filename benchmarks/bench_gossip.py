@@ -0,0 +1,127 @@
+"""Simulated swarm: tracker calls with every chunk scheduled by the tracker vs peers gossiping bitfields.
+
+Usage: python benchmarks/bench_gossip.py [--chunks N] [--leechers 10,50,200] [--summary-ticks N]
+
+Nodes are simulated in steps ("ticks") against a real in-process Tracker, every node
+uploading a few chunks per tick. In tracker mode, leechers ask the tracker for chunks
+whenever their window has room and report the chunks they got every tick, like Downloader
+used to. In gossip mode, each leecher bootstraps a SwarmView from one /torrent_data call,
+learns about new chunks from HAVEs (delivered the next tick), schedules rarest first
+itself, and only sends the tracker a summary every --summary-ticks.
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter, deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bitfield import Bitfield  # noqa: E402
+from gossip import SwarmView  # noqa: E402
+from tracker import Tracker  # noqa: E402
+
+FILE_ID = "sim.bin"
+WINDOW = 8  # requests each leecher keeps in flight, like Downloader
+SPEED = 2  # chunks a node uploads per tick
+
+
+class SimNode:
+    def __init__(self, node_id, num_chunks, complete=False):
+        self.node_id = node_id
+        self.chunks = Bitfield.full(num_chunks) if complete else Bitfield(num_chunks)
+        self.queue = deque()  # (leecher, chunk id) waiting to be served
+        self.in_flight = {}  # chunk id -> holder
+        self.unreported = []
+        self.view = None
+        self.done_at = None
+
+
+def simulate(gossip, num_chunks, num_leechers, summary_ticks):
+    tracker = Tracker()
+    calls = Counter()
+    seeder = SimNode("seeder", num_chunks, complete=True)
+    leechers = [SimNode(f"leecher{i}", num_chunks) for i in range(num_leechers)]
+    nodes = {node.node_id: node for node in [seeder] + leechers}
+    chunk_data = {node_id: Bitfield(num_chunks, node.chunks.bits) for node_id, node in nodes.items()}
+    tracker.initialize_chunks(FILE_ID, num_chunks, chunk_data, {})
+
+    if gossip:
+        for node in leechers:
+            calls['torrent_data'] += 1
+            node.view = SwarmView(node.chunks)
+            for node_id, encoded in tracker.encode_torrent_info(FILE_ID).items():
+                if node_id != node.node_id:
+                    node.view.set_peer(node_id, Bitfield.from_base64(num_chunks, encoded))
+
+    haves = []  # (sender, chunk id) delivered at the start of the next tick
+    messages = 0
+    tick = 0
+    while any(node.done_at is None for node in leechers):
+        tick += 1
+        for sender, chunk_id in haves:
+            for node in leechers:
+                if node is not sender and node.done_at is None:
+                    node.view.peer_has(sender.node_id, [chunk_id])
+                    messages += 1
+        haves = []
+
+        # Leechers top up their window of requests
+        for node in leechers:
+            wanted = WINDOW - len(node.in_flight)
+            if node.done_at is not None or wanted <= 0:
+                continue
+            if gossip:
+                load = Counter(node.in_flight.values())
+                schedule = node.view.schedule(wanted, node.in_flight, (), load)
+            else:
+                calls['request_chunks'] += 1
+                schedule = [entry[:2] for entry in tracker.request_chunks(node.node_id, FILE_ID, wanted, node.in_flight)]
+            for chunk_id, holder in schedule:
+                node.in_flight[chunk_id] = holder
+                nodes[holder].queue.append((node, chunk_id))
+
+        # Every node uploads as much as its speed allows
+        for holder in nodes.values():
+            for _ in range(min(SPEED, len(holder.queue))):
+                node, chunk_id = holder.queue.popleft()
+                del node.in_flight[chunk_id]
+                node.chunks[chunk_id] = 1
+                node.unreported.append(chunk_id)
+                if gossip:
+                    node.view.we_have([chunk_id])
+                    haves.append((node, chunk_id))
+
+        for node in leechers:
+            if node.done_at is None and node.chunks.all():
+                node.done_at = tick
+            due = node.done_at == tick or (tick % summary_ticks == 0 if gossip else True)
+            if node.unreported and due:
+                calls['update_chunks'] += 1
+                tracker.update_chunks(FILE_ID, node.node_id, node.unreported)
+                node.unreported = []
+
+    return tick, sum(calls.values()), calls, messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chunks', type=int, default=400)
+    parser.add_argument('--leechers', default='10,50,200')
+    parser.add_argument('--summary-ticks', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{args.chunks} chunks, every node uploads {SPEED} chunks/tick, summaries every {args.summary_ticks} ticks")
+    print(f"{'leechers':>8} {'mode':<8} {'last done':>10} {'tracker calls':>14} {'per chunk':>10} "
+          f"{'gossip msgs':>12} {'wall s':>7}")
+    for num_leechers in [int(count) for count in args.leechers.split(',')]:
+        for mode in ('tracker', 'gossip'):
+            start = time.perf_counter()
+            last, total, calls, messages = simulate(mode == 'gossip', args.chunks, num_leechers, args.summary_ticks)
+            per_chunk = total / (args.chunks * num_leechers)
+            print(f"{num_leechers:>8} {mode:<8} {last:>10} {total:>14} {per_chunk:>10.3f} {messages:>12} "
+                  f"{time.perf_counter() - start:>7.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Simulated swarm: random holder choice vs the tracker's weighted least-load choice.
+
+Usage: python benchmarks/bench_holder_selection.py [--chunks N] [--leechers N] [--ticks-per-report N]
+
+Nodes are simulated in steps ("ticks") against a real in-process Tracker. Every node
+serves the chunk requests queued on it first come first served, at its own upload speed:
+a few nodes are fast, most are slow. Leechers keep a window of requests out, ask the
+tracker for more as chunks arrive, report what they got, and periodically report their
+upload rate and queue length like Node.report_stats does.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bitfield import Bitfield  # noqa: E402
+from tracker import Tracker  # noqa: E402
+
+FILE_ID = "sim.bin"
+WINDOW = 8  # requests each leecher keeps in flight, like Downloader
+
+
+class RandomTracker(Tracker):
+    """How holders used to be picked."""
+
+    def _pick_holder(self, holders):
+        return random.choice(holders)
+
+
+class SimNode:
+    def __init__(self, node_id, speed):
+        self.node_id = node_id
+        self.speed = speed  # chunks uploaded per tick
+        self.queue = deque()  # (leecher, chunk id) waiting to be served
+        self.in_flight = set()
+        self.have = 0
+        self.served = 0
+        self.done_at = None
+
+
+def simulate(tracker_class, num_chunks, num_leechers, ticks_per_report, seed):
+    random.seed(seed)
+    tracker = tracker_class()
+    seeder = SimNode("seeder", 4)
+    leechers = [SimNode(f"leecher{i}", 16 if i % 5 == 0 else 1) for i in range(num_leechers)]
+    nodes = {node.node_id: node for node in [seeder] + leechers}
+    chunk_data = {seeder.node_id: Bitfield.full(num_chunks)}
+    chunk_data.update({node.node_id: Bitfield(num_chunks) for node in leechers})
+    tracker.initialize_chunks(FILE_ID, num_chunks, chunk_data, {})
+
+    longest_queue = 0
+    tick = 0
+    while any(node.done_at is None for node in leechers):
+        tick += 1
+        # Leechers top up their window of requests
+        for node in leechers:
+            wanted = WINDOW - len(node.in_flight)
+            if node.done_at is not None or wanted <= 0:
+                continue
+            for chunk_id, holder, _ in tracker.request_chunks(node.node_id, FILE_ID, wanted, node.in_flight):
+                node.in_flight.add(chunk_id)
+                nodes[holder].queue.append((node, chunk_id))
+        longest_queue = max(longest_queue, max(len(node.queue) for node in nodes.values()))
+
+        # Every node uploads as much as its speed allows
+        finished = []
+        for node in nodes.values():
+            for _ in range(min(node.speed, len(node.queue))):
+                finished.append(node.queue.popleft())
+                node.served += 1
+        for leecher, chunk_id in finished:
+            leecher.in_flight.discard(chunk_id)
+            tracker.update_chunks(FILE_ID, leecher.node_id, [chunk_id])
+            leecher.have += 1
+            if leecher.have == num_chunks:
+                leecher.done_at = tick
+
+        if tick % ticks_per_report == 0:
+            for node in nodes.values():
+                tracker.report_stats(node.node_id, node.served / ticks_per_report, 0, len(node.queue))
+                node.served = 0
+
+    done = sorted(node.done_at for node in leechers)
+    return tick, sum(done) / len(done), longest_queue
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chunks', type=int, default=500)
+    parser.add_argument('--leechers', type=int, default=50)
+    parser.add_argument('--ticks-per-report', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{args.chunks} chunks, {args.leechers} leechers (1 in 5 uploads 16 chunks/tick, the rest 1), "
+          f"seeder 4 chunks/tick")
+    print(f"{'policy':<12} {'last done':>10} {'mean done':>10} {'longest queue':>14} {'wall s':>7}")
+    for name, tracker_class in (("random", RandomTracker), ("least-load", Tracker)):
+        start = time.perf_counter()
+        last, mean, longest = simulate(tracker_class, args.chunks, args.leechers, args.ticks_per_report, args.seed)
+        print(f"{name:<12} {last:>10} {mean:>10.1f} {longest:>14} {time.perf_counter() - start:>7.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Cost of the hot-path instrumentation: metric updates, rendering, and per-chunk logging vs print.
+
+Usage: python benchmarks/bench_metrics.py [--calls N] [--peers N]
+
+Per-chunk work is what a Downloader does for every chunk: one histogram observation, one
+per-peer counter increment and one log line. The log line is at DEBUG, so with the default
+INFO level it is dropped before being formatted; the print it replaced is timed writing to
+/dev/null, which is a lower bound on writing to a terminal or a log file.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import metrics  # noqa: E402
+
+log = logging.getLogger('bench')
+
+
+def per_call(function, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        function(i)
+    return (time.perf_counter() - start) / calls * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=200000)
+    parser.add_argument('--peers', type=int, default=100)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    registry = metrics.Registry()
+    latency = registry.histogram('bench_seconds', "Latency")
+    peer_bytes = registry.counter('bench_bytes_total', "Bytes per peer", ('peer',))
+    peers = [(f"10.0.{i // 256}.{i % 256}",) for i in range(args.peers)]
+    devnull = open(os.devnull, 'w')
+
+    results = [
+        ("Counter.inc", per_call(lambda i: peer_bytes.inc(262144, peers[i % len(peers)]), args.calls)),
+        ("Histogram.observe", per_call(lambda i: latency.observe(i * 1e-6), args.calls)),
+        ("log.debug, level INFO", per_call(
+            lambda i: log.debug("Downloaded chunk %d of %s (%d bytes) from %s", i, 'file.bin', 262144, peers[0]),
+            args.calls)),
+        ("print to /dev/null", per_call(
+            lambda i: print(f"Successfully downloaded chunk {i} (size: {262144} bytes)", file=devnull), args.calls)),
+    ]
+    for name, ns in results:
+        print(f"{name:<24} {ns:>8.0f} ns/call")
+
+    start = time.perf_counter()
+    text = registry.render()
+    print(f"render, {args.peers} peers    {(time.perf_counter() - start) * 1e3:>8.2f} ms ({len(text)} bytes)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""GET_CHUNK requests/sec and latency of a seeding node's peer server as downloaders are added.
+
+Usage: python benchmarks/bench_peer_server.py [--clients 1,4,16,64,256] [--duration SECONDS]
+                                              [--piece-size BYTES] [--reconnect]
+
+Every downloader keeps one connection open and requests random chunks back to back,
+like Downloader does. With --reconnect each request opens a fresh connection instead,
+which is how chunks used to be fetched. More downloaders than MAX_CONNECTIONS queue in
+the listen backlog, which shows up in the tail latency.
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from compression import NONE  # noqa: E402
+from file_utils import ChunkStore  # noqa: E402
+from node import Node  # noqa: E402
+from protocol import GET_CHUNK, send_frame, recv_chunk_frames, encode_get_chunk  # noqa: E402
+from torrent import Torrent  # noqa: E402
+
+FILE_SIZE = 64 << 20
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_listener(port):
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+
+def connect(port):
+    sock = socket.create_connection(('127.0.0.1', port), timeout=60)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def downloader(port, sink, deadline, reconnect, latencies):
+    rng = random.Random()
+    sock = None
+    try:
+        while time.perf_counter() < deadline:
+            chunk_id = rng.randrange(sink.num_chunks)
+            start = time.perf_counter()
+            if sock is None:
+                sock = connect(port)
+            send_frame(sock, GET_CHUNK, chunk_id, encode_get_chunk('bench.bin', NONE))
+            recv_chunk_frames(sock, sink, chunk_id)
+            if reconnect:
+                sock.close()
+                sock = None
+            latencies.append(time.perf_counter() - start)
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+def run(port, sink_path, seeder, clients, duration, reconnect):
+    sinks = [ChunkStore.create(f"{sink_path}.{i}", seeder.file_size, seeder.piece_size, seeder.block_size)
+             for i in range(clients)]
+    results = [[] for _ in range(clients)]
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=downloader, args=(port, sinks[i], deadline, reconnect, results[i]))
+               for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    for i, sink in enumerate(sinks):
+        sink.close()
+        os.remove(f"{sink_path}.{i}")
+
+    latencies = sorted(latency for result in results for latency in result)
+    if not latencies:
+        return 0, 0, 0
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return len(latencies) / elapsed, p50, p99
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', default='1,4,16,64,256')
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--piece-size', type=int, default=64 * 1024)
+    parser.add_argument('--reconnect', action='store_true', help="open a new connection for every request")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    path = os.path.join(workdir, 'bench.bin')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(FILE_SIZE))
+
+    port = free_port()
+    node = Node(port)  # registering fails without a tracker, the peer server runs regardless
+    store = ChunkStore.open(path, args.piece_size)
+    node.add_torrent(Torrent('bench.bin', store, complete=True))
+    wait_for_listener(port)
+
+    mode = "new connection per request" if args.reconnect else "persistent connections"
+    print(f"{store.num_chunks} chunks of {args.piece_size} bytes, {mode}")
+    print(f"{'downloaders':>12} {'req/s':>10} {'MB/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for clients in [int(c) for c in args.clients.split(',')]:
+        rate, p50, p99 = run(port, os.path.join(workdir, 'sink'), store, clients, args.duration, args.reconnect)
+        print(f"{clients:>12} {rate:>10.0f} {rate * args.piece_size / 1e6:>9.1f} {p50 * 1e3:>9.2f} {p99 * 1e3:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
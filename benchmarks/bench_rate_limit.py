@@ -0,0 +1,160 @@
+"""Upload rate limiting: throughput against the cap, fairness between flows, and CPU cost.
+
+Usage: python benchmarks/bench_rate_limit.py [--caps 0,20e6,100e6] [--pushes N] [--pulls N] [--duration SECONDS]
+
+One seeding node uploads over loopback through both of its upload paths at once: pushes
+to other nodes (ChunkSender) and chunks served to downloaders asking for them (GET_CHUNK).
+All of them share the node's upload limit. For every cap the total rate, the slowest and
+fastest flow's share of it (1/flows each when fair) and the CPU the whole process used
+(senders and receivers), in % of one core, are given. The last run halves the cap halfway
+through, to show a limit changed at runtime taking effect on transfers already under way.
+The cost of throttle() itself, called once per block, is measured on its own first.
+"""
+import argparse
+import os
+import queue
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from compression import NONE  # noqa: E402
+from file_utils import ChunkStore  # noqa: E402
+from node import ChunkSender, Node  # noqa: E402
+from protocol import GET_CHUNK, send_frame, recv_chunk_frames, encode_get_chunk  # noqa: E402
+from ratelimit import RateLimiter, UPLOAD  # noqa: E402
+from torrent import Torrent  # noqa: E402
+
+FILE_SIZE = 64 << 20
+FILE_ID = 'bench.bin'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_listener(port):
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+
+class Puller(threading.Thread):
+    """Requests random chunks from the seeder back to back over one connection, like Downloader."""
+
+    def __init__(self, port, sink, stop):
+        super().__init__()
+        self.port = port
+        self.sink = sink
+        self.stop = stop
+        self.sent_bytes = 0
+
+    def run(self):
+        with socket.create_connection(('127.0.0.1', self.port), timeout=60) as sock:
+            while not self.stop.is_set():
+                chunk_id = random.randrange(self.sink.num_chunks)
+                send_frame(sock, GET_CHUNK, chunk_id, encode_get_chunk(FILE_ID, NONE))
+                recv_chunk_frames(sock, self.sink, chunk_id)
+                self.sent_bytes += self.sink.chunk_range(chunk_id)[1]
+
+
+def throttle_cost(limiter, calls=200000):
+    throttle = limiter.throttler(UPLOAD, FILE_ID, '127.0.0.1')
+    start = time.perf_counter()
+    for _ in range(calls):
+        throttle(1)
+    return (time.perf_counter() - start) / calls
+
+
+def run(seeder, store, receivers, sinks, cap, duration, halve):
+    seeder.set_rate_limit(UPLOAD, cap)
+    stop = threading.Event()
+    queues = [queue.Queue() for _ in receivers]
+    for chunks in queues:
+        for _ in range(1000):
+            for chunk_id in range(store.num_chunks):
+                chunks.put(chunk_id)
+    flows = [ChunkSender('127.0.0.1', port, store, chunks, f"push{i}.bin",
+                         throttle=seeder.limiter.throttler(UPLOAD, FILE_ID, '127.0.0.1'))
+             for i, (port, chunks) in enumerate(zip(receivers, queues))]
+    flows += [Puller(seeder.port, sink, stop) for sink in sinks]
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for flow in flows:
+        flow.start()
+    time.sleep(duration / 2)
+    half = sum(flow.sent_bytes for flow in flows)
+    if halve:
+        seeder.set_rate_limit(UPLOAD, cap // 2)
+    time.sleep(duration / 2)
+    before = [flow.sent_bytes for flow in flows]
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for chunks in queues:
+        while not chunks.empty():
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                break
+    for flow in flows:
+        flow.join()
+    cpu = time.process_time() - cpu
+    total = sum(before)
+    return total / elapsed, half / (elapsed / 2), (total - half) / (elapsed / 2), \
+        min(before) / total, max(before) / total, 100 * cpu / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--caps', default='0,20e6,100e6')
+    parser.add_argument('--pushes', type=int, default=2)
+    parser.add_argument('--pulls', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=4)
+    args = parser.parse_args()
+    caps = [int(float(cap)) for cap in args.caps.split(',')]
+
+    # The receiving nodes write their chunks under ./received_files
+    os.chdir(tempfile.mkdtemp())
+    with open(FILE_ID, 'wb') as f:
+        f.write(os.urandom(FILE_SIZE))
+    store = ChunkStore.open(FILE_ID)
+    seeder = Node(free_port())
+    seeder.add_torrent(Torrent(FILE_ID, store, complete=True))
+    receivers = [free_port() for _ in range(args.pushes)]
+    for port in receivers:
+        Node(port)
+    for port in [seeder.port] + receivers:
+        wait_for_listener(port)
+    sinks = [ChunkStore.create(f"sink{i}", store.file_size, store.piece_size, store.block_size)
+             for i in range(args.pulls)]
+
+    limited = RateLimiter(upload_rate=10 ** 12)
+    limited.set_limit(UPLOAD, 10 ** 12, peer='127.0.0.1')
+    print(f"throttle() per block: {throttle_cost(RateLimiter()) * 1e9:.0f} ns with no limits, "
+          f"{throttle_cost(limited) * 1e9:.0f} ns with node and peer limits")
+    flows = args.pushes + args.pulls
+    print(f"{args.pushes} pushes + {args.pulls} served downloaders, fair share {1 / flows:.2f} each")
+    print(f"{'cap MB/s':>9} {'total MB/s':>11} {'of cap':>7} {'min share':>10} {'max share':>10} {'CPU %':>6}")
+    for cap in caps:
+        rate, _, _, low, high, cpu = run(seeder, store, receivers, sinks, cap, args.duration, False)
+        of_cap = f"{rate / cap:.2f}" if cap else '-'
+        print(f"{cap / 1e6 if cap else 'none':>9} {rate / 1e6:>11.1f} {of_cap:>7} {low:>10.2f} {high:>10.2f} "
+              f"{cpu:>6.0f}")
+
+    cap = max(caps)
+    _, first, second, _, _, _ = run(seeder, store, receivers, sinks, cap, args.duration, True)
+    print(f"cap {cap / 1e6:.0f} MB/s, halved at runtime: {first / 1e6:.1f} MB/s before, {second / 1e6:.1f} MB/s after")
+
+
+if __name__ == '__main__':
+    main()
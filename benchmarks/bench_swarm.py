@@ -0,0 +1,350 @@
+"""End-to-end swarm run: the tracker plus N nodes in one process on loopback, with shaped links and churn.
+
+Usage: python benchmarks/bench_swarm.py [--size BYTES] [--peers N] [--latency MS] [--bandwidth BYTES/S]
+                                        [--slow N] [--slow-bandwidth BYTES/S] [--no-endgame]
+                                        [--churn N] [--churn-at SECONDS] [--churn-for SECONDS]
+                                        [--timeout SECONDS] [--json PATH]
+
+The Flask tracker is served on a free port and the nodes are pointed at it. One node uploads
+a random file to the other --peers nodes, which then download what they are missing from
+each other. Time is counted from the start of the upload.
+
+Every node sits behind a LinkProxy that stands for its network link. All connections made
+to the node go through it, so every transfer is shaped once, by the link of the node it was
+made to. The proxy delays each direction by --latency and caps it at --bandwidth, or at
+--slow-bandwidth for --slow random downloaders, to see how much they hold the others back
+(with or without endgame requests, see downloader.py). Churn takes
+the links of --churn random downloaders down at --churn-at: their connections are reset and
+new ones are refused. With --churn-for they come back after that long. Without latency,
+bandwidth or churn, nodes are reached directly, and CPU per byte is the nodes' and tracker's own.
+
+The report gives:
+- the upload call time;
+- each downloader's completion time and throughput;
+- tracker QPS and mean latency per route, from the tracker's own metrics;
+- process CPU per downloaded byte.
+--json writes the same numbers, so runs can be compared for regressions.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import downloader  # noqa: E402
+import node as node_module  # noqa: E402
+import tracker as tracker_module  # noqa: E402
+from ratelimit import TokenBucket  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+FILE_ID = 'swarm.bin'
+RELAY_CHUNK = 64 * 1024  # bytes a proxy reads at a time
+RELAY_BUFFERS = 64  # reads a proxy holds per direction, so a slow link pushes back on the sender
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_listener(port):
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+
+def close_quietly(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+class ProxiedConnection:
+    """Both sockets of one connection through a proxy, closed once both directions are done."""
+
+    def __init__(self, proxy, client, server):
+        self.proxy = proxy
+        self.sockets = (client, server)
+        self.finished = 0
+        self.lock = threading.Lock()
+
+    def finish(self):
+        with self.lock:
+            self.finished += 1
+            if self.finished < 2:
+                return
+        for sock in self.sockets:
+            sock.close()
+        self.proxy.forget(self)
+
+    def reset(self):
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class LinkProxy:
+    """Stands in front of one node's peer server as its network link.
+
+    Data is held back for `latency` seconds in each direction, and each direction is capped at
+    `bandwidth` bytes/s (0 for unlimited) across all of the node's connections.
+    """
+
+    def __init__(self, port, target_port, latency=0, bandwidth=0):
+        self.port = port
+        self.target_port = target_port
+        self.latency = latency
+        self.up = TokenBucket(bandwidth)  # data the node sends
+        self.down = TokenBucket(bandwidth)  # data sent to the node
+        self.listener = None
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.set_online(True)
+
+    def set_online(self, online):
+        with self.lock:
+            if online and self.listener is None:
+                listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                listener.bind(('127.0.0.1', self.port))
+                listener.listen(128)
+                self.listener = listener
+                threading.Thread(target=self.accept, args=(listener,), daemon=True).start()
+            elif not online and self.listener is not None:
+                close_quietly(self.listener)
+                self.listener = None
+                for connection in self.connections:
+                    connection.reset()
+
+    def forget(self, connection):
+        with self.lock:
+            self.connections.discard(connection)
+
+    def accept(self, listener):
+        while True:
+            try:
+                client, _ = listener.accept()
+            except OSError:
+                return
+            try:
+                server = socket.create_connection(('127.0.0.1', self.target_port))
+            except OSError:
+                client.close()
+                continue
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = ProxiedConnection(self, client, server)
+            with self.lock:
+                self.connections.add(connection)
+            self.relay(connection, client, server, self.down)
+            self.relay(connection, server, client, self.up)
+
+    def relay(self, connection, src, dst, bucket):
+        pending = queue.Queue(maxsize=RELAY_BUFFERS)
+        threading.Thread(target=self.read, args=(src, pending), daemon=True).start()
+        threading.Thread(target=self.write, args=(connection, dst, pending, bucket), daemon=True).start()
+
+    def read(self, src, pending):
+        while True:
+            try:
+                data = src.recv(RELAY_CHUNK)
+            except OSError:
+                data = b''
+            pending.put((time.monotonic() + self.latency, data))
+            if not data:
+                return
+
+    def write(self, connection, dst, pending, bucket):
+        failed = False
+        while True:
+            due, data = pending.get()
+            if not data:
+                break
+            if failed:
+                continue  # keep draining, so the reader never blocks on a full queue
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            wait = bucket.reserve(len(data))
+            if wait:
+                time.sleep(wait)
+            try:
+                dst.sendall(data)
+            except OSError:
+                failed = True
+                connection.reset()
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        connection.finish()
+
+
+class Swarm:
+    """The tracker and `peers + 1` nodes, the first of which uploads."""
+
+    def __init__(self, peers, latency=0, bandwidth=0, shaped=False, slow=0, slow_bandwidth=0):
+        tracker_port = free_port()
+        self.tracker_server = make_server('127.0.0.1', tracker_port, tracker_module.app, threaded=True)
+        threading.Thread(target=self.tracker_server.serve_forever, daemon=True).start()
+        node_module.BASEURL = f"http://127.0.0.1:{tracker_port}"
+        node_module.METRICS_PORT = None
+
+        self.nodes = []
+        self.proxies = {}  # node port -> LinkProxy
+        slow_nodes = set(random.sample(range(1, peers + 1), min(slow, peers)))
+        for i in range(peers + 1):
+            port = free_port()
+            if shaped:
+                listen_port = free_port()
+                link = slow_bandwidth if i in slow_nodes else bandwidth
+                self.proxies[port] = LinkProxy(port, listen_port, latency, link)
+                self.nodes.append(node_module.Node(port, listen_port))
+            else:
+                self.nodes.append(node_module.Node(port))
+        for peer in self.nodes:
+            wait_for_listener(peer.port)
+        time.sleep(0.5)  # let every node register before the upload asks for peers
+
+    def set_online(self, peer, online):
+        self.proxies[peer.port].set_online(online)
+
+    def output_path(self, peer):
+        return os.path.join('received_files', FILE_ID + str(peer.port))
+
+
+def request_stats():
+    """(requests, seconds spent) per tracker route, from the tracker's metrics."""
+    stats = {}
+    for (route, _), count in list(tracker_module.requests_total.values.items()):
+        stats.setdefault(route, [0, 0.0])[0] += count
+    for (route,), (_, total) in list(tracker_module.request_seconds.values.items()):
+        stats.setdefault(route, [0, 0.0])[1] = total
+    return stats
+
+
+def run(args):
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs('received_files')
+    with open(FILE_ID, 'wb') as f:
+        f.write(os.urandom(args.size))
+    if args.no_endgame:
+        downloader.ENDGAME_CHUNKS = 0
+    shaped = bool(args.latency or args.bandwidth or args.churn or args.slow)
+    swarm = Swarm(args.peers, args.latency / 1000, args.bandwidth, shaped, args.slow, args.slow_bandwidth)
+    uploader, downloaders = swarm.nodes[0], swarm.nodes[1:]
+
+    if args.churn:
+        churned = random.sample(downloaders, min(args.churn, len(downloaders)))
+
+        def churn():
+            time.sleep(args.churn_at)
+            for peer in churned:
+                swarm.set_online(peer, False)
+            if args.churn_for:
+                time.sleep(args.churn_for)
+                for peer in churned:
+                    swarm.set_online(peer, True)
+        threading.Thread(target=churn, daemon=True).start()
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    uploader.upload(FILE_ID)
+    upload_seconds = time.perf_counter() - start
+    done = {}
+    while len(done) < len(downloaders) and time.perf_counter() - start < args.timeout:
+        for peer in downloaders:
+            if peer.port not in done and os.path.exists(swarm.output_path(peer)):
+                done[peer.port] = time.perf_counter() - start
+        time.sleep(0.02)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+
+    received = args.size * len(done)
+    return {
+        "size": args.size,
+        "peers": args.peers,
+        "latency_ms": args.latency,
+        "bandwidth": args.bandwidth,
+        "churn": args.churn,
+        "slow": args.slow,
+        "endgame": not args.no_endgame,
+        "upload_seconds": upload_seconds,
+        "completed": len(done),
+        "last_done_seconds": max(done.values()) if len(done) == len(downloaders) else None,
+        "nodes": [{"port": peer.port, "done_seconds": done.get(peer.port),
+                   "mb_per_s": args.size / done[peer.port] / 1e6 if peer.port in done else None,
+                   "downloaded_bytes": peer.total_downloaded_bytes, "uploaded_bytes": peer.total_uploaded_bytes}
+                  for peer in downloaders],
+        "uploader_uploaded_bytes": uploader.total_uploaded_bytes,
+        "tracker": {route: {"requests": count, "qps": count / elapsed, "mean_ms": total / count * 1e3 if count else 0}
+                    for route, (count, total) in request_stats().items()},
+        "tracker_qps": sum(count for count, _ in request_stats().values()) / elapsed,
+        "cpu_ns_per_byte": cpu / received * 1e9 if received else None,
+    }
+
+
+def report(result):
+    print(f"{result['size']} bytes to {result['peers']} peers, latency {result['latency_ms']} ms, "
+          f"bandwidth {result['bandwidth'] or 'unlimited'} B/s per link, {result['slow']} slow, "
+          f"churn {result['churn']}, endgame {'on' if result['endgame'] else 'off'}")
+    print(f"upload() returned after {result['upload_seconds']:.2f}s, "
+          f"{result['completed']}/{result['peers']} downloads complete, "
+          f"last at {result['last_done_seconds'] if result['last_done_seconds'] is None else round(result['last_done_seconds'], 2)}s")
+    print(f"{'node':>6} {'done s':>8} {'MB/s':>7} {'down MB':>8} {'up MB':>7}")
+    for entry in result["nodes"]:
+        done = f"{entry['done_seconds']:.2f}" if entry['done_seconds'] is not None else '-'
+        rate = f"{entry['mb_per_s']:.1f}" if entry['mb_per_s'] is not None else '-'
+        print(f"{entry['port']:>6} {done:>8} {rate:>7} {entry['downloaded_bytes'] / 1e6:>8.1f} "
+              f"{entry['uploaded_bytes'] / 1e6:>7.1f}")
+    print(f"tracker: {result['tracker_qps']:.1f} requests/s")
+    for route, stats in sorted(result["tracker"].items()):
+        print(f"  {route:<20} {stats['requests']:>6} requests {stats['qps']:>7.1f}/s {stats['mean_ms']:>7.2f} ms mean")
+    if result["cpu_ns_per_byte"] is not None:
+        print(f"CPU: {result['cpu_ns_per_byte']:.2f} ns per downloaded byte (whole process)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=32 << 20)
+    parser.add_argument('--peers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0, help="one-way delay per link, ms")
+    parser.add_argument('--bandwidth', type=int, default=0, help="bytes/s per link and direction, 0 for unlimited")
+    parser.add_argument('--slow', type=int, default=0, help="downloaders on a slower link")
+    parser.add_argument('--slow-bandwidth', type=int, default=1 << 20, help="bytes/s of their links")
+    parser.add_argument('--no-endgame', action='store_true', help="never send duplicate requests for the last chunks")
+    parser.add_argument('--churn', type=int, default=0, help="downloaders whose link goes down")
+    parser.add_argument('--churn-at', type=float, default=1)
+    parser.add_argument('--churn-for', type=float, default=0, help="seconds until they come back, 0 for never")
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    result = run(args)
+    report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Latency of Tracker.request_chunk as the number of chunks grows, vs the old linear scan.
+
+Usage: python benchmarks/bench_tracker.py [--chunks N ...] [--peers N] [--requests N]
+
+Each round simulates a swarm: an uploader holding every chunk, peers that were
+pushed contiguous blocks, and one downloader that repeatedly requests a chunk
+and reports it, so the rarity index is kept up to date between requests.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bitfield import Bitfield  # noqa: E402
+from tracker import Tracker  # noqa: E402
+
+
+def linear_request_chunk(tracker, node_id, file_id):
+    """The original full scan over every chunk of the file."""
+    request_id = ""
+    rarest_freq = float('inf')
+    rarest_chunk = -1
+    for chunk_id, freq in enumerate(tracker.chunk_freq[file_id]):
+        if (0 < freq < rarest_freq and tracker.torrents[file_id][node_id][chunk_id] == 0):
+            rarest_freq = freq
+            request_id = random.choice(tracker.chunk_holders[file_id][chunk_id])
+            rarest_chunk = chunk_id
+    return (rarest_chunk, request_id)
+
+
+def build_tracker(num_chunks, num_peers):
+    tracker = Tracker()
+    chunk_data = {"seeder:1": Bitfield.full(num_chunks)}
+    block = -(-num_chunks // num_peers)
+    for i in range(num_peers):
+        chunks = Bitfield(num_chunks)
+        for j in range(i * block, min(num_chunks, (i + 1) * block)):
+            chunks[j] = 1
+        chunk_data[f"peer:{i}"] = chunks
+    tracker.initialize_chunks("bench", num_chunks, chunk_data)
+    return tracker
+
+
+def time_requests(tracker, request, num_requests):
+    start = time.perf_counter()
+    for _ in range(num_requests):
+        chunk_id, _ = request(tracker, "peer:0", "bench")
+        if chunk_id == -1:
+            break
+        tracker.update_chunk("bench", "peer:0", chunk_id)
+    return (time.perf_counter() - start) / num_requests
+
+
+def indexed_request_chunk(tracker, node_id, file_id):
+    return tracker.request_chunk(node_id, file_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chunks', type=int, nargs='+', default=[10 ** 4, 10 ** 5, 10 ** 6])
+    parser.add_argument('--peers', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--linear-requests', type=int, default=20,
+                        help="requests to time with the linear scan, which is slow on large files")
+    args = parser.parse_args()
+
+    print(f"{'chunks':>10} {'indexed':>12} {'linear scan':>12}")
+    for num_chunks in args.chunks:
+        indexed = time_requests(build_tracker(num_chunks, args.peers), indexed_request_chunk, args.requests)
+        linear = time_requests(build_tracker(num_chunks, args.peers), linear_request_chunk, args.linear_requests)
+        print(f"{num_chunks:>10} {indexed * 1e6:>10.1f}us {linear * 1e6:>10.1f}us")
+
+
+if __name__ == '__main__':
+    main()
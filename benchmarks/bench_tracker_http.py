@@ -0,0 +1,118 @@
+"""Tracker requests/second: Flask with a new connection per call (the old Node behaviour),
+Flask with keep-alive sessions, and the ASGI app under uvicorn with keep-alive sessions.
+
+Usage: python benchmarks/bench_tracker_http.py [--peers N] [--requests N] [--chunks N]
+
+Each server runs in its own process. Every simulated peer is a thread that asks
+for a chunk and reports it, over and over.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+
+from bitfield import Bitfield  # noqa: E402
+
+FILE_ID = "http"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_flask(port):
+    code = f"import logging, tracker; logging.getLogger('werkzeug').setLevel(logging.ERROR); " \
+           f"tracker.app.run(host='127.0.0.1', port={port}, threaded=True)"
+    return subprocess.Popen([sys.executable, '-c', code], cwd=REPO,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def start_asgi(port):
+    return subprocess.Popen([sys.executable, '-m', 'uvicorn', 'tracker_asgi:app', '--host', '127.0.0.1',
+                             '--port', str(port), '--log-level', 'warning'], cwd=REPO,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_up(base_url):
+    for _ in range(100):
+        try:
+            requests.get(base_url + '/peers', json={"port": 0})
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise Exception(f"Tracker at {base_url} did not come up")
+
+
+def initialize(base_url, peer_ports, num_chunks):
+    chunk_data = {f"127.0.0.1:{port}": Bitfield(num_chunks).to_base64() for port in peer_ports}
+    chunk_data["seeder:1"] = Bitfield.full(num_chunks).to_base64()
+    response = requests.post(base_url + '/initialize_chunks',
+                             json={"file_id": FILE_ID, "file_size": num_chunks, "chunk_data": chunk_data})
+    response.raise_for_status()
+
+
+def simulated_peer(base_url, port, num_requests, use_session, counter):
+    client = requests.Session() if use_session else requests
+    done = 0
+    for _ in range(num_requests):
+        response = client.get(base_url + '/request_chunk', json={"file_id": FILE_ID, "port": port})
+        chunk_id = response.json()["chunk_id"]
+        done += 1
+        if chunk_id == -1:
+            break
+        client.post(base_url + '/update_chunk', json={"file_id": FILE_ID, "port": port, "chunk_id": chunk_id})
+        done += 1
+    counter.append(done)
+
+
+def run(name, start_server, use_session, args):
+    port = free_port()
+    server = start_server(port)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_up(base_url)
+        peer_ports = [20000 + i for i in range(args.peers)]
+        initialize(base_url, peer_ports, args.chunks)
+        counter = []
+        threads = [threading.Thread(target=simulated_peer, args=(base_url, p, args.requests, use_session, counter))
+                   for p in peer_ports]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<28} {sum(counter) / elapsed:8.0f} req/s")
+    finally:
+        server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--peers', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=50, help="request/update pairs per peer")
+    parser.add_argument('--chunks', type=int, default=4096)
+    args = parser.parse_args()
+
+    run("flask, connection per call", start_flask, False, args)
+    run("flask, keep-alive session", start_flask, True, args)
+    try:
+        import uvicorn  # noqa: F401
+    except ImportError:
+        print("uvicorn is not installed, skipping the ASGI tracker")
+        return
+    run("asgi, keep-alive session", start_asgi, True, args)
+
+
+if __name__ == '__main__':
+    main()
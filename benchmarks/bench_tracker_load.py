@@ -0,0 +1,120 @@
+"""Hammers a live tracker with /request_chunk and /update_chunk from many simulated peers.
+
+Usage: python benchmarks/bench_tracker_load.py [--peers N] [--chunks N] [--requests N]
+
+Every simulated peer runs in its own thread with its own keep-alive HTTP session,
+repeatedly asking for a chunk and reporting it, like a downloader would. At the
+end the tracker's frequency counts, holder lists and rarity index are checked
+against the bitfields, which catches lost updates.
+"""
+import argparse
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tracker as tracker_module  # noqa: E402
+from bitfield import Bitfield  # noqa: E402
+
+FILE_ID = "load"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def check_consistency(tracker, file_id):
+    """Returns a list of problems; empty when all of the tracker's views of the file agree."""
+    problems = []
+    torrents = tracker.torrents[file_id]
+    for chunk_id in range(len(tracker.chunk_freq[file_id])):
+        holders = [node_id for node_id, chunks in torrents.items() if chunks[chunk_id]]
+        if tracker.chunk_freq[file_id][chunk_id] != len(holders):
+            problems.append(f"chunk {chunk_id}: freq {tracker.chunk_freq[file_id][chunk_id]}, {len(holders)} holders")
+        if sorted(tracker.chunk_holders[file_id][chunk_id]) != sorted(holders):
+            problems.append(f"chunk {chunk_id}: holder list out of sync")
+    for node_id, buckets in tracker.missing[file_id].items():
+        indexed = {chunk_id: freq for freq, bucket in buckets.items() for chunk_id in bucket.items}
+        missing = set(torrents[node_id].missing())
+        if set(indexed) != missing:
+            problems.append(f"{node_id}: rarity index has {len(indexed)} chunks, bitfield misses {len(missing)}")
+        for chunk_id, freq in indexed.items():
+            if freq != tracker.chunk_freq[file_id][chunk_id]:
+                problems.append(f"{node_id}: chunk {chunk_id} in bucket {freq}, freq is {tracker.chunk_freq[file_id][chunk_id]}")
+    return problems
+
+
+def simulated_peer(base_url, port, num_requests, latencies, errors):
+    session = requests.Session()
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        try:
+            response = session.get(base_url + '/request_chunk', json={"file_id": FILE_ID, "port": port})
+            response.raise_for_status()
+            chunk_id = response.json()["chunk_id"]
+            latencies.append(time.perf_counter() - start)
+            if chunk_id == -1:
+                return
+            start = time.perf_counter()
+            response = session.post(base_url + '/update_chunk',
+                                    json={"file_id": FILE_ID, "port": port, "chunk_id": chunk_id})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except requests.RequestException as e:
+            errors.append(e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--peers', type=int, default=200)
+    parser.add_argument('--chunks', type=int, default=4096)
+    parser.add_argument('--requests', type=int, default=50, help="request/update pairs per peer")
+    args = parser.parse_args()
+
+    tracker = tracker_module.tracker
+    peer_ports = [20000 + i for i in range(args.peers)]
+    chunk_data = {"seeder:1": Bitfield.full(args.chunks)}
+    for port in peer_ports:
+        chunk_data[tracker_module.get_node_id('127.0.0.1', port)] = Bitfield(args.chunks)
+    tracker.initialize_chunks(FILE_ID, args.chunks, chunk_data)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    port = free_port()
+    server = make_server('127.0.0.1', port, tracker_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{port}"
+
+    latencies, errors = [], []
+    threads = [threading.Thread(target=simulated_peer, args=(base_url, p, args.requests, latencies, errors))
+               for p in peer_ports]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    latencies.sort()
+    print(f"{args.peers} peers, {len(latencies)} requests in {elapsed:.2f} s: {len(latencies) / elapsed:.0f} req/s")
+    if latencies:
+        print(f"p50 {latencies[len(latencies) // 2] * 1e3:.1f} ms, p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.1f} ms")
+    print(f"{len(errors)} failed requests")
+    problems = check_consistency(tracker, FILE_ID)
+    print("consistency: " + ("ok" if not problems else f"{len(problems)} problems"))
+    for problem in problems[:10]:
+        print("  " + problem)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
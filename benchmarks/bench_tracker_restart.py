@@ -0,0 +1,93 @@
+"""Tracker restart time against state size: replaying the write-ahead log vs loading a snapshot.
+
+Usage: python benchmarks/bench_tracker_restart.py [--chunks N ...] [--files N] [--peers N] [--batch N]
+
+For every size, a journaled Tracker is filled the way a swarm fills it: each file is
+initialized with an uploader holding every chunk, then every peer reports half of the chunks
+in batches of --batch, like downloaders do. Chunk records are the (node, chunk) pairs the
+tracker ends up knowing about. Then a fresh Tracker is restored from the log alone, a snapshot
+is written, and another fresh Tracker is restored from the snapshot, and each is timed.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bitfield import Bitfield  # noqa: E402
+from journal import Journal, SNAPSHOT_NAME, WAL_NAME  # noqa: E402
+from tracker import Tracker  # noqa: E402
+
+
+def fill(tracker, files, num_chunks, peers, batch):
+    peer_ids = [f"10.0.0.{i}:5000" for i in range(peers)]
+    for node_id in ["10.0.1.1:5000"] + peer_ids:
+        tracker.register_peer(node_id)
+    records = 0
+    for f in range(files):
+        file_id = f"file{f}.bin"
+        chunk_data = {"10.0.1.1:5000": Bitfield.full(num_chunks)}
+        chunk_data.update((node_id, Bitfield(num_chunks)) for node_id in peer_ids)
+        tracker.initialize_chunks(file_id, num_chunks, chunk_data, {"piece_size": 262144, "block_size": 16384})
+        records += num_chunks
+        for node_id in peer_ids:
+            chunk_ids = random.sample(range(num_chunks), num_chunks // 2)
+            for i in range(0, len(chunk_ids), batch):
+                tracker.update_chunks(file_id, node_id, chunk_ids[i:i + batch])
+            records += len(chunk_ids)
+    return records
+
+
+def restore(directory):
+    start = time.perf_counter()
+    tracker = Tracker()
+    journal = Journal(directory, snapshot_bytes=float('inf'))
+    journal.open(tracker)
+    elapsed = time.perf_counter() - start
+    return tracker, journal, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chunks', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--peers', type=int, default=8)
+    parser.add_argument('--batch', type=int, default=32)
+    args = parser.parse_args()
+
+    print(f"{args.files} files, an uploader and {args.peers} peers each, reports of {args.batch} chunks")
+    print(f"{'chunks/file':>11} {'records':>9} {'log MB':>7} {'replay s':>9} {'snapshot s':>11} {'snap MB':>8} "
+          f"{'load s':>7}")
+    for num_chunks in args.chunks:
+        directory = tempfile.mkdtemp()
+        try:
+            tracker = Tracker()
+            journal = Journal(directory, snapshot_bytes=float('inf'))
+            journal.open(tracker)
+            records = fill(tracker, args.files, num_chunks, args.peers, args.batch)
+            journal.close()
+            log_size = os.path.getsize(os.path.join(directory, WAL_NAME))
+
+            replayed, journal, replay_seconds = restore(directory)
+            assert replayed.chunk_freq == tracker.chunk_freq
+            start = time.perf_counter()
+            journal.snapshot()
+            snapshot_seconds = time.perf_counter() - start
+            journal.close()
+            snapshot_size = os.path.getsize(os.path.join(directory, SNAPSHOT_NAME))
+
+            loaded, journal, load_seconds = restore(directory)
+            assert loaded.chunk_freq == tracker.chunk_freq
+            journal.close()
+        finally:
+            shutil.rmtree(directory)
+        print(f"{num_chunks:>11} {records:>9} {log_size / 1e6:>7.1f} {replay_seconds:>9.2f} {snapshot_seconds:>11.2f} "
+              f"{snapshot_size / 1e6:>8.2f} {load_seconds:>7.2f}")
+
+
+if __name__ == '__main__':
+    main()
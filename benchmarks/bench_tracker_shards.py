@@ -0,0 +1,149 @@
+"""Tracker throughput against the number of shards, with files split between them by consistent hashing.
+
+Usage: python benchmarks/bench_tracker_shards.py [--shards N ...] [--files N] [--chunks N] [--peers N]
+                                                 [--clients N] [--threads N] [--duration SECONDS]
+
+For every shard count, that many tracker.py processes are started on loopback and --files files
+are initialized on the shards the ring puts them on, each with a seeder and --peers peers. Every
+peer is registered with all shards, as nodes do. Then --clients processes of --threads threads
+each route /request_chunks and /update_chunks pairs for random files and peers to the files'
+shards, like downloaders, and the requests served per second are counted. Each shard is a
+separate process, so throughput can only scale with shard count up to the machine's cores,
+shared with the clients; the core count is printed with the results.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bitfield import Bitfield  # noqa: E402
+from ring import HashRing  # noqa: E402
+
+TRACKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tracker.py')
+PEER_BASE_PORT = 30000
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_listener(port):
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+
+def start_shards(count):
+    processes, urls = [], []
+    for _ in range(count):
+        port = free_port()
+        env = dict(os.environ, TRACKER_PORT=str(port))
+        env.pop('TRACKER_STATE_DIR', None)
+        processes.append(subprocess.Popen([sys.executable, TRACKER], env=env,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        urls.append(f"http://127.0.0.1:{port}")
+    for url in urls:
+        wait_for_listener(int(url.rsplit(':', 1)[1]))
+    return processes, urls
+
+
+def setup(ring, files, num_chunks, peers):
+    session = requests.Session()
+    for i in range(peers):
+        for url in ring.shards:
+            session.post(url + '/register', json={"port": PEER_BASE_PORT + i}).raise_for_status()
+    empty = Bitfield(num_chunks).to_base64()
+    chunk_data = {f"127.0.0.1:{PEER_BASE_PORT + i}": empty for i in range(peers)}
+    chunk_data["seeder:1"] = Bitfield.full(num_chunks).to_base64()
+    for f in range(files):
+        file_id = f"file{f}.bin"
+        session.post(ring.shard_for(file_id) + '/initialize_chunks', json={
+            "file_id": file_id, "file_size": num_chunks, "chunk_data": chunk_data,
+            "piece_size": 262144, "block_size": 16384}).raise_for_status()
+
+
+def client(urls, files, peers, threads, deadline, results):
+    import threading
+    ring = HashRing(urls)
+    counts = []
+
+    def worker():
+        session = requests.Session()
+        count = 0
+        while time.time() < deadline:
+            file_id = f"file{random.randrange(files)}.bin"
+            port = PEER_BASE_PORT + random.randrange(peers)
+            url = ring.shard_for(file_id)
+            response = session.get(url + '/request_chunks', json={"file_id": file_id, "port": port, "count": 8})
+            chunk_ids = [entry["chunk_id"] for entry in response.json()["schedule"]]
+            session.post(url + '/update_chunks', json={"file_id": file_id, "port": port, "chunk_ids": chunk_ids})
+            count += 2
+        counts.append(count)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    results.put(sum(counts))
+
+
+def run(shards, args):
+    processes, urls = start_shards(shards)
+    try:
+        ring = HashRing(urls)
+        setup(ring, args.files, args.chunks, args.peers)
+        results = multiprocessing.Queue()
+        deadline = time.time() + 1 + args.duration
+        clients = [multiprocessing.Process(target=client, args=(urls, args.files, args.peers, args.threads,
+                                                                 deadline, results))
+                   for _ in range(args.clients)]
+        for process in clients:
+            process.start()
+        total = sum(results.get() for _ in clients)
+        for process in clients:
+            process.join()
+        files_per_shard = [sum(ring.shard_for(f"file{f}.bin") == url for f in range(args.files)) for url in urls]
+        return total / (args.duration + 1), files_per_shard
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--files', type=int, default=64)
+    parser.add_argument('--chunks', type=int, default=4096)
+    parser.add_argument('--peers', type=int, default=16)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cores, {args.files} files of {args.chunks} chunks, {args.peers} peers, "
+          f"{args.clients} client processes x {args.threads} threads")
+    print(f"{'shards':>6} {'req/s':>8} {'speedup':>8}  files per shard")
+    base = None
+    for shards in args.shards:
+        rate, files_per_shard = run(shards, args)
+        base = base or rate
+        print(f"{shards:>6} {rate:>8.0f} {rate / base:>8.2f}  {files_per_shard}")
+
+
+if __name__ == '__main__':
+    main()
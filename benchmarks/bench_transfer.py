@@ -0,0 +1,142 @@
+"""Loopback throughput of the windowed chunk push vs the old stop-and-wait protocol.
+
+Usage: python benchmarks/bench_transfer.py [--size BYTES] [--legacy-size BYTES] [--window N]
+
+Stop-and-wait pays a full round trip (plus Nagle/delayed-ACK stalls from its
+three small writes) per chunk, so its throughput does not depend on the file
+size. It is measured on --legacy-size bytes to keep the run short.
+"""
+import argparse
+import os
+import queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from file_utils import ChunkStore  # noqa: E402
+from node import ChunkSender, Node  # noqa: E402
+from protocol import DEFAULT_WINDOW  # noqa: E402
+
+LEGACY_CHUNK_SIZE = 512  # what the old protocol sent per round trip
+
+
+def make_file(path, size):
+    block = os.urandom(1 << 20)
+    with open(path, 'wb') as f:
+        for offset in range(0, size, len(block)):
+            f.write(block[:size - offset])
+    return ChunkStore.open(path)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_listener(port):
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+
+def legacy_receive(server_socket):
+    """The receiving half of the old protocol, minus the per-chunk prints."""
+    conn, _ = server_socket.accept()
+    with conn:
+        conn.recv(1024)
+        num_chunks, total_chunks = conn.recv(1024).decode().split("/")
+        conn.sendall("READY".encode())
+        for _ in range(int(num_chunks)):
+            conn.recv(4)
+            chunk_size = int.from_bytes(conn.recv(4), byteorder='big')
+            chunk_data = b''
+            while len(chunk_data) < chunk_size:
+                packet = conn.recv(min(4096, chunk_size - len(chunk_data)))
+                if not packet:
+                    raise Exception("Connection closed while receiving chunk data")
+                chunk_data += packet
+            conn.sendall("ACK".encode())
+
+
+def legacy_send(port, store, num_chunks):
+    """The sending half of the old protocol, minus the per-chunk prints."""
+    with socket.create_connection(('127.0.0.1', port)) as s:
+        s.sendall(b"bench")
+        time.sleep(0.2)
+        s.sendall(f"{num_chunks}/{num_chunks}".encode())
+        if s.recv(1024).decode() != "READY":
+            raise Exception("Receiver not ready")
+        for i in range(num_chunks):
+            chunk = store.map[i * LEGACY_CHUNK_SIZE:(i + 1) * LEGACY_CHUNK_SIZE]
+            s.sendall(i.to_bytes(4, byteorder='big'))
+            s.sendall(len(chunk).to_bytes(4, byteorder='big'))
+            s.sendall(chunk)
+            if s.recv(1024).decode() != "ACK":
+                raise Exception(f"Chunk {i} not acknowledged")
+
+
+def bench_legacy(store, num_chunks):
+    server_socket = socket.socket()
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(1)
+    receiver = threading.Thread(target=legacy_receive, args=(server_socket,))
+    receiver.start()
+    start = time.perf_counter()
+    legacy_send(server_socket.getsockname()[1], store, num_chunks)
+    receiver.join()
+    elapsed = time.perf_counter() - start
+    server_socket.close()
+    return elapsed
+
+
+def bench_windowed(store, window):
+    port = free_port()
+    node = Node(port)
+    wait_for_listener(port)
+    chunks = queue.Queue()
+    for chunk_id in range(store.num_chunks):
+        chunks.put(chunk_id)
+    start = time.perf_counter()
+    sender = ChunkSender('127.0.0.1', port, store, chunks, "bench", window=window)
+    sender.run()
+    elapsed = time.perf_counter() - start
+    if node.downloaded_chunks != store.num_chunks:
+        raise Exception(f"Receiver only got {node.downloaded_chunks}/{store.num_chunks} chunks")
+    return elapsed
+
+
+def report(name, size, elapsed):
+    print(f"{name:<14} {elapsed:8.2f} s  {size / elapsed / (1 << 20):8.2f} MiB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1 << 30, help="bytes to transfer (default 1 GiB)")
+    parser.add_argument('--legacy-size', type=int, default=1 << 20,
+                        help="bytes to transfer with stop-and-wait (default 1 MiB)")
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW)
+    args = parser.parse_args()
+
+    # The receiving node writes its chunks under ./received_files
+    os.chdir(tempfile.mkdtemp())
+    store = make_file('bench.bin', args.size)
+    legacy_size = min(args.size, args.legacy_size)
+    print(f"{args.size} bytes in {store.num_chunks} chunks of {store.piece_size} bytes "
+          f"({store.num_blocks} blocks of {store.block_size} bytes)")
+    legacy = bench_legacy(store, -(-legacy_size // LEGACY_CHUNK_SIZE))
+    windowed = bench_windowed(store, args.window)
+    report("stop-and-wait", legacy_size, legacy)
+    report(f"window={args.window}", args.size, windowed)
+    print(f"speedup: {(args.size / windowed) / (legacy_size / legacy):.1f}x")
+
+
+if __name__ == '__main__':
+    main()
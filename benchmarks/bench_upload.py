@@ -0,0 +1,141 @@
+"""Pushing a file to several peers: static contiguous shares vs a shared queue, and hashing passes.
+
+Usage: python benchmarks/bench_upload.py [--size BYTES] [--peers N] [--slow-delay SECONDS]
+
+One of the receiving peers sleeps --slow-delay per block, like a peer on a slow link.
+With static shares the push lasts as long as that peer needs for its 1/N of the file;
+with the shared queue it just ends up taking fewer chunks. The hashing comparison is
+the per-chunk hashes plus a second whole-file pass, vs hash_store's single pass.
+"""
+import argparse
+import os
+import queue
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from file_utils import ChunkStore, compute_sha256, hash_chunk, hash_store  # noqa: E402
+from node import ChunkSender, Node  # noqa: E402
+
+
+class SlowSocket:
+    """Wraps a peer connection, sleeping before every read of block data."""
+
+    def __init__(self, sock, delay):
+        self.sock = sock
+        self.delay = delay
+
+    def recv_into(self, buffer, nbytes=0):
+        time.sleep(self.delay)
+        return self.sock.recv_into(buffer, nbytes)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class SlowNode(Node):
+    def __init__(self, port, delay):
+        self.delay = delay
+        super().__init__(port)
+
+    def receive_chunks(self, conn, payload):
+        super().receive_chunks(SlowSocket(conn, self.delay), payload)
+
+
+def make_file(path, size):
+    block = os.urandom(1 << 20)
+    with open(path, 'wb') as f:
+        for offset in range(0, size, len(block)):
+            f.write(block[:size - offset])
+    return ChunkStore.open(path)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_listener(port):
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+
+def start_peers(count, slow_delay):
+    ports = [free_port() for _ in range(count)]
+    nodes = [SlowNode(ports[0], slow_delay)] + [Node(port) for port in ports[1:]]
+    for port in ports:
+        wait_for_listener(port)
+    return ports, nodes
+
+
+def push(store, ports, queues, file_name):
+    senders = [ChunkSender('127.0.0.1', port, store, chunks, file_name)
+               for port, chunks in zip(ports, queues)]
+    start = time.perf_counter()
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    return time.perf_counter() - start, [len(sender.sent_chunks) for sender in senders]
+
+
+def static_queues(num_chunks, num_peers):
+    share = -(-num_chunks // num_peers)
+    queues = []
+    for i in range(num_peers):
+        chunks = queue.Queue()
+        for chunk_id in range(i * share, min(num_chunks, (i + 1) * share)):
+            chunks.put(chunk_id)
+        queues.append(chunks)
+    return queues
+
+
+def shared_queue(num_chunks, num_peers):
+    chunks = queue.Queue()
+    for chunk_id in range(num_chunks):
+        chunks.put(chunk_id)
+    return [chunks] * num_peers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=256 << 20)
+    parser.add_argument('--peers', type=int, default=4)
+    parser.add_argument('--slow-delay', type=float, default=0.002)
+    args = parser.parse_args()
+
+    # The receiving nodes write their chunks under ./received_files
+    os.chdir(tempfile.mkdtemp())
+    store = make_file('bench.bin', args.size)
+    print(f"{args.size} bytes in {store.num_chunks} chunks of {store.piece_size} bytes, {args.peers} peers, "
+          f"one sleeping {args.slow_delay * 1e3:.1f} ms per block read")
+
+    start = time.perf_counter()
+    [hash_chunk(store, i) for i in range(store.num_chunks)]
+    compute_sha256('bench.bin')
+    two_pass = time.perf_counter() - start
+    start = time.perf_counter()
+    hash_store(store)
+    one_pass = time.perf_counter() - start
+    print(f"{'hashing, two passes':<24} {two_pass:8.2f} s")
+    print(f"{'hashing, hash_store':<24} {one_pass:8.2f} s")
+
+    ports, _ = start_peers(args.peers, args.slow_delay)
+    runs = [("push, static shares", static_queues(store.num_chunks, args.peers)),
+            ("push, shared queue", shared_queue(store.num_chunks, args.peers))]
+    for i, (name, queues) in enumerate(runs):
+        # A different file name per run, so the peers start each run with an empty session
+        elapsed, counts = push(store, ports, queues, f"bench{i}.bin")
+        print(f"{name:<24} {elapsed:8.2f} s  {args.size / elapsed / (1 << 20):8.2f} MiB/s  chunks per peer: {counts}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import base64
+import itertools
+
+# Turn the '0'/'1' digits of a bitfield's binary string into selectors for itertools.compress
+SET_SELECTORS = bytes.maketrans(b'01', b'\x00\x01')
+CLEAR_SELECTORS = bytes.maketrans(b'01', b'\x01\x00')
+
+
+class Bitfield:
+    """One bit per chunk, packed eight to a byte (chunk 0 is the high bit of the first byte).
+
+    Indexing returns and accepts 0/1 like the lists it replaces. On the wire a bitfield is sent as
+    base64 of the packed bytes, which is 1/8 of a byte per chunk instead of a JSON list entry.
+    """
+
+    def __init__(self, length, data=None):
+        self.length = length
+        size = (length + 7) // 8
+        if data is None:
+            self.bits = bytearray(size)
+        else:
+            if len(data) != size:
+                raise ValueError(f"Bitfield of {length} bits needs {size} bytes, got {len(data)}")
+            self.bits = bytearray(data)
+
+    @classmethod
+    def full(cls, length):
+        bitfield = cls(length, b'\xff' * ((length + 7) // 8))
+        bitfield._clear_padding()
+        return bitfield
+
+    @classmethod
+    def from_base64(cls, length, encoded):
+        bitfield = cls(length, base64.b64decode(encoded))
+        bitfield._clear_padding()
+        return bitfield
+
+    @classmethod
+    def from_bytes(cls, length, data):
+        bitfield = cls(length, data)
+        bitfield._clear_padding()
+        return bitfield
+
+    def to_base64(self):
+        return base64.b64encode(self.bits).decode()
+
+    def _clear_padding(self):
+        if self.length % 8:
+            self.bits[-1] &= (0xff << (8 - self.length % 8)) & 0xff
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.length:
+            raise IndexError(f"Bit {index} out of range")
+        return (self.bits[index >> 3] >> (7 - (index & 7))) & 1
+
+    def __setitem__(self, index, value):
+        if not 0 <= index < self.length:
+            raise IndexError(f"Bit {index} out of range")
+        mask = 0x80 >> (index & 7)
+        if value:
+            self.bits[index >> 3] |= mask
+        else:
+            self.bits[index >> 3] &= ~mask & 0xff
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self[index]
+
+    def __eq__(self, other):
+        return isinstance(other, Bitfield) and self.length == other.length and self.bits == other.bits
+
+    def count(self):
+        """Number of set bits."""
+        return bin(int.from_bytes(self.bits, 'big')).count('1')
+
+    def all(self):
+        return self.count() == self.length
+
+    def _digits(self):
+        """The bits as a string of '0' and '1' bytes; the leading 1 keeps leading zeros."""
+        return bin(int.from_bytes(self.bits, 'big') | 1 << 8 * len(self.bits))[3:].encode()
+
+    def set_bits(self):
+        """Indexes of the set bits, picked out by C code rather than a Python loop per bit."""
+        return itertools.compress(range(self.length), self._digits().translate(SET_SELECTORS))
+
+    def missing(self):
+        """Indexes of the clear bits."""
+        return itertools.compress(range(self.length), self._digits().translate(CLEAR_SELECTORS))
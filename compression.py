@@ -0,0 +1,98 @@
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Codecs are negotiated as a bitmask of the codecs a side accepts. Compressed blocks
+# travel in ZCHUNK frames whose payload starts with the codec's byte.
+NONE = 0
+ZLIB = 1
+ZSTD = 2
+LZ4 = 4
+
+PREFERENCE = (ZSTD, LZ4, ZLIB)  # fastest for the ratio first
+MAX_RATIO = 0.9  # a piece whose first block doesn't shrink below this is sent as is
+COMPRESS_WORKERS = max(2, os.cpu_count() or 1)
+
+# Shared by every sender, so compressing never ties up the threads doing socket I/O
+pool = ThreadPoolExecutor(max_workers=COMPRESS_WORKERS)
+
+
+def available():
+    """Bitmask of the codecs this process can compress and decompress."""
+    mask = ZLIB
+    if zstandard is not None:
+        mask |= ZSTD
+    if lz4 is not None:
+        mask |= LZ4
+    return mask
+
+
+def choose(offered):
+    """Picks the preferred codec among those both sides support, or NONE."""
+    for codec in PREFERENCE:
+        if offered & available() & codec:
+            return codec
+    return NONE
+
+
+def compress(codec, data):
+    if codec == ZLIB:
+        return zlib.compress(data, 1)
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if codec == LZ4:
+        return lz4.frame.compress(data)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def decompress(codec, data, size):
+    """Decompresses a block that must come out at exactly `size` bytes."""
+    if codec == ZLIB:
+        decompressor = zlib.decompressobj()
+        out = decompressor.decompress(data, size)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Compressed block is larger than expected")
+    elif codec == ZSTD:
+        out = zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+    elif codec == LZ4:
+        # Stop at `size` bytes, like the others, so a small frame can't expand without bound
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        out = decompressor.decompress(data, max_length=size)
+        if not decompressor.eof:
+            raise ValueError("Compressed block is larger than expected, or cut short")
+    else:
+        raise ValueError(f"Unknown codec {codec}")
+    if len(out) != size:
+        raise ValueError(f"Block decompressed to {len(out)} bytes, expected {size}")
+    return out
+
+
+def encode_chunk(store, chunk_id, codec):
+    """Returns (block id, ZCHUNK payload or None) for every block of a chunk.
+
+    None means the block goes out raw. The first block is compressed on its own to see if
+    the piece is worth it, so already compressed data costs one block of work, not a piece.
+    The other blocks are compressed in parallel on the pool.
+    """
+    blocks = store.blocks_in_chunk(chunk_id)
+    if codec == NONE:
+        return [(block_id, None) for block_id in blocks]
+    views = [store.block_view(block_id) for block_id in blocks]
+    first = pool.submit(compress, codec, views[0]).result()
+    if len(first) > MAX_RATIO * len(views[0]):
+        return [(block_id, None) for block_id in blocks]
+    rest = pool.map(compress, [codec] * (len(views) - 1), views[1:])
+    encoded = []
+    for block_id, view, data in zip(blocks, views, [first, *rest]):
+        encoded.append((block_id, bytes([codec]) + data if len(data) < len(view) else None))
+    return encoded
@@ -0,0 +1,378 @@
+import collections
+import logging
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from file_utils import ChunkBuffer, verify_chunk
+from peer_server import IDLE_TIMEOUT
+from protocol import GET_CHUNK, send_frame, recv_chunk_frames, encode_get_chunk
+from ratelimit import DOWNLOAD
+
+DEFAULT_IN_FLIGHT = 8  # chunk requests kept outstanding across all holders
+REQUEST_TIMEOUT = 10  # seconds a peer may stall before the chunk is retried elsewhere
+PEER_COOLDOWN = 5  # seconds a peer that failed a request is avoided for
+RETRY_DELAY = 0.2  # seconds to wait when the tracker has nothing to hand out
+REPORT_BATCH = 32  # verified chunks reported to the tracker in one call
+REPORT_INTERVAL = 0.5  # seconds a verified chunk may wait to be reported
+SUMMARY_INTERVAL = 10  # seconds between reports to the tracker while the peers hear about chunks by gossip
+ENDGAME_CHUNKS = DEFAULT_IN_FLIGHT  # chunks left when endgame starts, 0 to never enter it
+ENDGAME_COPIES = 3  # holders asked at once for each of the last chunks
+ENDGAME_TIMEOUT = 2  # seconds a peer may stall on one of the last chunks before it is asked elsewhere
+POOL_IDLE = IDLE_TIMEOUT / 2  # seconds a pooled connection is reused for, well before the peer closes it
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """Idle connections to peers, kept open so consecutive chunks from a peer skip the TCP handshake.
+
+    A connection that sat unused for `max_idle` is closed instead of reused, since the peer may
+    have closed its end by then, and so it stops holding one of the peer's connection slots.
+    """
+
+    def __init__(self, timeout=REQUEST_TIMEOUT, max_idle=POOL_IDLE):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = {}  # node id -> list of (open socket, when it was put back)
+        self.lock = threading.Lock()
+
+    def get(self, node_id):
+        stale = []
+        cutoff = time.monotonic() - self.max_idle
+        with self.lock:
+            for peer, sockets in list(self.idle.items()):
+                stale += [sock for sock, since in sockets if since < cutoff]
+                sockets[:] = [(sock, since) for sock, since in sockets if since >= cutoff]
+                if not sockets:
+                    del self.idle[peer]
+            sockets = self.idle.get(node_id)
+            sock = sockets.pop()[0] if sockets else None
+        for old in stale:
+            old.close()
+        if sock is not None:
+            return sock
+        ip, port = node_id.split(':')
+        sock = socket.create_connection((ip, int(port)), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def put(self, node_id, sock):
+        with self.lock:
+            self.idle.setdefault(node_id, []).append((sock, time.monotonic()))
+
+    def close(self):
+        with self.lock:
+            for sockets in self.idle.values():
+                for sock, _ in sockets:
+                    sock.close()
+            self.idle.clear()
+
+
+class ChunkRequest:
+    """One chunk asked of one holder, which the downloading loop can cancel while a worker runs it.
+
+    Cancelling shuts the request's socket down, so a worker blocked on it fails right away. A
+    request that may race others for the same chunk receives into a ChunkBuffer instead of the
+    file, so only the copy that wins is written.
+    """
+
+    def __init__(self, chunk_id, holder, source=None, buffered=False, timeout=REQUEST_TIMEOUT):
+        self.chunk_id = chunk_id
+        self.holder = holder
+        self.source = source
+        self.buffer = None
+        self.buffered = buffered
+        self.timeout = timeout
+        self.sock = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def attach(self, sock):
+        """Sets the socket the request goes over; returns False if it was cancelled already."""
+        with self.lock:
+            self.sock = None if self.cancelled else sock
+            return not self.cancelled
+
+    def detach(self):
+        """Returns whether the socket is fit to be reused, which it isn't if the request was cancelled."""
+        with self.lock:
+            self.sock = None
+            return not self.cancelled
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.sock is not None:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class Downloader:
+    """Downloads the missing chunks of a torrent from every holder at once.
+
+    Up to `max_in_flight` chunks are fetched concurrently by a thread pool, each over a pooled
+    connection to its holder. The fetching thread also verifies the chunk, so hashing never holds
+    up the loop that hands out requests. Failed or timed out requests put the holder on a short
+    cooldown and the chunk is scheduled again.
+
+    Once no more than `endgame_chunks` chunks are left, the download is in endgame: each of them
+    is asked of up to ENDGAME_COPIES holders at once, with a shorter timeout, and the first copy
+    that matches its hash wins while the other requests are cancelled. A stalled or failed
+    request is replaced by one to another holder on the next pass, so the last chunks don't wait
+    on the slowest peer.
+
+    Chunks are picked rarest first from what the peers told us by gossip, and each verified chunk
+    is announced to them the same way. The tracker is only asked for chunks when gossip has none
+    to offer, and only hears a summary of our chunks every SUMMARY_INTERVAL, so tracker calls
+    don't grow with the size of the swarm. Before anything is requested, chunks whose hash the
+    node already has from another file or its chunk cache are copied locally.
+    """
+
+    def __init__(self, node, torrent, max_in_flight=DEFAULT_IN_FLIGHT, timeout=REQUEST_TIMEOUT, endgame_chunks=None):
+        self.node = node
+        self.torrent = torrent
+        self.file_name = torrent.file_id
+        self.store = torrent.store
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.endgame_chunks = ENDGAME_CHUNKS if endgame_chunks is None else endgame_chunks
+        self.connections = ConnectionPool(timeout)
+        self.in_flight = {}  # future -> ChunkRequest
+        # Chunks whose winning copy waits in its buffer for the request writing into the file to stop
+        self.pending = {}  # chunk id -> ChunkRequest
+        self.bad_peers = set()  # holders that sent chunks that failed verification
+        self.cooldown = {}  # holder -> time until which it is avoided
+        self.unreported = []  # verified chunks the tracker doesn't know we have yet
+        self.unlogged = []  # verified chunks not checkpointed in the session log yet
+        self.last_report = self.last_checkpoint = time.monotonic()
+
+    def run(self):
+        self.copy_local_chunks()
+        workers = max(self.max_in_flight, self.endgame_chunks * ENDGAME_COPIES)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                while not self.torrent.complete():
+                    self.fill(pool)
+                    if not self.in_flight:
+                        self.report(force=True)
+                        time.sleep(RETRY_DELAY)
+                        continue
+                    done, _ = wait(self.in_flight, timeout=REPORT_INTERVAL, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.finish(future)
+                    self.report()
+                while self.unreported:
+                    self.report(force=True)
+            finally:
+                for future, request in self.in_flight.items():
+                    future.cancel()
+                    request.cancel()
+                self.connections.close()
+
+    def fill(self, pool):
+        """Schedules a batch of chunks that fills the in-flight window.
+
+        The rarest chunks our gossip peers hold come first, each from whichever of them we have the
+        fewest requests out to. The tracker is only asked once gossip has nothing left to hand out.
+        """
+        view = self.node.gossip.view(self.file_name)
+        if view is not None and 0 < self.store.num_chunks - self.torrent.have <= self.endgame_chunks:
+            self.fill_endgame(pool, view)
+            if self.in_flight:
+                return
+        wanted = self.max_in_flight - len(self.in_flight)
+        if wanted <= 0:
+            return
+        schedule = []
+        if view is not None:
+            load = collections.Counter(request.holder for request in self.in_flight.values())
+            schedule = [(chunk_id, holder, None) for chunk_id, holder in
+                        view.schedule(wanted, self.in_flight_chunks(), self.avoided_peers(), load)]
+        if not schedule and not self.in_flight:
+            try:
+                schedule = self.node.request_chunks(self.file_name, wanted, self.in_flight_chunks() + self.unreported,
+                                                    self.avoided_peers())
+            except Exception as e:
+                log.warning("Error asking the tracker for chunks: %s", e)
+                return
+        for chunk_id, holder, source in schedule:
+            self.submit(pool, ChunkRequest(chunk_id, holder, source, timeout=self.timeout))
+
+    def fill_endgame(self, pool, view):
+        """Asks more holders for each chunk left, so every one has up to ENDGAME_COPIES requests out."""
+        asked = collections.defaultdict(set)  # chunk id -> holders it is asked of
+        for request in self.in_flight.values():
+            asked[request.chunk_id].add(request.holder)
+        load = collections.Counter(request.holder for request in self.in_flight.values())
+        avoid = set(self.avoided_peers())
+        for chunk_id in list(self.torrent.bitfield.missing()):
+            if chunk_id in self.pending:
+                continue
+            holders = view.holders(chunk_id, avoid | asked[chunk_id])
+            random.shuffle(holders)
+            holders.sort(key=lambda peer: load[peer])
+            for holder in holders[:ENDGAME_COPIES - len(asked[chunk_id])]:
+                load[holder] += 1
+                # Once a chunk may be raced for, no request writes it straight into the file
+                self.submit(pool, ChunkRequest(chunk_id, holder, buffered=True, timeout=ENDGAME_TIMEOUT))
+
+    def submit(self, pool, request):
+        self.in_flight[pool.submit(self.fetch, request)] = request
+
+    def in_flight_chunks(self):
+        return [request.chunk_id for request in self.in_flight.values()] + list(self.pending)
+
+    def gossiping(self):
+        view = self.node.gossip.view(self.file_name)
+        return view is not None and bool(view.peers)
+
+    def report(self, force=False):
+        """Checkpoints verified chunks once enough have piled up or they have waited long enough.
+
+        The tracker hears about them at the same pace, or only every SUMMARY_INTERVAL while our
+        peers learn about our chunks by gossip.
+        """
+        now = time.monotonic()
+        if self.unlogged and (force or len(self.unlogged) >= REPORT_BATCH or
+                              now - self.last_checkpoint >= REPORT_INTERVAL):
+            self.torrent.checkpoint(self.unlogged)
+            self.unlogged = []
+            self.last_checkpoint = now
+        if not self.unreported:
+            return
+        if self.gossiping():
+            due = now - self.last_report >= SUMMARY_INTERVAL
+        else:
+            due = len(self.unreported) >= REPORT_BATCH or now - self.last_report >= REPORT_INTERVAL
+        if not force and not due:
+            return
+        try:
+            self.node.report_chunks(self.file_name, self.unreported)
+        except Exception as e:
+            log.warning("Error reporting chunks to the tracker: %s", e)
+            time.sleep(RETRY_DELAY)
+            return
+        self.unreported = []
+        self.last_report = time.monotonic()
+
+    def avoided_peers(self):
+        now = time.monotonic()
+        cooling = [peer for peer, until in self.cooldown.items() if until > now]
+        return list(self.bad_peers.union(cooling))
+
+    def copy_local_chunks(self):
+        """Fills in missing chunks the node already has the data for, under any file."""
+        copied = []
+        for chunk_id in list(self.torrent.bitfield.missing()):
+            chunk_hash = self.torrent.piece_hashes[chunk_id]
+            data = self.node.find_local_chunk(chunk_hash)
+            if data is None or len(data) != self.store.chunk_range(chunk_id)[1]:
+                continue
+            self.store.write_chunk(chunk_id, data)
+            if verify_chunk(self.store, chunk_id, chunk_hash) and self.torrent.mark_have(chunk_id):
+                self.node.index_chunks(self.torrent, [chunk_id])
+                self.unreported.append(chunk_id)
+                self.unlogged.append(chunk_id)
+                copied.append(chunk_id)
+        if copied:
+            self.node.gossip.announce(self.torrent, copied)
+            log.info("Copied %d chunks of %s from local data", len(copied), self.file_name)
+
+    def fetch(self, request):
+        """Fetches one chunk into the store, or the request's buffer, and returns whether it matches its hash.
+
+        With a `source` on the request, the holder is asked for that (file, chunk) instead, which
+        has the same data.
+        """
+        chunk_id, holder = request.chunk_id, request.holder
+        file_name, source_chunk = request.source or (self.file_name, None)
+        start = time.perf_counter()
+        target = self.store
+        if request.buffered:
+            target = request.buffer = ChunkBuffer(self.store, chunk_id)
+        sock = self.connections.get(holder)
+        if not request.attach(sock):
+            self.connections.put(holder, sock)
+            return False
+        try:
+            sock.settimeout(request.timeout)
+            send_frame(sock, GET_CHUNK, chunk_id if source_chunk is None else source_chunk,
+                       encode_get_chunk(file_name, self.node.codecs))
+            # Receive the chunk's blocks straight into their place on disk, or in the buffer
+            recv_chunk_frames(sock, target, chunk_id, source_chunk,
+                              self.node.limiter.throttler(DOWNLOAD, self.file_name, holder.split(':')[0]))
+        except Exception:
+            request.detach()
+            sock.close()
+            raise
+        if request.detach():
+            self.connections.put(holder, sock)
+        else:
+            sock.close()
+        chunk_hash = self.torrent.piece_hashes[chunk_id]
+        if not verify_chunk(target, chunk_id, chunk_hash):
+            return False
+        self.node.fetch_seconds.observe(time.perf_counter() - start)
+        self.node.chunk_cache.put(chunk_hash, target.read_chunk(chunk_id))
+        return True
+
+    def finish(self, future):
+        request = self.in_flight.pop(future)
+        chunk_id, holder = request.chunk_id, request.holder
+        if not request.buffered and chunk_id in self.pending:
+            # The request writing into the file lost and has stopped, so the winning copy can go in
+            self.commit(self.pending.pop(chunk_id))
+            return
+        if request.cancelled:
+            return
+        try:
+            valid = future.result()
+        except Exception as e:
+            log.warning("Error fetching chunk %d from %s: %s", chunk_id, holder, e, exc_info=True)
+            self.node.failed_connections += 1
+            self.node.chunk_errors.inc(1, ('fetch',))
+            self.cooldown[holder] = time.monotonic() + PEER_COOLDOWN
+            if isinstance(e, OSError):
+                # Unreachable, not just refusing this chunk: other downloaders had better know too
+                try:
+                    self.node.report_failure(holder)
+                except Exception as report_error:
+                    log.warning("Error reporting %s to the tracker: %s", holder, report_error)
+            return
+        self.node.successful_connections += 1
+        if not valid:
+            log.warning("Chunk %d from %s failed verification, fetching it from another node", chunk_id, holder)
+            self.node.chunk_errors.inc(1, ('verify',))
+            self.bad_peers.add(holder)
+            return
+
+        racing = [other for other in self.in_flight.values() if other.chunk_id == chunk_id]
+        for other in racing:
+            other.cancel()
+        if racing:
+            self.node.cancelled_requests.inc(len(racing))
+        # Only requests asked as buffered ever get a buffer, and one still queued doesn't have it yet
+        if request.buffered and any(not other.buffered for other in racing):
+            self.pending[chunk_id] = request
+            return
+        self.commit(request)
+
+    def commit(self, request):
+        """Records the chunk of a request that won, writing it into the file first if it was buffered."""
+        chunk_id, holder = request.chunk_id, request.holder
+        if request.buffer is not None and not self.torrent.has_chunk(chunk_id):
+            self.store.write_chunk(chunk_id, request.buffer.data)
+        self.unreported.append(chunk_id)
+        self.unlogged.append(chunk_id)
+        chunk_size = self.store.chunk_range(chunk_id)[1]
+        log.debug("Downloaded chunk %d of %s (%d bytes) from %s", chunk_id, self.file_name, chunk_size, holder)
+        self.node.peer_received_bytes.inc(chunk_size, (holder.split(':')[0],))
+        if self.torrent.mark_have(chunk_id):
+            self.node.index_chunks(self.torrent, [chunk_id])
+            self.node.gossip.announce(self.torrent, [chunk_id])
+            self.node.downloaded_chunks += 1
+            self.node.total_downloaded_bytes += chunk_size
@@ -1,25 +1,302 @@
 import os
+import mmap
 import hashlib
+import logging
+import threading
+from collections import OrderedDict
 
-CHUNK_SIZE = 512  # Size of each chunk
-
-def chunk_file(file):
-    chunks = []
-    with open(file, 'rb') as f:
-        while True:
-            chunk = f.read(CHUNK_SIZE)
-            if not chunk:
-                break
-            chunks.append(chunk)
-    return chunks
-
-def save_chunks(chunks, output_dir):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    for i, chunk in enumerate(chunks):
-        chunk_path = os.path.join(output_dir, f'chunk_{i:04d}')
-        with open(chunk_path, 'wb') as f:
-            f.write(chunk)
+# Files are split into pieces (the chunks the tracker keeps track of), and pieces
+# are split into blocks, which are what actually go over the wire in CHUNK frames.
+BLOCK_SIZE = 16 * 1024
+MIN_PIECE_SIZE = 256 * 1024
+MAX_PIECE_SIZE = 4 * 1024 * 1024
+TARGET_PIECES = 1024  # Piece count to aim for before growing the piece size
+
+log = logging.getLogger(__name__)
+
+
+def choose_piece_size(file_size):
+    """Picks a power-of-two piece size between MIN_PIECE_SIZE and MAX_PIECE_SIZE for a file."""
+    piece_size = MIN_PIECE_SIZE
+    while piece_size < MAX_PIECE_SIZE and file_size > piece_size * TARGET_PIECES:
+        piece_size *= 2
+    return piece_size
+
+
+class ChunkStore:
+    """Chunks of one file, kept on disk in a single preallocated file instead of in memory.
+
+    Chunk `i` lives at offset `i * piece_size` and is made of blocks of `block_size` bytes.
+    Blocks are numbered across the whole file, so block `b` lives at offset `b * block_size`.
+    Received blocks are written straight into place and served blocks are sent straight
+    from the page cache.
+    """
+
+    def __init__(self, path, file_size, piece_size=None, block_size=BLOCK_SIZE, writable=True):
+        if piece_size is None:
+            piece_size = choose_piece_size(file_size)
+        if piece_size % block_size != 0:
+            raise ValueError(f"Piece size {piece_size} is not a multiple of block size {block_size}")
+        self.path = path
+        self.file_size = file_size
+        self.piece_size = piece_size
+        self.block_size = block_size
+        self.blocks_per_piece = piece_size // block_size
+        self.writable = writable
+        if writable:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+            os.ftruncate(self.fd, file_size)
+        else:
+            self.fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self.map = None
+        if file_size > 0:
+            self.map = mmap.mmap(self.fd, file_size, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+    @classmethod
+    def open(cls, path, piece_size=None, block_size=BLOCK_SIZE):
+        """Serves an existing file in place, without copying it."""
+        return cls(path, os.path.getsize(path), piece_size, block_size, writable=False)
+
+    @classmethod
+    def create(cls, path, file_size, piece_size=None, block_size=BLOCK_SIZE):
+        """Preallocates a file that chunks will be written into as they arrive."""
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        return cls(path, file_size, piece_size, block_size)
+
+    @property
+    def num_chunks(self):
+        return -(-self.file_size // self.piece_size)
+
+    @property
+    def num_blocks(self):
+        return -(-self.file_size // self.block_size)
+
+    def chunk_range(self, chunk_id):
+        """Returns (offset, length) of a chunk in the file."""
+        if not 0 <= chunk_id < self.num_chunks:
+            raise IndexError(f"Chunk {chunk_id} out of range")
+        offset = chunk_id * self.piece_size
+        return offset, min(self.piece_size, self.file_size - offset)
+
+    def block_range(self, block_id):
+        """Returns (offset, length) of a block in the file."""
+        if not 0 <= block_id < self.num_blocks:
+            raise IndexError(f"Block {block_id} out of range")
+        offset = block_id * self.block_size
+        return offset, min(self.block_size, self.file_size - offset)
+
+    def blocks_in_chunk(self, chunk_id):
+        first = chunk_id * self.blocks_per_piece
+        return range(first, min(first + self.blocks_per_piece, self.num_blocks))
+
+    def chunk_of_block(self, block_id):
+        return block_id // self.blocks_per_piece
+
+    def chunk_view(self, chunk_id):
+        """Returns a memoryview over a chunk, backed directly by the file mapping."""
+        offset, length = self.chunk_range(chunk_id)
+        return memoryview(self.map)[offset:offset + length]
+
+    def block_view(self, block_id):
+        offset, length = self.block_range(block_id)
+        return memoryview(self.map)[offset:offset + length]
+
+    def write_block(self, block_id, data):
+        offset, length = self.block_range(block_id)
+        if len(data) != length:
+            raise ValueError(f"Block {block_id} should be {length} bytes, got {len(data)}")
+        self.map[offset:offset + length] = data
+
+    def read_chunk(self, chunk_id):
+        return bytes(self.chunk_view(chunk_id))
+
+    def write_chunk(self, chunk_id, data):
+        offset, length = self.chunk_range(chunk_id)
+        if len(data) != length:
+            raise ValueError(f"Chunk {chunk_id} should be {length} bytes, got {len(data)}")
+        self.map[offset:offset + length] = data
+
+    def recv_block(self, sock, block_id, length):
+        """Receives a block from a socket directly into its place in the file."""
+        offset, expected = self.block_range(block_id)
+        if length != expected:
+            raise ValueError(f"Block {block_id} should be {expected} bytes, got {length}")
+        recv_into(sock, memoryview(self.map)[offset:offset + length])
+
+    def send_block(self, sock, block_id):
+        """Sends a block to a socket without copying it through Python where the OS allows it."""
+        offset, length = self.block_range(block_id)
+        if hasattr(os, 'sendfile'):
+            sent = 0
+            while sent < length:
+                sent += os.sendfile(sock.fileno(), self.fd, offset + sent, length - sent)
+        else:
+            sock.sendall(memoryview(self.map)[offset:offset + length])
+
+    def flush(self):
+        if self.map is not None and self.writable:
+            self.map.flush()
+
+    def rename(self, new_path):
+        """Moves the backing file. The open mapping stays valid, so chunks can still be served meanwhile."""
+        os.replace(self.path, new_path)
+        self.path = new_path
+
+    def close(self):
+        if self.map is not None:
+            if self.writable:
+                self.map.flush()
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class ChunkBuffer:
+    """Room in memory for one chunk of a ChunkStore, which receives blocks the same way the store does.
+
+    Used to receive a copy of a chunk that may lose to another copy, without touching the file.
+    Blocks keep their numbers in the whole file.
+    """
+
+    def __init__(self, store, chunk_id):
+        self.store = store
+        self.chunk_id = chunk_id
+        self.blocks_per_piece = store.blocks_per_piece
+        self.offset, length = store.chunk_range(chunk_id)
+        self.data = bytearray(length)
+
+    def blocks_in_chunk(self, chunk_id):
+        return self.store.blocks_in_chunk(chunk_id)
+
+    def block_range(self, block_id):
+        return self.store.block_range(block_id)
+
+    def chunk_view(self, chunk_id):
+        return memoryview(self.data)
+
+    def read_chunk(self, chunk_id):
+        return bytes(self.data)
+
+    def block_view(self, block_id):
+        offset, length = self.store.block_range(block_id)
+        return memoryview(self.data)[offset - self.offset:offset - self.offset + length]
+
+    def write_block(self, block_id, data):
+        view = self.block_view(block_id)
+        if len(data) != len(view):
+            raise ValueError(f"Block {block_id} should be {len(view)} bytes, got {len(data)}")
+        view[:] = data
+
+    def recv_block(self, sock, block_id, length):
+        view = self.block_view(block_id)
+        if length != len(view):
+            raise ValueError(f"Block {block_id} should be {len(view)} bytes, got {length}")
+        recv_into(sock, view)
+
+
+def recv_into(sock, view):
+    """Fills a memoryview from a socket."""
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:], len(view) - received)
+        if n == 0:
+            raise ConnectionError("Connection closed while receiving chunk data")
+        received += n
+
+
+class ChunkCache:
+    """Chunks kept by content, so data already seen in an earlier file isn't fetched again.
+
+    Every chunk is a file under `directory` named by its sha256. Once the chunks add up to
+    more than `max_bytes`, the least recently used ones are evicted. A `max_bytes` of 0
+    turns the cache off.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # chunk hash -> size, least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+        if max_bytes <= 0:
+            return
+        os.makedirs(directory, exist_ok=True)
+        # Pick up chunks cached by an earlier run, oldest first
+        cached = [entry for entry in os.scandir(directory) if entry.is_file() and not entry.name.endswith('.tmp')]
+        for entry in sorted(cached, key=lambda entry: entry.stat().st_mtime):
+            self.entries[entry.name] = entry.stat().st_size
+            self.size += entry.stat().st_size
+        self._evict()
+
+    def __contains__(self, chunk_hash):
+        with self.lock:
+            return chunk_hash in self.entries
+
+    def get(self, chunk_hash):
+        """Returns the cached chunk with this hash, or None."""
+        with self.lock:
+            if chunk_hash not in self.entries:
+                return None
+            self.entries.move_to_end(chunk_hash)
+        try:
+            with open(os.path.join(self.directory, chunk_hash), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, chunk_hash, data):
+        if not 0 < len(data) <= self.max_bytes:
+            return
+        with self.lock:
+            if chunk_hash in self.entries:
+                self.entries.move_to_end(chunk_hash)
+                return
+        path = os.path.join(self.directory, chunk_hash)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            if chunk_hash not in self.entries:
+                self.entries[chunk_hash] = len(data)
+                self.size += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            chunk_hash, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.directory, chunk_hash))
+            except OSError:
+                pass
+
+
+def chunk_file(file, piece_size=None):
+    return ChunkStore.open(file, piece_size)
+
+def hash_chunk(store, chunk_id):
+    return hashlib.sha256(store.chunk_view(chunk_id)).hexdigest()
+
+def hash_store(store):
+    """Hashes the whole file and every chunk in a single pass over the data.
+
+    Returns the file's sha256 and the list of chunk sha256s, as hex digests.
+    """
+    file_hash = hashlib.sha256()
+    piece_hashes = []
+    for chunk_id in range(store.num_chunks):
+        view = store.chunk_view(chunk_id)
+        file_hash.update(view)
+        piece_hashes.append(hashlib.sha256(view).hexdigest())
+    return file_hash.hexdigest(), piece_hashes
+
+def verify_chunk(store, chunk_id, expected_hash):
+    return hash_chunk(store, chunk_id) == expected_hash
 
 def compute_sha256(file_path):
     sha256 = hashlib.sha256()
@@ -28,13 +305,13 @@ def compute_sha256(file_path):
             sha256.update(chunk)
     return sha256.hexdigest()
 
-def reassemble_file(chunks, output_file, original_hash):
-    with open(output_file, 'wb') as f:
-        for chunk in chunks:
-            f.write(chunk)
+def reassemble_file(store, output_file, original_hash):
+    # The chunks are already in place on disk, so reassembling is just a rename
+    store.flush()
+    store.rename(output_file)
 
     reassembled_hash = compute_sha256(output_file)
     if reassembled_hash != original_hash:
         raise ValueError("Hash status: mismatch\nThe file may be corrupted :(")
     else:
-        print("Hash status: match\nMoto moto says good job")
\ No newline at end of file
+        log.info("Hash status of %s: match. Moto moto says good job", output_file)
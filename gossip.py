@@ -0,0 +1,259 @@
+import logging
+import queue
+import random
+import socket
+import struct
+import threading
+from array import array
+from bitfield import Bitfield
+from indexed_set import IndexedSet
+from peer_server import IDLE_TIMEOUT
+from protocol import BITFIELD, HAVE, send_frame, encode_gossip, decode_gossip
+
+LINK_TIMEOUT = 10  # seconds to connect to, or send to, a peer we gossip with
+LINK_IDLE = IDLE_TIMEOUT / 2  # seconds a link with nothing to send stays open, well before the peer closes it
+MAX_PEERS = 50  # peers of a torrent we start gossiping with, so HAVEs don't grow with the swarm
+
+log = logging.getLogger(__name__)
+
+
+class SwarmView:
+    """One file's chunks as seen across the peers we gossip with.
+
+    Keeps each peer's bitfield, how many of them hold every chunk, and the chunks we are still
+    missing bucketed by that count, like the tracker's rarity index (Tracker.missing).
+    """
+
+    def __init__(self, ours):
+        self.peers = {}  # peer id -> Bitfield
+        self.availability = array('I', bytes(4 * len(ours)))
+        self.missing = {0: IndexedSet(ours.missing())}  # availability -> our missing chunks
+        self.lock = threading.Lock()
+
+    def set_peer(self, peer_id, chunks):
+        with self.lock:
+            old = self.peers.get(peer_id)
+            if old is not None:
+                for chunk_id in old.set_bits():
+                    self._change(chunk_id, -1)
+            self.peers[peer_id] = chunks
+            for chunk_id in chunks.set_bits():
+                self._change(chunk_id, 1)
+
+    def peer_has(self, peer_id, chunk_ids):
+        with self.lock:
+            chunks = self.peers.setdefault(peer_id, Bitfield(len(self.availability)))
+            for chunk_id in chunk_ids:
+                if 0 <= chunk_id < len(chunks) and not chunks[chunk_id]:
+                    chunks[chunk_id] = 1
+                    self._change(chunk_id, 1)
+
+    def drop_peer(self, peer_id):
+        with self.lock:
+            chunks = self.peers.pop(peer_id, None)
+            if chunks is not None:
+                for chunk_id in chunks.set_bits():
+                    self._change(chunk_id, -1)
+
+    def we_have(self, chunk_ids):
+        with self.lock:
+            for chunk_id in chunk_ids:
+                self._discard(self.availability[chunk_id], chunk_id)
+
+    def _change(self, chunk_id, delta):
+        old = self.availability[chunk_id]
+        self.availability[chunk_id] = old + delta
+        if self._discard(old, chunk_id):
+            self.missing.setdefault(old + delta, IndexedSet()).add(chunk_id)
+
+    def _discard(self, freq, chunk_id):
+        bucket = self.missing.get(freq)
+        if bucket is None or chunk_id not in bucket:
+            return False
+        bucket.discard(chunk_id)
+        if not bucket:
+            del self.missing[freq]
+        return True
+
+    def holders(self, chunk_id, avoid=()):
+        """The peers holding a chunk, leaving out those in `avoid`."""
+        with self.lock:
+            return self._holders(chunk_id, avoid)
+
+    def _holders(self, chunk_id, avoid):
+        return [peer for peer, chunks in self.peers.items() if chunks[chunk_id] and peer not in avoid]
+
+    def schedule(self, count, exclude=(), avoid=(), load=None):
+        """Picks up to `count` of our rarest missing chunks, each with the least loaded peer holding it.
+
+        `exclude` are chunks already in flight, `avoid` peers not to use, and `load` the number of
+        requests already out to each peer; it is updated with the picks.
+        """
+        load = {} if load is None else load
+        exclude = set(exclude)
+        schedule = []
+        with self.lock:
+            for freq in sorted(self.missing):
+                if freq == 0:
+                    continue  # nobody we know of has these
+                while len(schedule) < count:
+                    picked = self.missing[freq].sample(count - len(schedule), exclude)
+                    if not picked:
+                        break
+                    for chunk_id in picked:
+                        exclude.add(chunk_id)
+                        holders = self._holders(chunk_id, avoid)
+                        if holders:
+                            holder = min(holders, key=lambda peer: (load.get(peer, 0), random.random()))
+                            load[holder] = load.get(holder, 0) + 1
+                            schedule.append((chunk_id, holder))
+                if len(schedule) == count:
+                    break
+        return schedule
+
+
+class Link:
+    """Our one-way connection to a peer we gossip with, and the thread that sends over it.
+
+    Messages are queued, so whoever announces chunks (a download, a push being received) never
+    waits on connecting to or sending to a peer. The thread connects when it has something to
+    send and exits, closing the connection, once nothing was queued for LINK_IDLE.
+    """
+
+    def __init__(self, gossip, peer_id):
+        self.gossip = gossip
+        self.peer_id = peer_id
+        self.outbox = queue.Queue()  # (msg type, index, payload) waiting to be sent
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        sock = None
+        try:
+            while True:
+                try:
+                    msg_type, index, payload = self.outbox.get(timeout=LINK_IDLE)
+                except queue.Empty:
+                    if self.gossip._retire(self):
+                        return
+                    continue
+                if sock is None:
+                    ip, port = self.peer_id.split(':')
+                    sock = socket.create_connection((ip, int(port)), timeout=LINK_TIMEOUT)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                send_frame(sock, msg_type, index, payload)
+        except OSError as e:
+            # Whatever is still queued is dropped with the peer
+            log.info("Stopped gossiping with %s: %s", self.peer_id, e)
+            self.gossip._drop(self.peer_id)
+        finally:
+            if sock is not None:
+                sock.close()
+
+
+class Gossip:
+    """Exchanges bitfields and HAVE announcements directly with the other peers of each torrent.
+
+    We keep a one-way Link to every peer we are gossiping with: for each torrent we send it our
+    bitfield once, then HAVEs for the chunks we gain. Peers do the same towards us, and their
+    messages come in through the peer server like any other request. The first bitfield from a
+    peer is answered with ours, so joining a swarm only needs the tracker's list of peers.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.views = {}  # file id -> SwarmView
+        self.interested = {}  # file id -> peers we sent our bitfield to
+        self.links = {}  # peer id -> Link
+        self.lock = threading.Lock()
+
+    def view(self, file_id):
+        with self.lock:
+            return self.views.get(file_id)
+
+    def _view(self, torrent):
+        with self.lock:
+            view = self.views.get(torrent.file_id)
+            if view is None:
+                view = self.views[torrent.file_id] = SwarmView(torrent.bitfield)
+                self.interested[torrent.file_id] = set()
+            return view
+
+    def forget(self, file_id):
+        """Drops what we know about a torrent's swarm, when its session is replaced by a new version."""
+        with self.lock:
+            self.views.pop(file_id, None)
+            self.interested.pop(file_id, None)
+
+    def join(self, torrent, peers):
+        """Starts gossiping about a torrent with the given peers, seeded with the bitfields we know for them."""
+        view = self._view(torrent)
+        for peer_id in random.sample(list(peers), min(MAX_PEERS, len(peers))):
+            view.set_peer(peer_id, peers[peer_id])
+            self.send_bitfield(torrent, peer_id)
+
+    def send_bitfield(self, torrent, peer_id):
+        with self.lock:
+            self.interested.setdefault(torrent.file_id, set()).add(peer_id)
+        with torrent.lock:
+            bits = bytes(torrent.bitfield.bits)
+        payload = encode_gossip(self.node.port, torrent.file_id, bits)
+        self._send(peer_id, BITFIELD, len(torrent.bitfield), payload)
+
+    def announce(self, torrent, chunk_ids):
+        """Tells the peers we gossip with about chunks we just got."""
+        view = self.view(torrent.file_id)
+        if view is None or not chunk_ids:
+            return
+        view.we_have(chunk_ids)
+        with self.lock:
+            peers = list(self.interested.get(torrent.file_id, ()))
+        payload = encode_gossip(self.node.port, torrent.file_id, struct.pack(f'!{len(chunk_ids)}I', *chunk_ids))
+        for peer_id in peers:
+            self._send(peer_id, HAVE, len(chunk_ids), payload)
+
+    def on_bitfield(self, ip, num_chunks, payload):
+        port, file_id, bits = decode_gossip(payload)
+        torrent = self.node.get_torrent(file_id)
+        if torrent is None or num_chunks != len(torrent.bitfield):
+            return
+        peer_id = f"{ip}:{port}"
+        view = self._view(torrent)
+        with view.lock:
+            new = peer_id not in view.peers
+        view.set_peer(peer_id, Bitfield.from_bytes(num_chunks, bits))
+        # A peer we hear from for the first time may not know what we have yet
+        if new:
+            self.send_bitfield(torrent, peer_id)
+
+    def on_have(self, ip, payload):
+        port, file_id, body = decode_gossip(payload)
+        view = self.view(file_id)
+        if view is not None:
+            view.peer_has(f"{ip}:{port}", struct.unpack(f'!{len(body) // 4}I', body))
+
+    def _send(self, peer_id, msg_type, index, payload):
+        with self.lock:
+            link = self.links.get(peer_id)
+            if link is None:
+                link = self.links[peer_id] = Link(self, peer_id)
+                link.thread.start()
+            link.outbox.put((msg_type, index, payload))
+
+    def _retire(self, link):
+        """Lets an idle link's thread exit, unless a message was queued for it meanwhile."""
+        with self.lock:
+            if not link.outbox.empty():
+                return False
+            if self.links.get(link.peer_id) is link:
+                del self.links[link.peer_id]
+            return True
+
+    def _drop(self, peer_id):
+        """Forgets a peer we can't reach, so it is no longer picked to serve chunks."""
+        with self.lock:
+            self.links.pop(peer_id, None)
+            views = list(self.views.values())
+            for peers in self.interested.values():
+                peers.discard(peer_id)
+        for view in views:
+            view.drop_peer(peer_id)
@@ -0,0 +1,40 @@
+import random
+
+
+class IndexedSet:
+    """A set that can also hand out random members in O(1) each."""
+    def __init__(self, items=()):
+        self.items = list(dict.fromkeys(items))
+        self.positions = dict(zip(self.items, range(len(self.items))))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def add(self, item):
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        position = self.positions.pop(item, None)
+        if position is None:
+            return
+        last = self.items.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.positions[last] = position
+
+    def sample(self, count, exclude=()):
+        """Returns up to `count` distinct random members that are not in `exclude`."""
+        if len(self.items) > 2 * (len(exclude) + count):
+            picked = set()
+            while len(picked) < count:
+                item = random.choice(self.items)
+                if item not in exclude:
+                    picked.add(item)
+            return list(picked)
+        candidates = [item for item in self.items if item not in exclude]
+        return random.sample(candidates, min(count, len(candidates)))
@@ -0,0 +1,295 @@
+import json
+import logging
+import os
+import shutil
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from bitfield import Bitfield
+
+log = logging.getLogger(__name__)
+
+# Record kinds: each is a tracker operation that changed what it knows
+REGISTER = 1  # a node registered: its id
+EXPIRE = 2  # a node was dropped from the registry: its id
+INITIALIZE = 3  # a file was (re)initialized: its metadata and every node's bitfield
+UPDATE = 4  # a node reported chunks: file id, node id and the chunk ids
+REPLACE = 5  # a node replaced its bitfield: file id, node id and the bitfield
+REMOVE = 6  # a dropped node was taken out of a file: file id and node id
+
+RECORD = struct.Struct('!BII')  # kind, payload length, crc32 of the payload
+LENGTH = struct.Struct('!I')
+STRING = struct.Struct('!H')
+SNAPSHOT_MAGIC = b'TRKSNAP1'
+WAL_NAME = 'tracker.wal'
+OLD_WAL_NAME = 'tracker.wal.old'  # the log a snapshot in progress replaces
+SNAPSHOT_NAME = 'tracker.snapshot'
+SNAPSHOT_BYTES = 8 * 1024 * 1024  # log size at which a snapshot is taken in the background
+
+
+def pack_strings(*strings):
+    parts = []
+    for string in strings:
+        data = string.encode()
+        parts.append(STRING.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+def unpack_strings(payload, count, offset=0):
+    """Returns `count` strings packed at `offset`, and the offset after them."""
+    strings = []
+    for _ in range(count):
+        (size,) = STRING.unpack_from(payload, offset)
+        offset += STRING.size
+        strings.append(bytes(payload[offset:offset + size]).decode())
+        offset += size
+    return strings, offset
+
+
+def pack_chunk_ids(chunk_ids):
+    ids = array('I', chunk_ids)
+    if sys.byteorder == 'little':
+        ids.byteswap()  # stored big-endian like the rest of the record
+    return ids.tobytes()
+
+
+def unpack_chunk_ids(data):
+    ids = array('I')
+    ids.frombytes(data)
+    if sys.byteorder == 'little':
+        ids.byteswap()
+    return ids
+
+
+def encode_initialize(file_id, num_chunks, chunk_data, metadata):
+    """A file's metadata as JSON, then the packed bitfield of every node in it, back to back."""
+    header = json.dumps({"file_id": file_id, "num_chunks": num_chunks, "metadata": metadata,
+                         "nodes": list(chunk_data)}).encode()
+    return b''.join([LENGTH.pack(len(header)), header] + [bytes(chunks.bits) for chunks in chunk_data.values()])
+
+
+def decode_initialize(payload):
+    (size,) = LENGTH.unpack_from(payload)
+    header = json.loads(bytes(payload[LENGTH.size:LENGTH.size + size]))
+    num_chunks = header["num_chunks"]
+    width = (num_chunks + 7) // 8
+    offset = LENGTH.size + size
+    chunk_data = {}
+    for node_id in header["nodes"]:
+        chunk_data[node_id] = Bitfield.from_bytes(num_chunks, payload[offset:offset + width])
+        offset += width
+    return header["file_id"], num_chunks, chunk_data, header["metadata"]
+
+
+class Replay:
+    """The state a sequence of records describes: the registered nodes, and every file's bitfields.
+
+    Records only set bits and swap bitfields here, which is cheap, and the tracker's indexes are
+    built once at the end from the result, instead of being updated record by record. A record for a
+    file the state doesn't have is skipped, and a report from a node a file doesn't list adds it,
+    rather than keeping the tracker from starting.
+    """
+
+    def __init__(self):
+        self.nodes = {}  # node id -> None, in registration order
+        self.files = {}  # file id -> (num chunks, node id -> Bitfield, metadata)
+
+    def apply(self, kind, payload):
+        if kind == REGISTER:
+            self.nodes[bytes(payload).decode()] = None
+        elif kind == EXPIRE:
+            self.nodes.pop(bytes(payload).decode(), None)
+        elif kind == INITIALIZE:
+            file_id, num_chunks, chunk_data, metadata = decode_initialize(payload)
+            self.files[file_id] = (num_chunks, chunk_data, metadata)
+        elif kind == UPDATE:
+            (file_id, node_id), offset = unpack_strings(payload, 2)
+            if file_id not in self.files:
+                return
+            num_chunks, chunk_data, _ = self.files[file_id]
+            chunks = chunk_data.setdefault(node_id, Bitfield(num_chunks))
+            for chunk_id in unpack_chunk_ids(payload[offset:]):
+                if chunk_id < num_chunks:
+                    chunks[chunk_id] = 1
+        elif kind == REPLACE:
+            (file_id, node_id), offset = unpack_strings(payload, 2)
+            if file_id not in self.files:
+                return
+            num_chunks, chunk_data, _ = self.files[file_id]
+            chunk_data[node_id] = Bitfield.from_bytes(num_chunks, payload[offset:])
+        elif kind == REMOVE:
+            (file_id, node_id), _ = unpack_strings(payload, 2)
+            if file_id in self.files:
+                self.files[file_id][1].pop(node_id, None)
+        else:
+            raise ValueError(f"Unknown journal record kind {kind}")
+
+    def load(self, tracker):
+        for node_id in self.nodes:
+            tracker.register_peer(node_id)
+        for file_id, (num_chunks, chunk_data, metadata) in self.files.items():
+            tracker.initialize_chunks(file_id, num_chunks, chunk_data, metadata)
+
+
+def read_records(path, offset=0):
+    """Yields (kind, payload, offset after the record) for every intact record of a file.
+
+    Reading stops at the first torn or corrupt record, which a crash mid-write leaves at the end.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = memoryview(f.read())
+    except FileNotFoundError:
+        return
+    while offset + RECORD.size <= len(data):
+        kind, length, crc = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            log.warning("Ignoring a torn record at offset %d of %s", offset, path)
+            return
+        offset = start + length
+        yield kind, payload, offset
+
+
+def pack_record(kind, payload):
+    return RECORD.pack(kind, len(payload), zlib.crc32(payload)) + payload
+
+
+class Journal:
+    """Makes a Tracker's state survive restarts: an append-only log of its operations, plus snapshots.
+
+    Every operation that changes what the tracker knows (registrations, expiries, files, chunk
+    reports, expired nodes leaving a file) is appended to the log as a binary record, while the tracker still holds the lock it
+    changed the state under, so records of one file are in the order they were applied. Leases,
+    liveness and reported rates aren't kept: they are rebuilt within seconds by the nodes' own
+    traffic. Records are flushed to the OS as they are written, so a crashed tracker loses nothing
+    the machine didn't lose too.
+
+    Once the log reaches `snapshot_bytes`, it is swapped for an empty one and the whole state is
+    written in the background as a snapshot: a REGISTER record per node and an INITIALIZE record
+    per file, which is as small as the state gets. Restoring reads the snapshot, then the old log if
+    a snapshot was cut short, then the current one, into plain bitfields, and builds the tracker's
+    indexes (frequencies, holder lists, rarity buckets) from them once. Replaying a record the
+    snapshot already reflects leaves the state unchanged, so nothing stops while a snapshot is taken.
+    """
+
+    def __init__(self, directory, snapshot_bytes=SNAPSHOT_BYTES):
+        self.directory = directory
+        self.snapshot_bytes = snapshot_bytes
+        self.wal_path = os.path.join(directory, WAL_NAME)
+        self.old_wal_path = os.path.join(directory, OLD_WAL_NAME)
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_NAME)
+        self.wal = None
+        self.size = 0
+        self.snapshotting = False
+        self.lock = threading.Lock()
+
+    def open(self, tracker):
+        """Restores the tracker from the directory, then logs its operations from here on."""
+        os.makedirs(self.directory, exist_ok=True)
+        self.tracker = tracker
+        replay = Replay()
+        records = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                    raise ValueError(f"{self.snapshot_path} is not a tracker snapshot")
+            records += self.replay(replay, self.snapshot_path, len(SNAPSHOT_MAGIC))[0]
+        unfinished = os.path.exists(self.old_wal_path)
+        if unfinished:
+            count, end = self.replay(replay, self.old_wal_path)
+            os.truncate(self.old_wal_path, end)  # so the log can be appended to it by the next snapshot
+            records += count
+        count, end = self.replay(replay, self.wal_path)
+        records += count
+        replay.load(tracker)
+        log.info("Restored tracker state from %d records", records)
+        self.wal = open(self.wal_path, 'ab')
+        self.wal.truncate(end)  # drop a torn record at the end, so new ones don't land behind it
+        self.size = end
+        tracker.journal = self
+        if unfinished or self.size >= self.snapshot_bytes:
+            self.snapshotting = True
+            threading.Thread(target=self.snapshot, daemon=True).start()
+
+    def replay(self, replay, path, offset=0):
+        """Applies the records of a file; returns how many, and where the intact ones end."""
+        count, end = 0, offset
+        for kind, payload, end in read_records(path, offset):
+            replay.apply(kind, payload)
+            count += 1
+        return count, end
+
+    def append(self, kind, payload):
+        record = pack_record(kind, payload)
+        with self.lock:
+            self.wal.write(record)
+            self.wal.flush()
+            self.size += len(record)
+            if self.size < self.snapshot_bytes or self.snapshotting:
+                return
+            self.snapshotting = True
+        threading.Thread(target=self.snapshot, daemon=True).start()
+
+    def register(self, node_id):
+        self.append(REGISTER, node_id.encode())
+
+    def expire(self, node_id):
+        self.append(EXPIRE, node_id.encode())
+
+    def remove(self, file_id, node_id):
+        self.append(REMOVE, pack_strings(file_id, node_id))
+
+    def initialize(self, file_id, num_chunks, chunk_data, metadata):
+        self.append(INITIALIZE, encode_initialize(file_id, num_chunks, chunk_data, metadata))
+
+    def update(self, file_id, node_id, chunk_ids):
+        self.append(UPDATE, pack_strings(file_id, node_id) + pack_chunk_ids(chunk_ids))
+
+    def replace(self, file_id, node_id, chunks):
+        self.append(REPLACE, pack_strings(file_id, node_id) + bytes(chunks.bits))
+
+    def snapshot(self):
+        """Writes the tracker's whole state to the snapshot file and drops the log it replaces."""
+        try:
+            with self.lock:
+                self.snapshotting = True
+                self.wal.close()
+                if os.path.exists(self.old_wal_path):
+                    # A snapshot didn't finish, so the log before this one isn't covered by any yet
+                    with open(self.old_wal_path, 'ab') as old, open(self.wal_path, 'rb') as wal:
+                        shutil.copyfileobj(wal, old)
+                    os.remove(self.wal_path)
+                else:
+                    os.replace(self.wal_path, self.old_wal_path)
+                self.wal = open(self.wal_path, 'ab')
+                self.size = 0
+            tmp_path = self.snapshot_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(SNAPSHOT_MAGIC)
+                for node_id in self.tracker.get_peers(expire=False):
+                    f.write(pack_record(REGISTER, node_id.encode()))
+                for file_id in list(self.tracker.metadata):
+                    state = self.tracker.copy_file_state(file_id)
+                    if state is not None:
+                        f.write(pack_record(INITIALIZE, encode_initialize(file_id, *state)))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            os.remove(self.old_wal_path)
+            log.info("Wrote a tracker snapshot of %d bytes", os.path.getsize(self.snapshot_path))
+        except OSError as e:
+            log.error("Error writing a tracker snapshot: %s", e)
+        finally:
+            with self.lock:
+                self.snapshotting = False
+
+    def close(self):
+        with self.lock:
+            if self.wal is not None:
+                self.wal.close()
+                self.wal = None
@@ -1,77 +1,149 @@
+import collections
+import logging
+import queue
 import socket
 import threading
 import os
-import traceback
 import time
 import requests
-from file_utils import chunk_file, reassemble_file, compute_sha256
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import compression
+import metrics
+from bitfield import Bitfield
+from downloader import Downloader
+from file_utils import ChunkStore, ChunkCache, chunk_file, reassemble_file, hash_store, verify_chunk
+from gossip import Gossip
+from peer_server import PeerServer, DETACHED
+from protocol import (PUSH, ACK, GET_CHUNK, QDOWNLOAD, ERROR, END, BITFIELD, HAVE, DEFAULT_WINDOW, send_frame,
+                      recv_frame, expect_frame, send_encoded_block, send_chunk_frames, recv_header, recv_block_body,
+                      encode_push, decode_push, decode_get_chunk, encode_qdownload, decode_qdownload, ack_interval,
+                      wire_size)
+from ratelimit import RateLimiter, UPLOAD, DOWNLOAD
+from ring import HashRing
+from torrent import Torrent, SessionLog
 
-CHUNK_SIZE = 512  # Size of each chunk
 BASEURL = "http://localhost:8080"
+# Comma-separated base URLs of tracker shards that split the files between them, used instead of BASEURL
+TRACKER_SHARDS = os.environ.get('TRACKER_SHARDS')
+HASH_WORKERS = max(2, os.cpu_count() or 1)
+TRACKER_CONNECTIONS = 16  # keep-alive connections to the tracker shared by all of a node's threads
+CHECKPOINT_BATCH = 32  # chunks received in a push between session log checkpoints
+CHUNK_CACHE_BYTES = 512 * 1024 * 1024  # disk space for chunks kept by hash across files, 0 to disable
+STATS_INTERVAL = 5  # seconds between reports of our transfer rates to the tracker
+# Port to serve GET /metrics on over HTTP, 0 for any free one (logged), unset to not serve metrics
+METRICS_PORT = os.environ.get('NODE_METRICS_PORT')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')  # DEBUG also logs every chunk
+UPLOAD_RATE = 0  # bytes/s the node may upload in total, 0 for unlimited
+DOWNLOAD_RATE = 0  # bytes/s the node may download in total, 0 for unlimited
+
+log = logging.getLogger(__name__)
 
 class ChunkSender(threading.Thread):
-    def __init__(self, ip, port, chunks, total_chunks, file_name):
+    """Pushes chunks to one peer, taking them from a queue shared with the senders to the other peers.
+
+    A sender only takes another chunk once its window has room, so each peer ends up with a
+    share of the file proportional to how fast it acknowledges blocks. Chunks that were not
+    fully acknowledged when the connection failed go back on the queue for the other senders.
+    """
+
+    def __init__(self, ip, port, store, chunks, file_name, window=DEFAULT_WINDOW, codecs=compression.NONE,
+                 throttle=None):
         super().__init__()
         self.ip = ip
         self.port = port
+        self.store = store
         self.chunks = chunks
-        self.total_chunks = total_chunks
         self.file_name = file_name
+        self.window = window
+        self.codecs = codecs  # compression codecs we offer the peer
+        self.throttle = throttle  # called with the size of each block before it is sent, to rate limit the push
+        self.sent_chunks = []  # chunks every block of which the peer acknowledged
+        self.sent_bytes = 0
+        self.pending = collections.deque()  # (chunk id, blocks sent once it is done) not yet fully acked
 
     def run(self):
-        """Connects to a peer and sends assigned chunks."""
+        """Connects to a peer and streams blocks of the chunks it takes, keeping up to `window` blocks unacknowledged."""
+        client_socket = None
+        start = time.monotonic()
         try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect((self.ip, self.port))
-            print(f"Connected to peer {self.ip}:{self.port}")
-            client_socket.sendall(self.file_name.encode())
-            time.sleep(0.2)
-
-            # Send the number of chunks assigned to this peer
-            num_chunks = len(self.chunks)
-            chunk_info = str(num_chunks) + "/" + str(self.total_chunks)
-            client_socket.sendall(str(chunk_info).encode())
-
-            # Wait for receiver to be ready
-            ready_signal = client_socket.recv(1024).decode()
-            if ready_signal != "READY":
-                raise Exception("Receiver not ready")
-
-            # Send chunks
-            for i, chunk in self.chunks:
-                chunk_index_bytes = i.to_bytes(4, byteorder='big')
-                chunk_size_bytes = len(chunk).to_bytes(4, byteorder='big')
-                
-                client_socket.sendall(chunk_index_bytes)
-                client_socket.sendall(chunk_size_bytes)
-                client_socket.sendall(chunk)
-                
-                print(f"Sent chunk {i} (size: {len(chunk)} bytes)")
-                
-                ack = client_socket.recv(1024).decode()
-                if ack != "ACK":
-                    print(f"Chunk {i} not acknowledged by peer: {ack}")
+            client_socket = socket.create_connection((self.ip, self.port))
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            log.debug("Connected to peer %s:%s", self.ip, self.port)
+
+            # Announce the file, and learn which compression codec the peer picked
+            store = self.store
+            send_frame(client_socket, PUSH, 0, encode_push(self.file_name, store.file_size, store.piece_size,
+                                                           store.block_size, self.window, self.codecs))
+            _, payload = expect_frame(client_socket, ACK)
+            codec = payload[0] if payload else compression.NONE
+
+            # Send blocks, only blocking on the receiver when the window is full
+            sent = acked = 0
+            while True:
+                try:
+                    chunk_id = self.chunks.get_nowait()
+                except queue.Empty:
                     break
-
-                # self.uploaded_chunks += 1
-                # self.total_uploaded_bytes += len(chunk)
-
-            print(f"File {self.file_name} sent successfully.")
-            # self.uploaded_files += 1
+                blocks = compression.encode_chunk(store, chunk_id, codec)
+                self.pending.append((chunk_id, sent + len(blocks)))
+                for block_id, payload in blocks:
+                    if self.throttle is not None:
+                        self.throttle(wire_size(store, block_id, payload))
+                    send_encoded_block(client_socket, store, block_id, payload)
+                    sent += 1
+                    while sent - acked >= self.window:
+                        acked, _ = expect_frame(client_socket, ACK)
+                        self.settle(acked)
+
+            # Drain the remaining cumulative acks
+            send_frame(client_socket, END, sent)
+            while acked < sent:
+                acked, _ = expect_frame(client_socket, ACK)
+                self.settle(acked)
+
+            elapsed = max(time.monotonic() - start, 1e-6)
+            log.info("File %s sent successfully to %s:%s (%d chunks, %.1f MB/s)", self.file_name, self.ip,
+                     self.port, len(self.sent_chunks), self.sent_bytes / elapsed / 1e6)
         except Exception as e:
-            print(f"Error sending chunks to {self.ip}:{self.port}: {e}")
-            print(traceback.format_exc())
+            log.error("Error sending chunks to %s:%s: %s", self.ip, self.port, e, exc_info=True)
+            for chunk_id, _ in self.pending:
+                self.chunks.put(chunk_id)
         finally:
-            client_socket.close()
+            if client_socket is not None:
+                client_socket.close()
+
+    def settle(self, acked):
+        """Moves the chunks covered by a cumulative ack of `acked` blocks to sent_chunks."""
+        while self.pending and self.pending[0][1] <= acked:
+            chunk_id, _ = self.pending.popleft()
+            self.sent_chunks.append(chunk_id)
+            self.sent_bytes += self.store.chunk_range(chunk_id)[1]
 
 class Node:
-    def __init__(self, port):
-        self.port = port
-        self.chunks = []  # To hold the actual chunks
-        self.bitfield = []  # To track available chunks
-        self.server_thread = threading.Thread(target=self.start_server)
-        self.server_thread.daemon = True  # Daemonize thread to end with main program
-        self.server_thread.start()
+    def __init__(self, port, listen_port=None, metrics_port=None):
+        self.port = port  # the port peers and the tracker know us by
+        # Where the peer server binds, when peers reach it through a port mapping or a proxy
+        self.listen_port = listen_port or port
+        # Where GET /metrics is served, None for METRICS_PORT
+        self.metrics_port = metrics_port if metrics_port is not None else METRICS_PORT
+        self.torrents = {}  # file id -> Torrent, one session per file being seeded or downloaded
+        self.torrents_lock = threading.Lock()
+        # Where to find each chunk hash we hold, across all torrents, and recently downloaded
+        # chunks kept by hash on disk, so data shared between files is never fetched twice
+        self.local_chunks = {}  # chunk hash -> (torrent, chunk id)
+        self.chunk_cache = ChunkCache(os.path.join('chunk_cache', str(port)), CHUNK_CACHE_BYTES)
+        self.hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+        self.codecs = compression.available()  # codecs we accept and offer on the wire, NONE to send raw
+        self.gossip = Gossip(self)  # chunk availability exchanged directly with the other peers
+        self.limiter = RateLimiter(UPLOAD_RATE, DOWNLOAD_RATE)  # shared by pushes, served and fetched chunks
+        # A file's swarm is tracked by one shard, found by hashing its id. Every shard knows every node,
+        # so node-wide calls (registration, heartbeats, failed peers) go to all of them.
+        self.trackers = HashRing(TRACKER_SHARDS.split(',') if TRACKER_SHARDS else [BASEURL])
+        # One pooled keep-alive session for every tracker call, instead of a new connection per call
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=len(self.trackers.shards),
+                                                  pool_maxsize=TRACKER_CONNECTIONS))
         self.uploaded_chunks = 0
         self.downloaded_chunks = 0
         self.uploaded_files = 0
@@ -80,247 +152,622 @@ class Node:
         self.total_downloaded_bytes = 0
         self.successful_connections = 0
         self.failed_connections = 0
+        self.uploads_in_flight = 0
+        self.stats_lock = threading.Lock()
+        self.metrics = metrics.Registry()
+        self.fetch_seconds = self.metrics.histogram(
+            'node_chunk_fetch_seconds', "Time to fetch and verify a chunk from a peer")
+        self.serve_seconds = self.metrics.histogram(
+            'node_chunk_serve_seconds', "Time to send a requested chunk to a peer")
+        self.peer_sent_bytes = self.metrics.counter(
+            'node_peer_sent_bytes_total', "Chunk bytes sent to each peer address", ('peer',))
+        self.peer_received_bytes = self.metrics.counter(
+            'node_peer_received_bytes_total', "Chunk bytes received from each peer address", ('peer',))
+        self.chunk_errors = self.metrics.counter(
+            'node_chunk_errors_total', "Chunk fetches that failed or didn't match their hash", ('reason',))
+        self.cancelled_requests = self.metrics.counter(
+            'node_cancelled_requests_total', "Chunk requests cancelled because another holder sent the chunk first")
+        self.metrics.collect(self.collect_stats)
+        self.server_thread = threading.Thread(target=self.start_server)
+        self.server_thread.daemon = True  # Daemonize thread to end with main program
+        self.server_thread.start()
 
     def start_server(self):
         """Starts a peer server that listens for incoming connections."""
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind(('0.0.0.0', self.port))
-        server_socket.listen(5)
-        
-        url = BASEURL + "/register" 
+        self.server = server = PeerServer(self.listen_port, self.handle_incoming_client)
+        server.listen()
+        self.register()
+
+        if self.metrics_port is not None:
+            try:
+                metrics_server = metrics.serve(self.metrics, int(self.metrics_port))
+                log.info("Serving metrics on port %s", metrics_server.server_address[1])
+            except (OSError, OverflowError, ValueError) as e:
+                # Metrics are optional, the peer server runs without them
+                log.warning("Could not serve metrics on port %s: %s", self.metrics_port, e)
+        threading.Thread(target=self.resume_downloads, daemon=True).start()
+        threading.Thread(target=self.report_stats, daemon=True).start()
+        log.info("Peer listening on port %s", self.listen_port)
+        server.serve_forever()
+
+    def tracker_for(self, file_id):
+        """Base URL of the tracker shard keeping track of a file."""
+        return self.trackers.shard_for(file_id)
+
+    def register(self):
         data = {"port": self.port}
 
         try:
-            response = requests.post(url, json=data)
-            response.raise_for_status()
-            print(f"Node registered successfully with port {self.port}")
+            for tracker in self.trackers.shards:
+                response = self.session.post(tracker + "/register", json=data)
+                response.raise_for_status()
+            log.info("Node registered successfully with port %s", self.port)
+            return True
         except requests.exceptions.RequestException as e:
-            print(f"Error registering node: {e}")
-
-        print(f"Peer listening on port {self.port}...")
+            log.error("Error registering node: %s", e)
+            return False
 
-        while True:
-            conn, addr = server_socket.accept()
-            print(f"Connected by {addr}")
-            threading.Thread(target=self.handle_incoming_client, args=(conn,)).start()
+    def rejoin(self):
+        """Registers again after the tracker dropped us, and tells it again what we hold of every file."""
+        if not self.register():
+            return
+        with self.torrents_lock:
+            torrents = list(self.torrents.values())
+        for torrent in torrents:
+            try:
+                self.announce_chunks(torrent.file_id, torrent.bitfield)
+            except requests.exceptions.RequestException as e:
+                log.warning("Error announcing chunks of %s: %s", torrent.file_id, e)
 
     def handle_incoming_client(self, conn):
-        """Handles messages from incoming connections."""
+        """Handles one message from a peer connection and returns whether to keep the connection open."""
+        return self.handle_safely(self.handle_message, conn)
+
+    def handle_message(self, conn):
+        frame = recv_frame(conn, eof_ok=True)
+        if frame is None:
+            return False
+        msg_type, index, payload = frame
+        if msg_type == GET_CHUNK:
+            if self.limiter.active:
+                # A throttled chunk waits between its blocks, which must not tie up a shared worker
+                return self.detach(conn, self.serve_chunk, index, payload)
+            return self.serve_chunk(conn, index, payload)
+        elif msg_type == BITFIELD:
+            self.gossip.on_bitfield(conn.getpeername()[0], index, payload)
+            return True
+        elif msg_type == HAVE:
+            self.gossip.on_have(conn.getpeername()[0], payload)
+            return True
+        elif msg_type == QDOWNLOAD:
+            # The download outlives the message, so it gets its own thread instead of a server worker
+            threading.Thread(target=self.download_file, args=(payload,), daemon=True).start()
+        elif msg_type == PUSH:
+            # A push lasts until the whole file is in, far too long to hold one of the shared workers
+            return self.detach(conn, self.receive_chunks, payload)
+        else:
+            log.warning("Unknown message type %s", msg_type)
+        return False
+
+    def handle_safely(self, handler, conn, *args):
+        """Runs a request handler, logging what goes wrong, and returns whether to keep the connection open."""
         try:
-            # Receive file name
-            message = conn.recv(1024).decode().strip()
-            if (message.startswith("GET_CHUNK")):
-                request_type, file, chunk_id = message.split(":")
-                chunk_id = int(chunk_id)
-                chunk = self.chunks[chunk_id]
-                chunk_size_bytes = len(chunk).to_bytes(4, byteorder='big')
-                conn.sendall(chunk_size_bytes)
-                conn.sendall(chunk)
-            elif (message.startswith("QDOWNLOAD")):
-                _, file_name, total, original_hash = message.split(":")
-                print("ASKING QDOWNLOAD NOW")
-                total_chunks = int(total)
-                while (self.downloaded_chunks < total_chunks):
-                    self.download_chunk(file_name)
-                new_file = file_name + str(self.port)
-                output_path = os.path.join('received_files', new_file)
-                reassemble_file(self.chunks, output_path, original_hash)
-                print(f"File {file_name} retrieved and reassambled successfully.")
-            else:
-                file_name = message
-                print(f"Receiving file: {file_name}")
-
-                # Receive the number of chunks
-                num_chunks, total_chunks = conn.recv(1024).decode().split("/")
-                num_chunks = int(num_chunks)
-                total_chunks = int(total_chunks)
-                print(f"Expecting {num_chunks} chunks.")
-
-                # Initialize the local bitfield
-                self.bitfield = [0] * total_chunks
-                self.chunks = [None] * total_chunks
-
-                # Send acknowledgment for setup
-                conn.sendall("READY".encode())
-
-                # Receive and process chunks
-                for i in range(num_chunks):
-                    chunk_index_bytes = conn.recv(4)
-                    chunk_index = int.from_bytes(chunk_index_bytes, byteorder='big')
-                    chunk_size_bytes = conn.recv(4)
-                    chunk_size = int.from_bytes(chunk_size_bytes, byteorder='big')
-                    
-                    chunk_data = b''
-                    while len(chunk_data) < chunk_size:
-                        packet = conn.recv(min(4096, chunk_size - len(chunk_data)))
-                        if not packet:
-                            raise Exception("Connection closed while receiving chunk data")
-                        chunk_data += packet
-
-                    print(f"Received chunk {chunk_index} (size: {chunk_size} bytes)")
-                    print(f"Adding chunk {chunk_index} with value {chunk_data} to chunks")
-                    self.chunks[chunk_index] = chunk_data
-                    self.bitfield[chunk_index] = 1
-                    conn.sendall("ACK".encode())
-
-                    # Update statistics
-                    self.downloaded_chunks += 1
-                    self.total_downloaded_bytes += chunk_size
-
-                # Receive the original hash to verify integrity
-                self.downloaded_files += 1
-
+            return handler(conn, *args)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            # Downloaders hang up on requests they no longer need, such as the losers of an endgame race
+            log.debug("Peer hung up: %s", e)
         except Exception as e:
-            print(f"Error while handling incoming client: {e}")
-            print(traceback.format_exc())
+            log.error("Error while handling incoming client: %s", e, exc_info=True)
             self.failed_connections += 1
+        return False
+
+    def detach(self, conn, handler, *args):
+        """Handles a request on a thread of its own instead of a server worker, for the handler to return.
+
+        `handler` returns whether to keep the connection open, and the thread then hands it back
+        to the peer server.
+        """
+        def run():
+            self.server.release(conn, self.handle_safely(handler, conn, *args))
+        threading.Thread(target=run, daemon=True).start()
+        return DETACHED
+
+    def collect_stats(self):
+        """The node's running totals, as metrics."""
+        with self.torrents_lock:
+            torrents = len(self.torrents)
+        return [
+            ('node_uploaded_chunks_total', 'counter', "Chunks uploaded", self.uploaded_chunks),
+            ('node_downloaded_chunks_total', 'counter', "Chunks downloaded", self.downloaded_chunks),
+            ('node_uploaded_bytes_total', 'counter', "Chunk bytes uploaded", self.total_uploaded_bytes),
+            ('node_downloaded_bytes_total', 'counter', "Chunk bytes downloaded", self.total_downloaded_bytes),
+            ('node_uploaded_files_total', 'counter', "Files uploaded", self.uploaded_files),
+            ('node_downloaded_files_total', 'counter', "Files downloaded and reassembled", self.downloaded_files),
+            ('node_successful_connections_total', 'counter', "Chunk fetches that succeeded", self.successful_connections),
+            ('node_failed_connections_total', 'counter', "Failed peer requests", self.failed_connections),
+            ('node_uploads_in_flight', 'gauge', "Chunks being sent to peers right now", self.uploads_in_flight),
+            ('node_torrents', 'gauge', "Files being seeded or downloaded", torrents),
+        ]
+
+    def set_rate_limit(self, direction, rate, file_id=None, peer=None):
+        """Limits uploads or downloads to `rate` bytes/s, for the whole node or one torrent or peer address.
+
+        A rate of 0 removes the limit. Transfers already under way follow the new limit right away.
+        """
+        self.limiter.set_limit(direction, rate, file_id, peer)
+        log.info("Rate limits: %s", self.limiter.limits())
+
+    def get_torrent(self, file_id):
+        with self.torrents_lock:
+            return self.torrents.get(file_id)
+
+    def add_torrent(self, torrent):
+        """Registers a torrent session, returning the existing one if the file already has a session."""
+        with self.torrents_lock:
+            return self.torrents.setdefault(torrent.file_id, torrent)
+
+    def replace_torrent(self, torrent):
+        """Makes a torrent the file's session, retiring the session of an older version it replaces."""
+        with self.torrents_lock:
+            old = self._forget_torrent(torrent.file_id)
+            self.torrents[torrent.file_id] = torrent
+        if old is not None:
+            self.close_torrent(old)
+
+    def _forget_torrent(self, file_id):
+        """Unregisters a file's session and the local chunks it offered, under torrents_lock."""
+        old = self.torrents.pop(file_id, None)
+        if old is not None:
+            self.local_chunks = {chunk_hash: found for chunk_hash, found in self.local_chunks.items()
+                                 if found[0] is not old}
+        return old
+
+    def close_torrent(self, torrent):
+        """Closes a session that is no longer registered, dropping its session log if it has one."""
+        self.gossip.forget(torrent.file_id)
+        if torrent.log is not None:
+            session_log, torrent.log = torrent.log, None
+            session_log.remove()
+        try:
+            torrent.store.close()
+        except BufferError:
+            # A chunk of it is still being sent; the mapping is closed once nothing uses it
+            log.debug("Store of %s still in use, leaving it to be closed later", torrent.file_id)
+
+    def index_chunks(self, torrent, chunk_ids):
+        """Records that these chunks of a torrent can be copied into other torrents with the same data."""
+        with self.torrents_lock:
+            for chunk_id in chunk_ids:
+                self.local_chunks.setdefault(torrent.piece_hashes[chunk_id], (torrent, chunk_id))
+
+    def find_local_chunk(self, chunk_hash):
+        """Returns the data of a chunk with this hash from any torrent or the chunk cache, or None."""
+        with self.torrents_lock:
+            found = self.local_chunks.get(chunk_hash)
+        if found is not None:
+            torrent, chunk_id = found
+            return torrent.store.read_chunk(chunk_id)
+        return self.chunk_cache.get(chunk_hash)
+
+    def serve_chunk(self, conn, chunk_id, payload):
+        """Answers a GET_CHUNK request with the blocks of the chunk from the named file.
+
+        Returns True: the connection stays open for the peer's next request.
+        """
+        file, codecs = decode_get_chunk(payload)
+        torrent = self.get_torrent(file)
+        if torrent is None or not torrent.has_chunk(chunk_id):
+            send_frame(conn, ERROR, chunk_id, f"No chunk {chunk_id} of {file}".encode())
+            return True
+        peer = conn.getpeername()[0]
+        start = time.perf_counter()
+        with self.stats_lock:
+            self.uploads_in_flight += 1
+        try:
+            send_chunk_frames(conn, torrent.store, chunk_id, compression.choose(codecs & self.codecs),
+                              self.limiter.throttler(UPLOAD, file, peer))
         finally:
-            conn.close()
-
-    def upload(self, file):
-        """Connects to multiple peers to upload a file in chunks."""
-        print(f"Starting upload process for file: {file}")
-        url = BASEURL + "/peers" 
+            with self.stats_lock:
+                self.uploads_in_flight -= 1
+        torrent.mark_sent(chunk_id)
+        chunk_size = torrent.store.chunk_range(chunk_id)[1]
+        with self.stats_lock:
+            self.uploaded_chunks += 1
+            self.total_uploaded_bytes += chunk_size
+        self.serve_seconds.observe(time.perf_counter() - start)
+        self.peer_sent_bytes.inc(chunk_size, (peer,))
+        return True
+
+    def download_file(self, payload):
+        """Downloads the file announced by a QDOWNLOAD message from the other peers."""
+        try:
+            file_name, file_size, piece_size, block_size, original_hash = decode_qdownload(payload)
+            log.info("Asked to download %s", file_name)
+            torrent = self.open_download(file_name, file_size, piece_size, block_size)
+            if torrent.log is not None:
+                torrent.log.record(original_hash=original_hash)
+            self.download(torrent, original_hash)
+        except Exception as e:
+            log.error("Error while downloading: %s", e, exc_info=True)
+
+    def download(self, torrent, original_hash):
+        """Fetches the chunks of a torrent we are missing, then puts the file together."""
+        file_name = torrent.file_id
+        with torrent.lock:
+            if torrent.downloader is not None:
+                log.info("Already downloading %s", file_name)
+                return
+            torrent.downloader = Downloader(self, torrent)
+        try:
+            # Chunks pushed to us before we had the hash manifest haven't been checked yet
+            unverified = [] if torrent.piece_hashes else list(torrent.bitfield.set_bits())
+            metadata, peers = self.fetch_torrent_data(file_name)
+            torrent.piece_hashes = metadata["piece_hashes"]
+            if unverified:
+                self.verify_held_chunks(torrent, unverified)
+            self.index_chunks(torrent, list(torrent.bitfield.set_bits()))
+            if not torrent.complete():
+                self.gossip.join(torrent, peers)
+                torrent.downloader.run()
+        finally:
+            torrent.downloader = None
+        new_file = os.path.basename(file_name) + str(self.port)
+        output_path = os.path.join('received_files', new_file)
+        reassemble_file(torrent.store, output_path, original_hash)
+        if torrent.log is not None:
+            session_log, torrent.log = torrent.log, None
+            session_log.remove()
+        self.downloaded_files += 1
+        log.info("File %s retrieved and reassembled successfully", file_name)
+
+    def verify_held_chunks(self, torrent, chunk_ids):
+        """Checks chunks we hold against the torrent's hashes, and drops the ones that don't match.
+
+        The checks run on the hash pool, like those of a resumed download. If any fail, the tracker
+        gets our corrected bitfield, since the uploader told it we had them.
+        """
+        checks = {chunk_id: self.hash_pool.submit(verify_chunk, torrent.store, chunk_id, torrent.piece_hashes[chunk_id])
+                  for chunk_id in chunk_ids}
+        bad = [chunk_id for chunk_id, check in checks.items() if not check.result()]
+        if not bad:
+            return
+        log.warning("%d chunks of %s pushed to us failed verification, fetching them again", len(bad), torrent.file_id)
+        self.chunk_errors.inc(len(bad), ('verify',))
+        torrent.discard(bad)
+        try:
+            self.announce_chunks(torrent.file_id, torrent.bitfield)
+        except requests.exceptions.RequestException as e:
+            log.warning("Error announcing chunks of %s: %s", torrent.file_id, e)
+
+    def open_download(self, file_name, file_size, piece_size, block_size):
+        """Returns the session of a file we are receiving, starting one with a preallocated partial file if needed.
+
+        An unfinished download of a file with the same layout is carried on, as when a push is
+        followed by the QDOWNLOAD for it. Any other session for the file id, one we seed or a
+        download that finished, is of an older version: it is closed, and the new version gets a
+        fresh store, bitfield and session log.
+        """
+        with self.torrents_lock:
+            old = self.torrents.get(file_name)
+            if old is not None:
+                store = old.store
+                if old.log is not None and (store.file_size, store.piece_size, store.block_size) == \
+                        (file_size, piece_size, block_size):
+                    return old
+                self._forget_torrent(file_name)
+                log.info("Replacing our session of %s with a new version", file_name)
+                self.close_torrent(old)  # before the new store takes over its partial file
+            path = self.partial_path(file_name)
+            store = ChunkStore.create(path, file_size, piece_size, block_size)
+            torrent = Torrent(file_name, store)
+            torrent.log = SessionLog.create(path + '.log', file_name, store)
+            self.torrents[file_name] = torrent
+            return torrent
+
+    def resume_downloads(self):
+        """Picks up the downloads an earlier run of this node left unfinished in received_files."""
+        if not os.path.isdir('received_files'):
+            return
+        for name in os.listdir('received_files'):
+            if name.endswith('.part.log'):
+                try:
+                    self.resume_download(os.path.join('received_files', name))
+                except Exception as e:
+                    log.error("Error resuming %s: %s", name, e, exc_info=True)
+
+    def resume_download(self, log_path):
+        header, logged, original_hash = SessionLog.read(log_path)
+        file_name = header["file_id"]
+        path = self.partial_path(file_name)
+        if path + '.log' != log_path or not os.path.exists(path) or self.get_torrent(file_name) is not None:
+            return  # another node's download, or one already under way
+        store = ChunkStore.create(path, header["file_size"], header["piece_size"], header["block_size"])
+        torrent = Torrent(file_name, store)
+        torrent.piece_hashes = self.fetch_metadata(file_name)["piece_hashes"]
+
+        # Only trust chunks that still match their hash. hashlib releases the GIL, so the pool
+        # checks them in parallel.
+        checks = {chunk_id: self.hash_pool.submit(verify_chunk, store, chunk_id, torrent.piece_hashes[chunk_id])
+                  for chunk_id in logged if 0 <= chunk_id < store.num_chunks}
+        torrent.restore([chunk_id for chunk_id, check in checks.items() if check.result()])
+        torrent.log = SessionLog(log_path)
+        torrent = self.add_torrent(torrent)
+        log.info("Resuming %s: %d of %d chunks verified on disk", file_name, torrent.have, store.num_chunks)
+
+        # Tell the tracker exactly what we hold now, replacing whatever it had from before the restart
+        self.announce_chunks(file_name, torrent.bitfield)
+        self.index_chunks(torrent, list(torrent.bitfield.set_bits()))
+        if original_hash is not None:
+            self.download(torrent, original_hash)
+
+    def receive_chunks(self, conn, payload):
+        """Receives a chunk push from an uploader, acking cumulatively so the sender never waits per block."""
+        file_name, file_size, piece_size, block_size, window, codecs = decode_push(payload)
+        log.info("Receiving file %s", file_name)
+        send_frame(conn, ACK, 0, bytes([compression.choose(codecs & self.codecs)]))
+
+        # Start a session for the file, preallocating the file the chunks are written into
+        torrent = self.open_download(file_name, file_size, piece_size, block_size)
+        store = torrent.store
+
+        peer = conn.getpeername()[0]
+        throttle = self.limiter.throttler(DOWNLOAD, file_name, peer)
+        interval = ack_interval(window)
+        missing_blocks = {}  # blocks still outstanding for each partially received chunk
+        completed = []  # received chunks not checkpointed yet
+        received = received_bytes = 0
+        while True:
+            msg_type, block_id, length = recv_header(conn)
+            if msg_type == END:
+                break
+            throttle(length)
+            recv_block_body(conn, store, msg_type, block_id, length)
+            received += 1
+            received_bytes += store.block_range(block_id)[1]
+            chunk_index = store.chunk_of_block(block_id)
+            missing = missing_blocks.get(chunk_index, len(store.blocks_in_chunk(chunk_index))) - 1
+            missing_blocks[chunk_index] = missing
+            if missing == 0:
+                del missing_blocks[chunk_index]
+                if torrent.mark_have(chunk_index):
+                    completed.append(chunk_index)
+                    # Update statistics
+                    self.downloaded_chunks += 1
+                    self.total_downloaded_bytes += store.chunk_range(chunk_index)[1]
+                if len(completed) >= CHECKPOINT_BATCH:
+                    torrent.checkpoint(completed)
+                    self.gossip.announce(torrent, completed)
+                    completed = []
+
+            if received % interval == 0:
+                send_frame(conn, ACK, received)
+        torrent.checkpoint(completed)
+        self.gossip.announce(torrent, completed)
+        if received % interval:
+            send_frame(conn, ACK, received)
+
+        self.peer_received_bytes.inc(received_bytes, (peer,))
+        log.info("Received %d blocks of %s", received, file_name)
+        return False  # a push is the last request on its connection
+
+    def partial_path(self, file_name):
+        """Where chunks of a file being received are written until it is complete."""
+        return os.path.join('received_files', os.path.basename(file_name) + str(self.port) + '.part')
+
+    def upload(self, file, piece_size=None):
+        """Connects to multiple peers to upload a file in chunks.
+
+        The piece (chunk) size is picked from the file size unless one is given.
+        """
+        log.info("Starting upload of %s", file)
+        url = self.tracker_for(file) + "/peers" 
         data = {"port": self.port}
 
         try:
-            response = requests.get(url, json=data)
+            response = self.session.get(url, json=data)
             data = response.json()
             nodes = data["available_peers"]
              
             response.raise_for_status()
-            print(f"Node registered successfully with port {self.port}")
-            print(f"Available peers: {nodes}")
+            log.info("Available peers: %s", nodes)
         except requests.exceptions.RequestException as e:
-            print(f"Error registering node: {e}")
+            log.error("Error getting the peer list: %s", e)
             return
 
         # Chunk the file and store chunks
-        print(f"Chunking file: {file}")
-        chunks = chunk_file(file)
-        self.chunks = chunks
-        num_chunks = len(chunks)
-        print(f"File chunked into {num_chunks} chunks")
+        log.debug("Chunking file %s", file)
+        store = chunk_file(file, piece_size)
+        torrent = Torrent(file, store, complete=True)
+        self.replace_torrent(torrent)
+        num_chunks = store.num_chunks
+        log.info("File chunked into %d chunks of %d bytes", num_chunks, store.piece_size)
+
+        # Hash the file and its chunks in one background pass while the chunks are being sent
+        hashes = self.hash_pool.submit(hash_store, store)
 
-        # Prepare peers for round-robin sending
         num_peers = len(nodes)
         if num_peers == 0:
-            print("No peers available for sending.")
+            log.warning("No peers available for sending")
             return
 
-        chunk_block_sz = num_chunks // num_peers
-        # Create a connection for each peer and keep it open
+        # Every sender takes chunks from the same queue, so faster peers take more of them
+        unsent = queue.Queue()
+        for chunk_id in range(num_chunks):
+            unsent.put(chunk_id)
         threads = []
-        chunk_data = {}
-        for i, peer in enumerate(nodes):
+        for peer in nodes:
             peer_ip, peer_port = peer.split(":")
-            chunk_data[peer] = [0 for j in range(num_chunks)]
-            for j in range(i * chunk_block_sz, min(num_chunks, ((i+1) * chunk_block_sz))):
-                chunk_data[peer][j] = 1
-            assigned_chunks = [(j, chunks[j]) for j in range(i * chunk_block_sz, min(num_chunks, ((i+1) * chunk_block_sz)))]
-            thread = ChunkSender(peer_ip, int(peer_port), assigned_chunks, num_chunks, file)
+            thread = ChunkSender(peer_ip, int(peer_port), store, unsent, file, codecs=self.codecs,
+                                 throttle=self.limiter.throttler(UPLOAD, file, peer_ip))
             thread.start()
             threads.append(thread)
 
         # Wait for all threads to finish
-        for thread in threads:
+        chunk_data = {}
+        for peer, thread in zip(nodes, threads):
             thread.join()
-        print("all chunks sent successfully")
-        
-        print("chunk_data", chunk_data)
-        url = BASEURL + "/initialize_chunks" 
-        data = {"file_id": file,  "file_size": num_chunks, "chunk_data": chunk_data}
+            with self.stats_lock:
+                self.uploaded_chunks += len(thread.sent_chunks)
+                self.total_uploaded_bytes += thread.sent_bytes
+            self.peer_sent_bytes.inc(thread.sent_bytes, (thread.ip,))
+            chunk_data[peer] = Bitfield(num_chunks)
+            for chunk_id in thread.sent_chunks:
+                chunk_data[peer][chunk_id] = 1
+        if unsent.empty():
+            log.info("All chunks sent successfully")
+        else:
+            log.warning("%d chunks could not be pushed, peers will fetch them from this node", unsent.qsize())
+        log.debug("Chunks pushed per peer: %s", {peer: chunks.count() for peer, chunks in chunk_data.items()})
+        url = self.tracker_for(file) + "/initialize_chunks" 
+        original_hash, torrent.piece_hashes = hashes.result()
+        self.uploaded_files += 1
+        self.index_chunks(torrent, range(num_chunks))
+        chunk_data = {peer: chunks.to_base64() for peer, chunks in chunk_data.items()}
+        data = {"file_id": file,  "file_size": num_chunks, "chunk_data": chunk_data, "port": self.port,
+                "length": store.file_size, "piece_size": store.piece_size, "block_size": store.block_size,
+                "piece_hashes": torrent.piece_hashes}
         try:
-            response = requests.post(url, json=data)
+            response = self.session.post(url, json=data)
             response.raise_for_status()
-            print(f"Torrent initialized")
-            print(f"Available peers: {nodes}")
+            log.info("Torrent initialized")
         except requests.exceptions.RequestException as e:
-            print(f"Error registering node: {e}")
+            log.error("Error initializing the torrent: %s", e)
             return
         
-        original_hash = compute_sha256(file)
+        message = encode_qdownload(file, store.file_size, store.piece_size, store.block_size, original_hash)
 
+        # Let the nodes know everybody is ready; one we can't reach mustn't keep the others from starting
+        unreachable = 0
         for node in nodes:
             ip, port = node.split(":")
             try:
-                client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                client_socket.connect((ip, int(port)))
-                message = "QDOWNLOAD:" + file + ":" + str(num_chunks) + ":" + original_hash
-                client_socket.sendall(message.encode()) # let the nodes know everybody is ready
+                with socket.create_connection((ip, int(port))) as client_socket:
+                    send_frame(client_socket, QDOWNLOAD, 0, message)
             except Exception as e:
-                print("ERROR SENDING MESSAGE: ", e)
-                return 
-            finally:
-                client_socket.close()
-        print(f"File {file} upload completed.")
+                log.error("Error telling %s to download %s: %s", node, file, e)
+                unreachable += 1
+        if unreachable:
+            log.warning("File %s upload completed, but %d of %d peers could not be told to download it",
+                        file, unreachable, num_peers)
+        else:
+            log.info("File %s upload completed", file)
 
     def run(self):
         """Continues allowing peer to initiate outgoing connections."""
         while True:
-            action = input("Do you want to upload a file to another peer? (y/n): ").lower()
+            action = input("Do you want to upload a file to another peer? (y/n, or 'limit' to set a rate limit): ").lower()
             if action == 'y':
                 file_path = input("Enter the file path to upload: ")
                 self.upload(file_path)
+            elif action == 'limit':
+                try:
+                    direction = input(f"Direction ({UPLOAD}/{DOWNLOAD}): ").lower()
+                    rate = int(input("Bytes per second (0 for unlimited): "))
+                    file_id = input("File to limit (empty to limit a peer or the whole node): ") or None
+                    peer = None if file_id else input("Peer address to limit (empty for the whole node): ") or None
+                    self.set_rate_limit(direction, rate, file_id, peer)
+                except ValueError as e:
+                    print(f"Invalid rate limit: {e}")
             else:
                 print("Waiting for incoming connections...")
                 time.sleep(1)  # Add a small delay to prevent busy-waiting
 
-    def download_chunk(self, file_name):
-        # Request chunk information from tracker
-        tracker_url = BASEURL+'/request_chunk'
+    def fetch_metadata(self, file_name):
+        """Gets the piece size and per-chunk hash manifest the uploader published."""
+        response = self.session.get(self.tracker_for(file_name) + '/metadata', json={"file_id": file_name})
+        response.raise_for_status()
+        return response.json()["metadata"]
+
+    def fetch_torrent_data(self, file_name):
+        """Gets a file's metadata and the chunks each other node held when they last told the tracker."""
+        response = self.session.get(self.tracker_for(file_name) + '/torrent_data', json={"file_id": file_name, "port": self.port})
+        response.raise_for_status()
+        info = response.json()
+        num_chunks = len(info["metadata"]["piece_hashes"])
+        peers = {node_id: Bitfield.from_base64(num_chunks, chunks) for node_id, chunks in info["chunk_data"].items()
+                 if node_id != info["node_id"]}
+        return info["metadata"], peers
+
+    def request_chunks(self, file_name, count, skip_chunks=(), skip_nodes=()):
+        """Asks the tracker for up to `count` of the rarest chunks we are missing, as (chunk_id, node, source).
+
+        `source` is None, or the (file, chunk id) with the same data to ask the node for instead.
+        """
+        tracker_url = self.tracker_for(file_name) + '/request_chunks'
 
         data = {
             "file_id": file_name,
-            "port": self.port
+            "port": self.port,
+            "count": count,
+            "skip_chunks": list(skip_chunks),
+            "skip_nodes": list(skip_nodes)
         }
 
-        try:
-            # Request data for that chunk from the tracker
-            response = requests.get(tracker_url, json=data)
-            print(f"Tracker response for chunk : {response.json()}")
-            data = response.json()
-
-            chunk_id = data["chunk_id"]
-            target_node = data["node"]
-
-            # Extract IP and port from target_node
-            target_ip, target_port = target_node.split(':')
-            target_port = int(target_port)
-
-            # Establish connection with the target node
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((target_ip, target_port))
-
-                # Send request for the specific chunk
-                request = f"GET_CHUNK:{file_name}:{chunk_id}"
-                s.sendall(request.encode())
-
-                # Receive chunk size
-                chunk_size_bytes = s.recv(4)
-                chunk_size = int.from_bytes(chunk_size_bytes, byteorder='big')
-
-                # Receive chunk data
-                chunk_data = b''
-                while len(chunk_data) < chunk_size:
-                    packet = s.recv(min(4096, chunk_size - len(chunk_data)))
-                    if not packet:
-                        raise Exception("Connection closed while receiving chunk data")
-                    chunk_data += packet
-                self.chunks[chunk_id] = chunk_data
-                # idk if we need to return it, maybe just append to self_chunklist, then send updated bitmap to tracker.
-                # HOw do we assemble at end? maybe send an arbitrary command to the downloader to check if they have a full bitmap/ some other condition?
-            tracker_url = BASEURL+'/update_chunk'
+        # Request a batch of chunks from the tracker
+        response = self.session.get(tracker_url, json=data)
+        response.raise_for_status()
+        schedule = response.json()["schedule"]
+        log.debug("Tracker assigned %d chunks", len(schedule))
+        return [(entry["chunk_id"], entry["node"],
+                 (entry["source_file"], entry["source_chunk"]) if "source_file" in entry else None)
+                for entry in schedule]
+
+    def report_stats(self):
+        """Tells the tracker how fast we have been uploading and downloading, so it can spread load by it.
+
+        The reports are also our heartbeat: if the tracker dropped us for missing them, we rejoin.
+        """
+        last_time = time.monotonic()
+        last_uploaded, last_downloaded = self.total_uploaded_bytes, self.total_downloaded_bytes
+        while True:
+            time.sleep(STATS_INTERVAL)
+            now = time.monotonic()
+            uploaded, downloaded = self.total_uploaded_bytes, self.total_downloaded_bytes
             data = {
-                "file_id": file_name,
                 "port": self.port,
-                "chunk_id": chunk_id
+                "upload_rate": (uploaded - last_uploaded) / (now - last_time),
+                "download_rate": (downloaded - last_downloaded) / (now - last_time),
+                "uploads_in_flight": self.uploads_in_flight
             }
-            response = requests.post(tracker_url, json=data)
-            print(f"Successfully downloaded chunk {chunk_id} (size: {len(chunk_data)} bytes)")
-            self.downloaded_chunks += 1
-        except Exception as e:
-            print("ERROR: ", e)
+            last_time, last_uploaded, last_downloaded = now, uploaded, downloaded
+            try:
+                for tracker in self.trackers.shards:
+                    response = self.session.post(tracker + '/stats', json=data)
+                    if response.status_code == 404:
+                        log.warning("The tracker at %s no longer knows us, registering again", tracker)
+                        self.rejoin()
+                        break
+                    response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                log.warning("Error reporting stats: %s", e)
+
+    def announce_chunks(self, file_name, bitfield):
+        """Tells the tracker the full set of chunks we hold, replacing what it had for us, in one call."""
+        data = {
+            "file_id": file_name,
+            "port": self.port,
+            "bitfield": bitfield.to_base64(),
+            "replace": True
+        }
+        response = self.session.post(self.tracker_for(file_name) + '/update_chunks', json=data)
+        response.raise_for_status()
+
+    def report_failure(self, node_id):
+        """Tells the tracker we couldn't reach a peer, so it stops handing it out to others too."""
+        for tracker in self.trackers.shards:
+            response = self.session.post(tracker + '/report_failure', json={"port": self.port, "peer": node_id})
+            response.raise_for_status()
+
+    def report_chunks(self, file_name, chunk_ids):
+        """Tells the tracker we now hold these chunks, in a single call."""
+        tracker_url = self.tracker_for(file_name) + '/update_chunks'
+        data = {
+            "file_id": file_name,
+            "port": self.port,
+            "chunk_ids": list(chunk_ids)
+        }
+        response = self.session.post(tracker_url, json=data)
+        response.raise_for_status()
 
 # Ensure the program runs by adding the proper entry point below.
 if __name__ == "__main__":
@@ -330,5 +777,6 @@ if __name__ == "__main__":
     if not os.path.exists('received_files'):
         os.makedirs('received_files')
 
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     peer_instance = Node(peer_port)
     peer_instance.run()
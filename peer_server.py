@@ -0,0 +1,155 @@
+import logging
+import queue
+import selectors
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_CONNECTIONS = 256  # open peer connections a node serves at once
+SERVER_WORKERS = 16  # threads handling requests, shared by all connections
+BACKLOG = 128  # connections the kernel queues while we are at MAX_CONNECTIONS
+PEER_TIMEOUT = 30  # seconds a peer may stall mid-request before it is dropped
+IDLE_TIMEOUT = 60  # seconds an open connection may go without a request before it is closed
+DETACHED = object()  # returned by a handler that passed the connection to a thread of its own
+
+log = logging.getLogger(__name__)
+
+
+class PeerServer:
+    """Serves a node's peer connections from one selector loop and a fixed pool of workers.
+
+    Idle connections wait in the selector, so a downloader can keep one connection open for
+    any number of GET_CHUNK requests without holding a thread. When a connection has a
+    request, it leaves the selector and a worker calls `handler(conn)` to answer that one
+    request. The handler returns whether the connection should stay open; if so the worker
+    hands it back to the loop for the next request. A request that would hold a worker for
+    long can be detached instead: the handler starts a thread for it and returns DETACHED, and
+    that thread calls release() when it is done with the connection. A detached connection
+    still counts towards `max_connections`, which bounds those threads too.
+
+    Once `max_connections` are open the server stops accepting, and new peers wait in the
+    listen backlog until a connection closes. Connections that go `idle_timeout` without a
+    request are closed, so peers that keep links open and forget them don't hold slots for
+    good. A connection only ever has one request being handled, so a peer that pipelines
+    requests can't get ahead of the others.
+    """
+
+    def __init__(self, port, handler, max_connections=MAX_CONNECTIONS, workers=SERVER_WORKERS, backlog=BACKLOG,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.port = port
+        self.handler = handler
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.backlog = backlog
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.selector = selectors.DefaultSelector()
+        self.returned = queue.Queue()  # connections workers are done with, (conn, keep_open)
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.open_connections = 0
+        self.accepting = False
+        self.listener = None
+        self.next_sweep = 0
+
+    def listen(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('0.0.0.0', self.port))
+        self.listener.listen(self.backlog)
+        self.listener.setblocking(False)
+        self.wakeup_recv.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, 'wakeup')
+        self.resume_accepting()
+
+    def serve_forever(self):
+        if self.listener is None:
+            self.listen()
+        # A peer connection's selector data is when it went idle; sweeping a few times per timeout
+        # closes an idle connection at most a quarter of the timeout late
+        sweep_interval = self.idle_timeout / 4
+        while True:
+            for key, _ in self.selector.select(timeout=sweep_interval):
+                if key.data == 'accept':
+                    self.accept()
+                elif key.data == 'wakeup':
+                    self.drain_wakeups()
+                else:
+                    self.selector.unregister(key.fileobj)
+                    self.pool.submit(self.handle, key.fileobj)
+            self.take_back()
+            if time.monotonic() >= self.next_sweep:
+                self.close_idle()
+                self.next_sweep = time.monotonic() + sweep_interval
+
+    def accept(self):
+        while self.open_connections < self.max_connections:
+            try:
+                conn, addr = self.listener.accept()
+            except BlockingIOError:
+                return
+            conn.setblocking(True)
+            conn.settimeout(PEER_TIMEOUT)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.open_connections += 1
+            self.selector.register(conn, selectors.EVENT_READ, time.monotonic())
+        # Leave further peers in the backlog until a connection closes
+        self.pause_accepting()
+
+    def pause_accepting(self):
+        if self.accepting:
+            self.selector.unregister(self.listener)
+            self.accepting = False
+
+    def resume_accepting(self):
+        if not self.accepting:
+            self.selector.register(self.listener, selectors.EVENT_READ, 'accept')
+            self.accepting = True
+
+    def handle(self, conn):
+        """Runs on a worker: answers one request and passes the connection back to the loop."""
+        keep_open = False
+        try:
+            keep_open = self.handler(conn)
+        except Exception as e:
+            log.error("Error while handling incoming client: %s", e, exc_info=True)
+        if keep_open is not DETACHED:
+            self.release(conn, keep_open)
+
+    def release(self, conn, keep_open):
+        """Passes a connection back to the loop, from a worker or the thread it was detached to."""
+        self.returned.put((conn, keep_open))
+        self.wakeup_send.send(b'\0')
+
+    def drain_wakeups(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def take_back(self):
+        while True:
+            try:
+                conn, keep_open = self.returned.get_nowait()
+            except queue.Empty:
+                break
+            if keep_open:
+                self.selector.register(conn, selectors.EVENT_READ, time.monotonic())
+            else:
+                conn.close()
+                self.open_connections -= 1
+        if self.open_connections < self.max_connections:
+            self.resume_accepting()
+
+    def close_idle(self):
+        """Closes the connections that have waited for a request longer than idle_timeout."""
+        cutoff = time.monotonic() - self.idle_timeout
+        idle = [key.fileobj for key in self.selector.get_map().values()
+                if isinstance(key.data, float) and key.data < cutoff]
+        for conn in idle:
+            self.selector.unregister(conn)
+            conn.close()
+            self.open_connections -= 1
+        if idle:
+            log.debug("Closed %d idle peer connections", len(idle))
+            if self.open_connections < self.max_connections:
+                self.resume_accepting()
@@ -0,0 +1,206 @@
+import struct
+from compression import NONE, decompress, encode_chunk
+
+# Every message between peers is a frame: a fixed 9 byte header followed by
+# `length` bytes of payload. The header carries the message type, a chunk
+# index (or counter, depending on the type) and the payload length, so the
+# receiver never has to guess where one message ends and the next begins.
+HEADER = struct.Struct('!BII')
+
+PUSH = 1       # uploader -> peer: start of a chunk push (payload: PUSH_INFO + file name)
+CHUNK = 2      # data for block `index` (blocks are numbered across the whole file)
+ACK = 3        # cumulative ack, `index` = number of blocks received so far
+GET_CHUNK = 4  # request all blocks of chunk `index` (payload: accepted codecs byte + file name)
+QDOWNLOAD = 5  # tell a peer to start downloading (payload: QDOWNLOAD_INFO + hash + file name)
+ERROR = 6      # payload is a utf-8 error message
+END = 7        # uploader -> peer: the push is over, `index` = number of blocks sent
+ZCHUNK = 8     # compressed data for block `index` (payload: codec byte + compressed block)
+BITFIELD = 9   # peer -> peer: the sender's chunks of a file, `index` = number of chunks (payload: GOSSIP_INFO + name + bits)
+HAVE = 10      # peer -> peer: chunks the sender just got (payload: GOSSIP_INFO + name + chunk ids as '!I')
+
+# file_size, piece_size, block_size, window, accepted codecs. The receiver answers with
+# ACK 0 carrying the chosen codec byte before any block is sent.
+PUSH_INFO = struct.Struct('!QIIIB')
+# file_size, piece_size, block_size, length of the hex hash that follows
+QDOWNLOAD_INFO = struct.Struct('!QIIH')
+# port the sender listens on, length of the file name that follows
+GOSSIP_INFO = struct.Struct('!HH')
+
+DEFAULT_WINDOW = 64  # blocks a sender may have in flight before waiting for an ACK
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def recv_exact(sock, size, eof_ok=False):
+    """Reads exactly `size` bytes, regardless of how recv() splits them.
+
+    With `eof_ok`, a connection closed before the first byte returns None instead of raising.
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            if eof_ok and received == 0:
+                return None
+            raise ProtocolError("Connection closed while receiving data")
+        received += n
+    return buf
+
+
+def pack_frame(msg_type, index=0, payload=b''):
+    return HEADER.pack(msg_type, index, len(payload)) + payload
+
+
+def send_frame(sock, msg_type, index=0, payload=b''):
+    sock.sendall(pack_frame(msg_type, index, payload))
+
+
+def send_block_frame(sock, store, block_id):
+    """Sends a CHUNK frame whose payload comes straight from a ChunkStore."""
+    _, length = store.block_range(block_id)
+    sock.sendall(HEADER.pack(CHUNK, block_id, length))
+    store.send_block(sock, block_id)
+
+
+def send_encoded_block(sock, store, block_id, payload):
+    """Sends a block as encode_chunk left it: raw if `payload` is None, else as a ZCHUNK frame."""
+    if payload is None:
+        send_block_frame(sock, store, block_id)
+    else:
+        sock.sendall(HEADER.pack(ZCHUNK, block_id, len(payload)) + payload)
+
+
+def send_chunk_frames(sock, store, chunk_id, codec=NONE, throttle=None):
+    """Sends every block of a chunk back to back, compressed with `codec` where that pays off.
+
+    `throttle`, if given, is called with the size of each block as it goes on the wire, before it is sent.
+    """
+    for block_id, payload in encode_chunk(store, chunk_id, codec):
+        if throttle is not None:
+            throttle(wire_size(store, block_id, payload))
+        send_encoded_block(sock, store, block_id, payload)
+
+
+def wire_size(store, block_id, payload):
+    """Bytes of block data send_encoded_block puts on the wire for a block."""
+    return store.block_range(block_id)[1] if payload is None else len(payload)
+
+
+def recv_block_body(sock, store, msg_type, block_id, length):
+    """Receives the payload of a CHUNK or ZCHUNK frame into its block of a ChunkStore."""
+    if msg_type == CHUNK:
+        store.recv_block(sock, block_id, length)
+    elif msg_type == ZCHUNK:
+        payload = recv_exact(sock, length)
+        store.write_block(block_id, decompress(payload[0], memoryview(payload)[1:], store.block_range(block_id)[1]))
+    else:
+        raise ProtocolError(f"Expected message type {CHUNK}, got {msg_type}")
+
+
+def recv_block_frame(sock, store, shift=0, throttle=None):
+    """Receives a CHUNK or ZCHUNK frame directly into a ChunkStore and returns its block id.
+
+    The block is stored as block `index - shift`, for blocks numbered as in another file.
+    `throttle` is called with the frame's length before its data is read.
+    """
+    msg_type, index, length = recv_header(sock)
+    if msg_type == ERROR:
+        raise ProtocolError(bytes(recv_exact(sock, length)).decode(errors='replace'))
+    if throttle is not None:
+        throttle(length)
+    recv_block_body(sock, store, msg_type, index - shift, length)
+    return index - shift
+
+
+def recv_chunk_frames(sock, store, chunk_id, source_chunk=None, throttle=None):
+    """Receives every block of a chunk, as sent by send_chunk_frames.
+
+    With `source_chunk`, the blocks are those of that chunk in another file with the same
+    content and piece size, and are stored as the blocks of `chunk_id`.
+    """
+    shift = 0 if source_chunk is None else (source_chunk - chunk_id) * store.blocks_per_piece
+    for block_id in store.blocks_in_chunk(chunk_id):
+        got = recv_block_frame(sock, store, shift, throttle)
+        if got != block_id:
+            raise ProtocolError(f"Expected block {block_id} of chunk {chunk_id}, got block {got}")
+
+
+def recv_header(sock, eof_ok=False):
+    """Returns (msg_type, index, length) of the next frame, or None if `eof_ok` and the peer hung up."""
+    header = recv_exact(sock, HEADER.size, eof_ok)
+    if header is None:
+        return None
+    return HEADER.unpack(header)
+
+
+def recv_frame(sock, eof_ok=False):
+    """Returns (msg_type, index, payload) of the next frame, or None if `eof_ok` and the peer hung up."""
+    header = recv_header(sock, eof_ok)
+    if header is None:
+        return None
+    msg_type, index, length = header
+    payload = bytes(recv_exact(sock, length)) if length else b''
+    return msg_type, index, payload
+
+
+def expect_frame(sock, msg_type):
+    """Receives a frame and checks that it has the expected type."""
+    got_type, index, payload = recv_frame(sock)
+    if got_type == ERROR:
+        raise ProtocolError(payload.decode(errors='replace'))
+    if got_type != msg_type:
+        raise ProtocolError(f"Expected message type {msg_type}, got {got_type}")
+    return index, payload
+
+
+def encode_get_chunk(file_name, codecs):
+    return bytes([codecs]) + file_name.encode()
+
+
+def decode_get_chunk(payload):
+    """Returns the file name and accepted codecs of a GET_CHUNK payload."""
+    return payload[1:].decode(), payload[0]
+
+
+def encode_push(file_name, file_size, piece_size, block_size, window, codecs):
+    return PUSH_INFO.pack(file_size, piece_size, block_size, window, codecs) + file_name.encode()
+
+
+def decode_push(payload):
+    file_size, piece_size, block_size, window, codecs = PUSH_INFO.unpack_from(payload)
+    file_name = payload[PUSH_INFO.size:].decode()
+    return file_name, file_size, piece_size, block_size, window, codecs
+
+
+def encode_qdownload(file_name, file_size, piece_size, block_size, original_hash):
+    hash_bytes = original_hash.encode()
+    return QDOWNLOAD_INFO.pack(file_size, piece_size, block_size, len(hash_bytes)) + hash_bytes + file_name.encode()
+
+
+def decode_qdownload(payload):
+    file_size, piece_size, block_size, hash_len = QDOWNLOAD_INFO.unpack_from(payload)
+    start = QDOWNLOAD_INFO.size
+    original_hash = payload[start:start + hash_len].decode()
+    file_name = payload[start + hash_len:].decode()
+    return file_name, file_size, piece_size, block_size, original_hash
+
+
+def ack_interval(window):
+    """How often a receiver should ack so that a sender with `window` never stalls."""
+    return max(1, window // 4)
+
+
+def encode_gossip(port, file_name, body):
+    name = file_name.encode()
+    return GOSSIP_INFO.pack(port, len(name)) + name + body
+
+
+def decode_gossip(payload):
+    """Returns the sender's listening port, the file name and the rest of a BITFIELD or HAVE payload."""
+    port, name_len = GOSSIP_INFO.unpack_from(payload)
+    start = GOSSIP_INFO.size
+    return port, payload[start:start + name_len].decode(), payload[start + name_len:]
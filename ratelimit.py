@@ -0,0 +1,103 @@
+import functools
+import threading
+import time
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+BURST_SECONDS = 0.1  # a bucket holds this much of its rate, so an idle flow can't send a long burst
+MIN_BURST = 64 * 1024  # but at least a few blocks, so low rates don't need a sleep per block
+
+
+class TokenBucket:
+    """A byte rate limit. A rate of 0 means unlimited.
+
+    Taking tokens never blocks: the bucket may go into debt, and the caller is told how long
+    to sleep for its bytes to be covered. A caller arriving while the bucket is in debt waits
+    behind everyone already in it, so flows sharing a bucket are served in turn, one block at
+    a time, whatever path they come from.
+    """
+
+    def __init__(self, rate=0, burst=None):
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.stamp = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate
+            self.burst = burst if burst is not None else max(rate * BURST_SECONDS, MIN_BURST)
+            self.tokens = min(self.tokens, self.burst)
+
+    def reserve(self, nbytes):
+        """Takes `nbytes` worth of tokens and returns how many seconds to wait before sending them."""
+        with self.lock:
+            if not self.rate:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= nbytes
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class RateLimiter:
+    """A node's upload and download limits, for the whole node, per torrent and per peer.
+
+    Every block sent or received passes through throttle(), which waits on the narrowest
+    bucket first: the peer's, then the torrent's, then the node's. A level is only charged once
+    the narrower ones let the block through, so a flow held back by its own limit doesn't use
+    up the node's bandwidth while it waits. Peers are keyed by address. Limits can be changed
+    at any time, including for transfers already under way, and cost nothing while none is set.
+    """
+
+    def __init__(self, upload_rate=0, download_rate=0):
+        self.total = {UPLOAD: TokenBucket(upload_rate), DOWNLOAD: TokenBucket(download_rate)}
+        self.torrents = {}  # (direction, file id) -> TokenBucket
+        self.peers = {}  # (direction, peer address) -> TokenBucket
+        self.lock = threading.Lock()
+        self.active = bool(upload_rate or download_rate)
+
+    def set_limit(self, direction, rate, file_id=None, peer=None):
+        """Sets the bytes/s limit of a direction for the node, or one torrent or peer; 0 removes it."""
+        if direction not in self.total:
+            raise ValueError(f"Unknown direction {direction!r}, expected {UPLOAD!r} or {DOWNLOAD!r}")
+        if file_id is not None and peer is not None:
+            raise ValueError("A limit is set for a torrent or a peer, not both")
+        with self.lock:
+            if file_id is None and peer is None:
+                self.total[direction].set_rate(rate)
+            else:
+                buckets, key = (self.torrents, file_id) if peer is None else (self.peers, peer)
+                if rate:
+                    bucket = buckets.setdefault((direction, key), TokenBucket())
+                    bucket.set_rate(rate)
+                else:
+                    buckets.pop((direction, key), None)
+            self.active = bool(self.torrents or self.peers or any(bucket.rate for bucket in self.total.values()))
+
+    def limits(self):
+        """The limits currently set, for display."""
+        with self.lock:
+            return {
+                "total": {direction: bucket.rate for direction, bucket in self.total.items()},
+                "torrents": {f"{direction} {file_id}": bucket.rate
+                             for (direction, file_id), bucket in self.torrents.items()},
+                "peers": {f"{direction} {peer}": bucket.rate for (direction, peer), bucket in self.peers.items()},
+            }
+
+    def throttle(self, direction, nbytes, file_id=None, peer=None):
+        """Waits until `nbytes` may go through in `direction` for this torrent and peer."""
+        if not self.active:
+            return
+        for bucket in (self.peers.get((direction, peer)), self.torrents.get((direction, file_id)),
+                       self.total[direction]):
+            if bucket is not None:
+                wait = bucket.reserve(nbytes)
+                if wait:
+                    time.sleep(wait)
+
+    def throttler(self, direction, file_id=None, peer=None):
+        """Returns a function that throttles a number of bytes for one transfer."""
+        return functools.partial(self.throttle, direction, file_id=file_id, peer=peer)
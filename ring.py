@@ -0,0 +1,29 @@
+import bisect
+import hashlib
+
+VIRTUAL_NODES = 64  # points per shard on the ring, so files spread evenly across shards
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of file ids onto tracker shards.
+
+    Each shard is placed at `vnodes` points of a 64-bit ring, and a file belongs to the shard at
+    the first point at or after the file id's hash. Adding or removing a shard only moves the files
+    next to its points, about 1/N of them. Every node builds the same ring from the same list of
+    shards, so no lookup service is needed.
+    """
+
+    def __init__(self, shards, vnodes=VIRTUAL_NODES):
+        if not shards:
+            raise ValueError("A hash ring needs at least one shard")
+        self.shards = list(shards)
+        points = sorted((ring_hash(f"{shard}#{i}"), shard) for shard in self.shards for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.owners = [shard for _, shard in points]
+
+    def shard_for(self, key):
+        return self.owners[bisect.bisect_left(self.hashes, ring_hash(key)) % len(self.hashes)]
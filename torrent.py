@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+from bitfield import Bitfield
+
+
+class Torrent:
+    """A node's session for one file: its chunk store, which chunks we have, their hashes and stats.
+
+    A node keeps one per file it seeds or downloads, keyed by file id, so transfers of
+    different files never share state.
+    """
+
+    def __init__(self, file_id, store, piece_hashes=None, complete=False):
+        self.file_id = file_id
+        self.store = store
+        num_chunks = store.num_chunks
+        self.bitfield = Bitfield.full(num_chunks) if complete else Bitfield(num_chunks)
+        self.have = num_chunks if complete else 0
+        self.piece_hashes = piece_hashes or []  # Expected sha256 of every chunk, from the tracker
+        self.downloader = None  # Downloader fetching the missing chunks, while there is one
+        self.log = None  # SessionLog checkpointing a download, so it can be resumed after a restart
+        self.lock = threading.Lock()
+        self.uploaded_chunks = 0
+        self.downloaded_chunks = 0
+        self.uploaded_bytes = 0
+        self.downloaded_bytes = 0
+
+    def has_chunk(self, chunk_id):
+        return 0 <= chunk_id < self.bitfield.length and self.bitfield[chunk_id] == 1
+
+    def mark_have(self, chunk_id):
+        """Records a chunk we received and checked; returns False if we already had it."""
+        with self.lock:
+            if self.bitfield[chunk_id]:
+                return False
+            self.bitfield[chunk_id] = 1
+            self.have += 1
+            self.downloaded_chunks += 1
+            self.downloaded_bytes += self.store.chunk_range(chunk_id)[1]
+            return True
+
+    def restore(self, chunk_ids):
+        """Marks chunks found on disk when resuming, without counting them as downloaded."""
+        with self.lock:
+            for chunk_id in chunk_ids:
+                if not self.bitfield[chunk_id]:
+                    self.bitfield[chunk_id] = 1
+                    self.have += 1
+
+    def discard(self, chunk_ids):
+        """Forgets chunks whose data turned out not to match their hash, so they are fetched again."""
+        with self.lock:
+            for chunk_id in chunk_ids:
+                if self.bitfield[chunk_id]:
+                    self.bitfield[chunk_id] = 0
+                    self.have -= 1
+
+    def checkpoint(self, chunk_ids):
+        """Records received chunks in the session log, if the download has one."""
+        if self.log is not None and chunk_ids:
+            self.log.record(have=list(chunk_ids))
+
+    def mark_sent(self, chunk_id):
+        with self.lock:
+            self.uploaded_chunks += 1
+            self.uploaded_bytes += self.store.chunk_range(chunk_id)[1]
+
+    def complete(self):
+        return self.have == self.store.num_chunks
+
+
+class SessionLog:
+    """Append-only record of a download's progress, kept next to its partial file.
+
+    The first line describes the file, every later line is a JSON object: either
+    {"have": [chunk ids]} for chunks that were received, or {"original_hash": ...}. A
+    checkpoint is one appended line, and a line torn by a crash is skipped when reading.
+    Chunk data is not synced before it is logged, so resumed chunks are verified again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a+')
+        self.lock = threading.Lock()
+        # Finish off a line torn by a crash, so it doesn't swallow the next record
+        if self.file.tell() > 0:
+            self.file.seek(self.file.tell() - 1)
+            if self.file.read(1) != '\n':
+                self.file.write('\n')
+
+    @classmethod
+    def create(cls, path, file_id, store):
+        with open(path, 'w') as f:
+            f.write(json.dumps({"file_id": file_id, "file_size": store.file_size, "piece_size": store.piece_size,
+                                "block_size": store.block_size}) + '\n')
+        return cls(path)
+
+    @staticmethod
+    def read(path):
+        """Returns the header, the set of logged chunk ids and the original hash (or None) of a log."""
+        have = set()
+        original_hash = None
+        with open(path) as f:
+            header = json.loads(f.readline())
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                have.update(entry.get("have", ()))
+                original_hash = entry.get("original_hash", original_hash)
+        return header, have, original_hash
+
+    def record(self, **entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def remove(self):
+        with self.lock:
+            self.file.close()
+            os.remove(self.path)
@@ -1,9 +1,28 @@
 from flask import Flask, request, jsonify
 from collections import defaultdict
+from array import array
+import heapq
+import itertools
+import os
 import random
+import threading
+import time
+import metrics
+from bitfield import Bitfield
+from indexed_set import IndexedSet
+from journal import Journal
 
 app = Flask(__name__)
 
+ASSIGNMENT_TTL = 30  # seconds an assigned chunk counts as in flight to its node
+MAX_BATCH = 256  # most chunks handed out by one /request_chunks call
+HOLDER_CHOICES = 3  # holders compared when picking who serves a chunk
+STATS_TTL = 60  # seconds a node's reported rates are trusted for
+NODE_TTL = 20  # seconds a node stays registered without a heartbeat (nodes send one with their stats)
+FAILED_PEER_TTL = 30  # seconds a node another node couldn't fetch from is only picked as a last resort
+PORT = int(os.environ.get('TRACKER_PORT', 8080))  # one per shard when several trackers split the files
+STATE_DIR = os.environ.get('TRACKER_STATE_DIR')  # where the tracker's state is journaled, None to keep it in memory only
+
 
 def exclude_self(nodes, node_id):
     return [node for node in nodes if node != node_id]
@@ -17,114 +36,613 @@ def get_node_id(ip, port):
     return str(ip) + ":" + str(port)
 
 class Tracker:
+    """Swarm state shared by every request handler.
+
+    Each file's state is guarded by its own lock, so requests for different files never wait on
+    each other, while all bookkeeping for one file (bitfields, frequencies, holders, the rarity
+    index and leases) changes atomically. The node registry has a lock of its own.
+
+    Registered nodes have to heartbeat within NODE_TTL. Their expiry times are kept in a heap, so
+    finding the nodes that went silent only looks at those, however many nodes there are. That's
+    checked whenever peers or holders are handed out, and an expired node is removed from every
+    file it was part of: its bitfield, the holder lists and the frequency counts.
+    """
     def __init__(self):
-        self.nodes = []
+        self.nodes = {} # node id -> expiry time, a dict so membership is O(1) and registration order is kept
+        self.expiry_heap = []  # (expiry time, node id), with stale entries for nodes that heartbeat since
+        self.node_files = defaultdict(set)  # node id -> files whose bitfields include it
+        self.expired_nodes = 0
+        self.nodes_lock = threading.Lock()
+        self.file_locks = {}
+        self.file_locks_lock = threading.Lock()
         self.torrents = {}
         self.chunk_freq = {} # maps each chunk id to freq
         self.chunk_holders = {}
+        self.metadata = {} # maps each file id to its length, piece size and block size
+        # For each file and node, the chunks the node is missing, bucketed by how many nodes have
+        # them, so the rarest missing chunk is found without scanning every chunk
+        self.missing = {}
+        # For each file, chunk id -> {node id: (lease expiry, holder)} of chunks handed out but not yet reported
+        self.assignments = {}
+        # How busy each node is serving others: leases naming it as the holder, and the rates and
+        # uploads in flight it last reported
+        self.holder_leases = defaultdict(int)
+        self.node_stats = {}
+        self.failed_peers = {}  # node id -> time until which other nodes avoid it, after one failed to reach it
+        self.load_lock = threading.Lock()
+        # Chunk sha256 -> [(file id, chunk id)], so a chunk can be fetched from holders of the same
+        # data in other files
+        self.chunks_by_hash = {}
+        self.chunks_by_hash_lock = threading.Lock()
+        self.journal = None  # Journal the state changes are logged to, if it's kept across restarts
+
+    def collect_stats(self):
+        """The size of the swarm state, as metrics."""
+        with self.load_lock:
+            leases = sum(self.holder_leases.values())
+        return [
+            ('tracker_nodes', 'gauge', "Registered nodes", len(self.nodes)),
+            ('tracker_files', 'gauge', "Files being tracked", len(self.metadata)),
+            ('tracker_leases', 'gauge', "Chunks handed out and not reported yet", leases),
+            ('tracker_expired_nodes_total', 'counter', "Nodes dropped for missing their heartbeats",
+             self.expired_nodes),
+        ]
 
     def register_peer(self, node_id):
-        if node_id not in self.nodes:
-            self.nodes.append(node_id)
+        """Registers a node, or renews its registration if it re-registers. Returns whether it is new."""
+        with self.nodes_lock:
+            new = node_id not in self.nodes
+            self._renew(node_id)
+            if new and self.journal is not None:
+                self.journal.register(node_id)
+            return new
+
+    def heartbeat(self, node_id):
+        """Keeps a node registered for another NODE_TTL. Returns False if it isn't registered (any more)."""
+        with self.nodes_lock:
+            if node_id not in self.nodes:
+                return False
+            self._renew(node_id)
             return True
-        else:
-            return False
 
-    def initialize_chunks(self, file_id, file_size, chunk_data):
+    def _renew(self, node_id):
+        expiry = time.monotonic() + NODE_TTL
+        self.nodes[node_id] = expiry
+        heapq.heappush(self.expiry_heap, (expiry, node_id))
+
+    def expire_nodes(self):
+        """Drops the nodes whose registration ran out, from the registry and every file they were in."""
+        now = time.monotonic()
+        expired = []
+        with self.nodes_lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                expiry, node_id = heapq.heappop(self.expiry_heap)
+                if self.nodes.get(node_id) == expiry:  # otherwise it heartbeat since
+                    del self.nodes[node_id]
+                    if self.journal is not None:
+                        self.journal.expire(node_id)
+                    expired.append((node_id, self.node_files.pop(node_id, set())))
+            self.expired_nodes += len(expired)
+        for node_id, file_ids in expired:
+            for file_id in file_ids:
+                with self.file_lock(file_id):
+                    if node_id not in self.nodes:  # unless it came back meanwhile
+                        self._remove_node(file_id, node_id)
+            with self.load_lock:
+                self.node_stats.pop(node_id, None)
+                self.failed_peers.pop(node_id, None)
+
+    def _remove_node(self, file_id, node_id):
+        chunks = self.torrents[file_id].pop(node_id, None)
+        if chunks is None:
+            return
+        if self.journal is not None:
+            self.journal.remove(file_id, node_id)
+        del self.missing[file_id][node_id]
+        for chunk_id in chunks.set_bits():
+            self._lose_holder(file_id, node_id, chunk_id)
+
+    def _track_node(self, file_id, node_id):
+        with self.nodes_lock:
+            self.node_files[node_id].add(file_id)
+
+    def report_failure(self, node_id):
+        """Records that a node couldn't be fetched from, so it's avoided for FAILED_PEER_TTL."""
+        with self.load_lock:
+            self.failed_peers[node_id] = time.monotonic() + FAILED_PEER_TTL
+
+    def _failed(self, node_id, now):
+        until = self.failed_peers.get(node_id)
+        return until is not None and until > now
+
+    def file_lock(self, file_id):
+        with self.file_locks_lock:
+            lock = self.file_locks.get(file_id)
+            if lock is None:
+                lock = self.file_locks[file_id] = threading.Lock()
+            return lock
+
+    def initialize_chunks(self, file_id, file_size, chunk_data, metadata=None):
+        """Starts tracking a file. `chunk_data` maps each node id to the Bitfield of chunks it holds."""
+        with self.file_lock(file_id):
+            self._initialize_chunks(file_id, file_size, chunk_data, metadata)
+            if self.journal is not None:
+                self.journal.initialize(file_id, file_size, chunk_data, metadata)
+
+    def _initialize_chunks(self, file_id, file_size, chunk_data, metadata):
+        if file_id in self.metadata:
+            self._unindex_hashes(file_id)
+        self.metadata[file_id] = dict(metadata or {}, num_chunks=file_size)
         self.torrents[file_id] = chunk_data
-        self.chunk_freq[file_id] = [0 for i in range(file_size)]
+        self.chunk_freq[file_id] = array('I', bytes(4 * file_size))
         self.chunk_holders[file_id] = [[] for i in range(file_size)] 
+        holders, freq = self.chunk_holders[file_id], self.chunk_freq[file_id]
         for node_id in chunk_data.keys():
-            for i, chunk in enumerate(chunk_data[node_id]):
-                if (chunk == 1):
-                    self.chunk_holders[file_id][i].append(node_id)
-                self.chunk_freq[file_id][i] += chunk
+            self._track_node(file_id, node_id)
+            for i in chunk_data[node_id].set_bits():
+                holders[i].append(node_id)
+                freq[i] += 1
         self.torrents[file_id] = chunk_data
+        self.missing[file_id] = {}
+        for leases in self.assignments.get(file_id, {}).values():
+            for lease in leases.values():
+                self._end_lease(lease)
+        self.assignments[file_id] = {}
+        # Sorting a node's missing chunks by frequency groups them into its buckets without a Python
+        # loop per chunk, which matters when a restarted tracker rebuilds millions of them
+        for node_id, chunks in chunk_data.items():
+            missing = sorted(chunks.missing(), key=freq.__getitem__)
+            self.missing[file_id][node_id] = {
+                f: IndexedSet(group) for f, group in itertools.groupby(missing, key=freq.__getitem__)}
+        with self.chunks_by_hash_lock:
+            for i, piece_hash in enumerate(self.metadata[file_id].get('piece_hashes') or ()):
+                self.chunks_by_hash.setdefault(piece_hash, []).append((file_id, i))
+
+    def _unindex_hashes(self, file_id):
+        with self.chunks_by_hash_lock:
+            for piece_hash in set(self.metadata[file_id].get('piece_hashes') or ()):
+                chunks = [c for c in self.chunks_by_hash.get(piece_hash, ()) if c[0] != file_id]
+                if chunks:
+                    self.chunks_by_hash[piece_hash] = chunks
+                else:
+                    self.chunks_by_hash.pop(piece_hash, None)
 
     def update_chunk(self, file_id, node_id, chunk_id):
+        return self.update_chunks(file_id, node_id, [chunk_id])
+
+    def _update_chunk(self, file_id, node_id, chunk_id):
         try:
-            self.torrents[file_id][node_id][chunk_id] = 1
+            chunks = self.torrents[file_id][node_id]
+            if chunks[chunk_id] == 1:
+                return True
+            chunks[chunk_id] = 1
+            old_freq = self.chunk_freq[file_id][chunk_id]
             self.chunk_freq[file_id][chunk_id] += 1
             self.chunk_holders[file_id][chunk_id].append(node_id)
-            return True
         except Exception as e:
             return False
 
+        self._release(file_id, node_id, chunk_id)
+
+        # The chunk got one holder more, so move it up a bucket for every node still missing it
+        missing = self.missing[file_id]
+        self._discard_missing(missing[node_id], old_freq, chunk_id)
+        for other_id, other_chunks in self.torrents[file_id].items():
+            if other_chunks[chunk_id] == 0:
+                self._discard_missing(missing[other_id], old_freq, chunk_id)
+                missing[other_id].setdefault(old_freq + 1, IndexedSet()).add(chunk_id)
+        return True
+
+    def update_chunks(self, file_id, node_id, chunk_ids):
+        """Records several chunks a node now holds.
+
+        Returns False, having changed nothing, if the torrent or node is unknown or any chunk id is
+        invalid, so the state and the journal never keep half of a report.
+        """
+        with self.file_lock(file_id):
+            chunks = self.torrents.get(file_id, {}).get(node_id)
+            if chunks is None or not all(isinstance(chunk_id, int) and 0 <= chunk_id < len(chunks)
+                                         for chunk_id in chunk_ids):
+                return False
+            for chunk_id in chunk_ids:
+                self._update_chunk(file_id, node_id, chunk_id)
+            if self.journal is not None:
+                self.journal.update(file_id, node_id, chunk_ids)
+            return True
+
+    def set_chunks(self, file_id, node_id, chunks):
+        """Replaces the Bitfield of chunks the tracker has for a node, e.g. after the node restarted.
+
+        A node the torrent doesn't know yet is added. Returns False if the torrent is unknown.
+        """
+        with self.file_lock(file_id):
+            torrent = self.torrents.get(file_id)
+            if torrent is None or len(chunks) != self.metadata[file_id]["num_chunks"]:
+                return False
+            if node_id not in torrent:
+                self._track_node(file_id, node_id)
+                torrent[node_id] = Bitfield(len(chunks))
+                freq = self.chunk_freq[file_id]
+                buckets = self.missing[file_id][node_id] = {}
+                for i in range(len(chunks)):
+                    buckets.setdefault(freq[i], IndexedSet()).add(i)
+            for chunk_id in list(torrent[node_id].set_bits()):
+                if not chunks[chunk_id]:
+                    self._drop_chunk(file_id, node_id, chunk_id)
+            for chunk_id in chunks.set_bits():
+                self._update_chunk(file_id, node_id, chunk_id)
+            if self.journal is not None:
+                self.journal.replace(file_id, node_id, chunks)
+            return True
+
+    def _drop_chunk(self, file_id, node_id, chunk_id):
+        """Undoes _update_chunk: the node no longer holds the chunk."""
+        self.torrents[file_id][node_id][chunk_id] = 0
+        self._lose_holder(file_id, node_id, chunk_id)
+
+    def _lose_holder(self, file_id, node_id, chunk_id):
+        old_freq = self.chunk_freq[file_id][chunk_id]
+        self.chunk_freq[file_id][chunk_id] -= 1
+        self.chunk_holders[file_id][chunk_id].remove(node_id)
+
+        # The chunk lost a holder, so move it down a bucket for every node missing it
+        missing = self.missing[file_id]
+        for other_id, other_chunks in self.torrents[file_id].items():
+            if other_chunks[chunk_id] == 0:
+                self._discard_missing(missing[other_id], old_freq, chunk_id)
+                missing[other_id].setdefault(old_freq - 1, IndexedSet()).add(chunk_id)
+
+    def _release(self, file_id, node_id, chunk_id):
+        leases = self.assignments[file_id].get(chunk_id)
+        if leases is not None:
+            lease = leases.pop(node_id, None)
+            if lease is not None:
+                self._end_lease(lease)
+            if not leases:
+                del self.assignments[file_id][chunk_id]
+
+    def _end_lease(self, lease):
+        _, holder = lease
+        with self.load_lock:
+            self.holder_leases[holder] -= 1
+            if self.holder_leases[holder] <= 0:
+                del self.holder_leases[holder]
+
+    def _busy_chunks(self, file_id, node_id, in_flight):
+        """Chunks currently in flight to nodes other than `node_id`.
+
+        Expired leases are dropped on the way, and so are leases of `node_id` on chunks that are no
+        longer in its `in_flight` list, since those fetches failed and can be handed out again.
+        """
+        now = time.monotonic()
+        busy = set()
+        assignments = self.assignments[file_id]
+        for chunk_id, leases in list(assignments.items()):
+            for leased_to, lease in list(leases.items()):
+                if lease[0] <= now or (leased_to == node_id and chunk_id not in in_flight):
+                    del leases[leased_to]
+                    self._end_lease(lease)
+            if not leases:
+                del assignments[chunk_id]
+            elif len(leases) > 1 or node_id not in leases:
+                busy.add(chunk_id)
+        return busy
+
+    def _discard_missing(self, buckets, freq, chunk_id):
+        bucket = buckets.get(freq)
+        if bucket is not None:
+            bucket.discard(chunk_id)
+            if not bucket:
+                del buckets[freq]
+
     def get_torrent_info(self, file_id):
         return self.torrents[file_id]
 
-    def get_peers(self):
-        return self.nodes
+    def encode_torrent_info(self, file_id):
+        self.expire_nodes()
+        with self.file_lock(file_id):
+            return {node_id: chunks.to_base64() for node_id, chunks in self.torrents[file_id].items()}
+
+    def get_metadata(self, file_id):
+        return self.metadata[file_id]
+
+    def copy_file_state(self, file_id):
+        """A consistent copy of a file's (num chunks, bitfield of every node, metadata), or None if it's unknown."""
+        with self.file_lock(file_id):
+            metadata = self.metadata.get(file_id)
+            if metadata is None:
+                return None
+            chunk_data = {node_id: Bitfield(chunks.length, chunks.bits) for node_id, chunks in self.torrents[file_id].items()}
+            return metadata["num_chunks"], chunk_data, metadata
+
+    def get_peers(self, expire=True):
+        if expire:
+            self.expire_nodes()
+        with self.nodes_lock:
+            return list(self.nodes)
     
-    def request_chunk(self, node_id, file_id):
-        request_id = ""
-        rarest_freq = float('inf')
-        rarest_chunk = -1
-        for chunk_id, freq in enumerate(self.chunk_freq[file_id]):
-            if (freq < rarest_freq and self.torrents[file_id][node_id][chunk_id] == 0):
-                rarest_freq = freq
-                request_id = random.choice(self.chunk_holders[file_id][chunk_id])
-                rarest_chunk = chunk_id
-        return (rarest_chunk, request_id)
+    def request_chunk(self, node_id, file_id, skip_chunks=(), skip_nodes=()):
+        """Picks the rarest chunk the node is missing and a holder to fetch it from.
+
+        `skip_chunks` are chunks the node still has in flight, and holders in `skip_nodes`
+        (e.g. ones that sent corrupt data) are only used when nobody else has the chunk.
+        """
+        schedule = self.request_chunks(node_id, file_id, 1, skip_chunks, skip_nodes)
+        return schedule[0][:2] if schedule else (-1, "")
+
+    def request_chunks(self, node_id, file_id, count, skip_chunks=(), skip_nodes=()):
+        """Hands a node up to `count` distinct chunks to fetch, rarest first, as (chunk id, holder, source).
+
+        Chunks already in flight to other nodes are only handed out once nothing equally rare is
+        left, so concurrent downloaders spread over different chunks. Handed out chunks are leased
+        to the node until it reports them or ASSIGNMENT_TTL runs out. `skip_chunks` and `skip_nodes`
+        work as in request_chunk.
+
+        The holder may be one of the file's holders, with `source` None, or hold a chunk with the
+        same hash in another file, with `source` the (file id, chunk id) to ask it for.
+
+        Holders that missed their heartbeats are gone by then, and holders another node recently
+        failed to reach are only picked when nobody else has the chunk.
+        """
+        self.expire_nodes()
+        with self.file_lock(file_id):
+            return self._request_chunks(node_id, file_id, count, skip_chunks, skip_nodes)
+
+    def _request_chunks(self, node_id, file_id, count, skip_chunks, skip_nodes):
+        buckets = self.missing[file_id][node_id]
+        exclude = set(skip_chunks)
+        busy = self._busy_chunks(file_id, node_id, exclude)
+        schedule = []
+        # There are at most as many buckets as nodes, so this is cheap however many chunks there are
+        for freq in sorted(buckets):
+            if freq == 0:
+                continue  # nobody has these yet
+            for avoid in (exclude | busy, exclude):
+                for chunk_id in buckets[freq].sample(count - len(schedule), avoid):
+                    exclude.add(chunk_id)
+                    schedule.append(chunk_id)
+                if len(schedule) == count:
+                    break
+            if len(schedule) == count:
+                break
+
+        now = time.monotonic()
+        expiry = now + ASSIGNMENT_TTL
+        result = []
+        for chunk_id in schedule:
+            holders = [(holder, None) for holder in self.chunk_holders[file_id][chunk_id]]
+            holders += self._same_chunk_holders(file_id, chunk_id, node_id)
+            usable = [h for h in holders if h[0] not in skip_nodes] or holders
+            with self.load_lock:
+                reachable = [h for h in usable if not self._failed(h[0], now)]
+            holder, source = self._pick_holder(reachable or usable)
+            self.assignments[file_id].setdefault(chunk_id, {})[node_id] = (expiry, holder)
+            with self.load_lock:
+                self.holder_leases[holder] += 1
+            result.append((chunk_id, holder, source))
+        return result
+
+    def report_stats(self, node_id, upload_rate, download_rate, uploads_in_flight):
+        """Records the transfer rates (bytes/s) and uploads in flight a node measured."""
+        with self.load_lock:
+            self.node_stats[node_id] = (time.monotonic() + STATS_TTL, upload_rate, download_rate, uploads_in_flight)
+
+    def _pick_holder(self, holders):
+        """Picks the least loaded of a few random (holder, source) candidates.
+
+        A holder's load is the uploads it has in flight, the larger of what we leased to it and what
+        it last reported, per byte/s of upload rate it reported. Holders that haven't reported count
+        as being as fast as the average of the candidates that have. Comparing a few random candidates instead of
+        every holder keeps this cheap and stops everyone from piling onto the same idle holder.
+        """
+        if len(holders) > HOLDER_CHOICES:
+            holders = random.sample(holders, HOLDER_CHOICES)
+        now = time.monotonic()
+        with self.load_lock:
+            stats = [self.node_stats.get(holder) for holder, _ in holders]
+            stats = [s if s is not None and s[0] > now else None for s in stats]
+            rates = [s[1] for s in stats if s is not None and s[1] > 0]
+            default_rate = sum(rates) / len(rates) if rates else 1.0
+            best, best_load = None, None
+            for candidate, s in zip(holders, stats):
+                in_flight = self.holder_leases.get(candidate[0], 0)
+                rate = default_rate
+                if s is not None:
+                    in_flight = max(in_flight, s[3])
+                    rate = s[1] if s[1] > 0 else default_rate
+                load = (in_flight + 1) / rate
+                if best is None or load < best_load:
+                    best, best_load = candidate, load
+        return best
+
+    def _same_chunk_holders(self, file_id, chunk_id, node_id):
+        """Holders of the same data as a chunk in other files split the same way, as (holder, source)."""
+        metadata = self.metadata[file_id]
+        piece_hashes = metadata.get('piece_hashes')
+        if not piece_hashes:
+            return []
+        with self.chunks_by_hash_lock:
+            same = list(self.chunks_by_hash.get(piece_hashes[chunk_id], ()))
+        holders = []
+        for other_file, other_chunk in same:
+            other = self.metadata[other_file]
+            if other_file == file_id or other['piece_size'] != metadata['piece_size'] or \
+                    other['block_size'] != metadata['block_size']:
+                continue
+            # list() copies a holder list in one step, so another file's can be read without its lock
+            for holder in list(self.chunk_holders[other_file][other_chunk]):
+                if holder != node_id:
+                    holders.append((holder, (other_file, other_chunk)))
+        return holders
 
 # Initialize the tracker
 tracker = Tracker()
+if STATE_DIR:
+    Journal(STATE_DIR).open(tracker)
+
+# Served at /metrics, by Flask here and by the ASGI app
+registry = metrics.Registry()
+request_seconds = registry.histogram('tracker_request_seconds', "Time spent handling a request", ('route',))
+requests_total = registry.counter('tracker_requests_total', "Requests handled", ('route', 'status'))
+registry.collect(tracker.collect_stats)
+
+# Every endpoint is a plain function of (json body, client ip) returning (json body, status), so
+# the same handlers can be served by Flask here and by the ASGI app in tracker_asgi.py
+ROUTES = {}
+
+def route(path, method):
+    def register_route(handler):
+        timed = timed_handler(path, handler)
+        ROUTES[(method, path)] = timed
+        app.add_url_rule(path, handler.__name__, lambda: respond(timed), methods=[method])
+        return handler
+    return register_route
+
+def timed_handler(path, handler):
+    """Wraps a handler to record its latency and response status."""
+    labels = (path,)
+    def timed(data, ip):
+        start = time.perf_counter()
+        status = 500
+        try:
+            body, status = handler(data, ip)
+            return body, status
+        finally:
+            request_seconds.observe(time.perf_counter() - start, labels)
+            requests_total.inc(1, (path, status))
+    return timed
+
+@app.route('/metrics', methods=['GET'])
+def serve_metrics():
+    return registry.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+def respond(handler):
+    body, status = handler(request.get_json(silent=True) or {}, request.remote_addr)
+    return jsonify(body), status
 
-@app.route('/register', methods=['POST'])
-def register():
-    data = request.json
-    ip = request.remote_addr
+@route('/register', 'POST')
+def register(data, ip):
     port = data.get('port')
     if port:
         if (tracker.register_peer(get_node_id(ip, port))):
-            return jsonify({"message": "Peer registered"}), 201
+            return {"message": "Peer registered"}, 201
         else:
-            return jsonify({"message": "Peer already exists"}), 400
-    return jsonify({"error": "Missing port"}), 400
+            # A node that restarted, or that was dropped for missing its heartbeats
+            return {"message": "Peer registration renewed"}, 200
+    return {"error": "Missing port"}, 400
 
-@app.route('/peers', methods=['GET'])
-def peers():
-    data = request.json
-    ip = request.remote_addr
+@route('/report_failure', 'POST')
+def report_failure(data, ip):
+    peer = data.get('peer')
+    if not peer:
+        return {"error": "Missing peer"}, 400
+    tracker.report_failure(peer)
+    return {"message": "Failure recorded"}, 200
+
+@route('/peers', 'GET')
+def peers(data, ip):
     port = data.get('port')
-    return jsonify({"available_peers": exclude_self(tracker.get_peers(), get_node_id(ip, port))}), 200
+    return {"available_peers": exclude_self(tracker.get_peers(), get_node_id(ip, port))}, 200
     
-@app.route('/initialize_chunks', methods=['POST'])
-def initialize_chunks():
-    data = request.json
+@route('/initialize_chunks', 'POST')
+def initialize_chunks(data, ip):
     file_id = data.get('file_id')
     file_size = data.get('file_size')
-    chunk_data = data.get('chunk_data')
-    tracker.initialize_chunks(file_id, file_size, chunk_data)
-    return jsonify({"message": "Initialized peer chunk data", "torrent_info": tracker.get_torrent_info(file_id)}), 200
+    # Bitfields arrive base64 encoded
+    chunk_data = {node_id: Bitfield.from_base64(file_size, chunks) for node_id, chunks in data.get('chunk_data').items()}
+    port = data.get('port')
+    if port:
+        # The uploader has every chunk, so it can always be fallen back on
+        chunk_data[get_node_id(ip, port)] = Bitfield.full(file_size)
+    # Everybody has to split the file the same way, so the piece size is part of the torrent
+    metadata = {key: data.get(key) for key in ('length', 'piece_size', 'block_size', 'piece_hashes')}
+    tracker.initialize_chunks(file_id, file_size, chunk_data, metadata)
+    return {"message": "Initialized peer chunk data", "num_chunks": file_size}, 200
     
-@app.route('/update_chunk', methods=['POST'])
-def update_chunk():
-    data = request.json 
-    ip = request.remote_addr
+@route('/update_chunk', 'POST')
+def update_chunk(data, ip):
     file_id = data.get('file_id')
     port = data.get('port')
     chunk_id = data.get('chunk_id')
     if tracker.update_chunk(file_id, get_node_id(ip, port), chunk_id):
-        return jsonify({"message": "Updated peer chunk data", "chunk_data": tracker.get_torrent_info(file_id)}), 200
+        return {"message": "Updated peer chunk data"}, 200
     else:
-        return jsonify({"error": "You need to call /initialize_chunks"}), 400
+        return {"error": "You need to call /initialize_chunks"}, 400
 
-@app.route('/torrent_data', methods=['GET'])
-def torrent_data():
-    data = request.json 
-    ip = request.remote_addr
+@route('/update_chunks', 'POST')
+def update_chunks(data, ip):
     file_id = data.get('file_id')
-    return jsonify({"chunk_data": tracker.get_torrent_info(file_id)}), 200
+    port = data.get('port')
+    chunk_ids = data.get('chunk_ids', [])
+    if 'bitfield' in data and file_id in tracker.metadata:
+        num_chunks = tracker.get_metadata(file_id)["num_chunks"]
+        chunks = Bitfield.from_base64(num_chunks, data['bitfield'])
+        if data.get('replace'):
+            # The node's whole bitfield, e.g. after it restarted and checked what survived on disk
+            if tracker.set_chunks(file_id, get_node_id(ip, port), chunks):
+                return {"message": "Replaced peer chunk data", "updated": chunks.count()}, 200
+            return {"error": "You need to call /initialize_chunks"}, 400
+        # A delta bitfield: every set bit is a chunk the node has gained
+        chunk_ids = list(chunks.set_bits())
+    if tracker.update_chunks(file_id, get_node_id(ip, port), chunk_ids):
+        return {"message": "Updated peer chunk data", "updated": len(chunk_ids)}, 200
+    else:
+        return {"error": "You need to call /initialize_chunks"}, 400
+
+@route('/stats', 'POST')
+def stats(data, ip):
+    port = data.get('port')
+    if not port:
+        return {"error": "Missing port"}, 400
+    node_id = get_node_id(ip, port)
+    # Stats double as the node's heartbeat; a node we dropped is told to register again
+    if not tracker.heartbeat(node_id):
+        return {"error": "Unknown peer, register again"}, 404
+    tracker.report_stats(node_id, float(data.get('upload_rate', 0)), float(data.get('download_rate', 0)),
+                         int(data.get('uploads_in_flight', 0)))
+    return {"message": "Stats recorded"}, 200
+
+@route('/torrent_data', 'GET')
+def torrent_data(data, ip):
+    file_id = data.get('file_id')
+    if file_id not in tracker.metadata:
+        return {"error": "Unknown file"}, 404
+    info = {"chunk_data": tracker.encode_torrent_info(file_id), "metadata": tracker.get_metadata(file_id)}
+    if 'port' in data:
+        info["node_id"] = get_node_id(ip, data['port'])  # how the tracker, and so the other peers, know the caller
+    return info, 200
+
+@route('/metadata', 'GET')
+def metadata(data, ip):
+    file_id = data.get('file_id')
+    if file_id not in tracker.metadata:
+        return {"error": "Unknown file"}, 404
+    return {"metadata": tracker.get_metadata(file_id)}, 200
+
+@route('/request_chunk', 'GET')
+def request_chunk(data, ip):
+    file_id = data.get('file_id')
+    port = data.get('port')
+    skip_chunks = set(data.get('skip_chunks', []))
+    skip_nodes = set(data.get('skip_nodes', []))
+    chunk_id, request_id = tracker.request_chunk(get_node_id(ip, port), file_id, skip_chunks, skip_nodes)
+    return {"chunk_id": chunk_id, "node": request_id}, 200
 
-@app.route('/request_chunk', methods=['GET'])
-def request_chunk():
-    data = request.json
-    ip = request.remote_addr
+@route('/request_chunks', 'GET')
+def request_chunks(data, ip):
     file_id = data.get('file_id')
     port = data.get('port')
-    chunk_id, request_id = tracker.request_chunk(get_node_id(ip, port), file_id)
-    return jsonify({"chunk_id": chunk_id, "node": request_id}), 200
+    count = min(int(data.get('count', 1)), MAX_BATCH)
+    skip_chunks = set(data.get('skip_chunks', []))
+    skip_nodes = set(data.get('skip_nodes', []))
+    schedule = tracker.request_chunks(get_node_id(ip, port), file_id, count, skip_chunks, skip_nodes)
+    entries = []
+    for chunk_id, node, source in schedule:
+        entry = {"chunk_id": chunk_id, "node": node}
+        if source is not None:
+            entry["source_file"], entry["source_chunk"] = source
+        entries.append(entry)
+    return {"schedule": entries}, 200
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
+    app.run(host='0.0.0.0', port=PORT, threaded=True)
@@ -0,0 +1,92 @@
+"""The tracker as an ASGI app, for serving many concurrent peers from an async server.
+
+Run with `python tracker_asgi.py` (needs uvicorn) or any ASGI server, e.g.
+`uvicorn tracker_asgi:app --port 8080`. It serves the same endpoints, backed by
+the same Tracker instance, as the Flask app in tracker.py.
+"""
+import asyncio
+import json
+import logging
+import sys
+import metrics
+from tracker import PORT, ROUTES, STATE_DIR, registry
+
+log = logging.getLogger(__name__)
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+async def send_json(send, body, status):
+    await send_text(send, json.dumps(body), status, 'application/json')
+
+
+async def send_text(send, text, status, content_type):
+    payload = text.encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(payload)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    body = await read_body(receive)
+    if (scope['method'], scope['path']) == ('GET', '/metrics'):
+        await send_text(send, registry.render(), 200, metrics.CONTENT_TYPE)
+        return
+    handler = ROUTES.get((scope['method'], scope['path']))
+    if handler is None:
+        await send_json(send, {"error": "Not found"}, 404)
+        return
+    try:
+        data = json.loads(body) if body else {}
+    except ValueError:
+        await send_json(send, {"error": "Body is not valid JSON"}, 400)
+        return
+
+    ip = scope['client'][0] if scope.get('client') else None
+    try:
+        if STATE_DIR is None:
+            # Without a journal, handlers only touch in-memory state, so they run right on the event loop
+            response, status = handler(data, ip)
+        else:
+            # Journal writes, and waiting on a snapshot holding the lock, would block every other request
+            response, status = await asyncio.get_running_loop().run_in_executor(None, handler, data, ip)
+    except Exception as e:
+        log.error("Error handling %s %s: %s", scope['method'], scope['path'], e, exc_info=True)
+        response, status = {"error": str(e)}, 500
+    await send_json(send, response, status)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        print("Serving the ASGI tracker needs uvicorn: pip install uvicorn")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    uvicorn.run(app, host='0.0.0.0', port=PORT, log_level='warning')